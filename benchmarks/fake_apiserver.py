@@ -0,0 +1,598 @@
+# In-process fake Kubernetes API server for benchmarks
+#
+# Implements enough of the core/v1 API for the spawner: discovery, create, get,
+# list, patch, server-side apply, delete, delete collection and watch.
+# Pods and PersistentVolumeClaims become ready after a delay, and every request
+# can be given extra latency to simulate a remote API server.
+
+import asyncio
+import json
+import re
+from collections import Counter, deque
+from copy import deepcopy
+from datetime import UTC, datetime
+from itertools import count
+from uuid import uuid4
+
+from aiohttp import web
+
+# plural -> kind, all namespaced
+RESOURCES = {
+    "configmaps": "ConfigMap",
+    "events": "Event",
+    "persistentvolumeclaims": "PersistentVolumeClaim",
+    "pods": "Pod",
+    "secrets": "Secret",
+    "serviceaccounts": "ServiceAccount",
+    "services": "Service",
+}
+VERBS = [
+    "create",
+    "delete",
+    "deletecollection",
+    "get",
+    "list",
+    "patch",
+    "update",
+    "watch",
+]
+
+
+def _now() -> str:
+    return datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _status(
+    code: int, reason: str, message: str, details: dict | None = None
+) -> web.Response:
+    status = {
+        "apiVersion": "v1",
+        "kind": "Status",
+        "metadata": {},
+        "status": "Failure",
+        "message": message,
+        "reason": reason,
+        "code": code,
+    }
+    if details:
+        status["details"] = details
+    return web.json_response(status, status=code)
+
+
+def _object_not_found(plural: str, name: str) -> web.Response:
+    # Unlike a missing resource, the details name the missing object
+    return _status(
+        404,
+        "NotFound",
+        f'{plural} "{name}" not found',
+        {"name": name, "kind": plural},
+    )
+
+
+def _merge(target: dict, patch: dict) -> dict:
+    """JSON merge patch, used for both merge and strategic merge patches"""
+    for k, v in patch.items():
+        if v is None:
+            target.pop(k, None)
+        elif isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge(target[k], v)
+        else:
+            target[k] = deepcopy(v)
+    return target
+
+
+def _split_selector(selector: str) -> list[str]:
+    # Split on commas that aren't inside a set, e.g. "a in (x,y),b=z"
+    return [s.strip() for s in re.split(r",(?![^()]*\))", selector) if s.strip()]
+
+
+def label_selector_matches(selector: str | None, labels: dict[str, str]) -> bool:
+    for requirement in _split_selector(selector or ""):
+        if m := re.fullmatch(r"(\S+)\s+(in|notin)\s+\((.*)\)", requirement):
+            key, op, values = m.groups()
+            value_set = {v.strip() for v in values.split(",")}
+            if (labels.get(key) in value_set) != (op == "in"):
+                return False
+        elif "!=" in requirement:
+            key, value = requirement.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in requirement:
+            key, value = requirement.replace("==", "=").split("=", 1)
+            if labels.get(key) != value:
+                return False
+        elif requirement.startswith("!"):
+            if requirement[1:] in labels:
+                return False
+        elif requirement not in labels:
+            return False
+    return True
+
+
+def field_selector_matches(selector: str | None, obj: dict) -> bool:
+    for requirement in _split_selector(selector or ""):
+        key, value = requirement.replace("==", "=").split("=", 1)
+        field: object = obj
+        for part in key.split("."):
+            field = field.get(part) if isinstance(field, dict) else None
+        if (field or "") != value:
+            return False
+    return True
+
+
+class _Watch:
+    def __init__(self, plural: str, namespace: str, query: dict[str, str]):
+        self.plural = plural
+        self.namespace = namespace
+        self.label_selector = query.get("labelSelector")
+        self.field_selector = query.get("fieldSelector")
+        # None closes the watch
+        self.queue: asyncio.Queue[tuple[str, dict] | None] = asyncio.Queue()
+
+    def matches(self, plural: str, obj: dict) -> bool:
+        return (
+            plural == self.plural
+            and obj["metadata"]["namespace"] == self.namespace
+            and label_selector_matches(
+                self.label_selector, obj["metadata"].get("labels") or {}
+            )
+            and field_selector_matches(self.field_selector, obj)
+        )
+
+
+class FakeApiServer:
+    """
+    A fake Kubernetes API server.
+
+    latency: seconds added to every request
+    ready_delay: seconds before a Pod is running or a PVC is bound
+    delete_delay: seconds a deleted Pod spends terminating
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        ready_delay: float = 0,
+        delete_delay: float = 0,
+        history: int = 10000,
+    ):
+        self.latency = latency
+        self.ready_delay = ready_delay
+        self.delete_delay = delete_delay
+        self.url = ""
+        # (verb, kind) -> number of requests
+        self.requests: Counter[tuple[str, str]] = Counter()
+
+        # plural -> (namespace, name) -> object
+        self._objects: dict[str, dict[tuple[str, str], dict]] = {
+            plural: {} for plural in RESOURCES
+        }
+        self._resource_versions = count(1)
+        self._resource_version = 0
+        # Recent events for resuming watches: (resourceVersion, type, plural, object)
+        self._history: deque[tuple[int, str, str, dict]] = deque(maxlen=history)
+        self._watches: set[_Watch] = set()
+        self._tasks: set[asyncio.Task] = set()
+        self._pod_ips = count(1)
+        self._runner: web.AppRunner | None = None
+
+        self.app = web.Application()
+        self.app.add_routes(
+            [
+                web.get("/version", self._version),
+                web.get("/api", self._api_versions),
+                web.get("/apis", self._api_groups),
+                web.get("/api/v1", self._api_resources),
+                web.get("/api/v1/namespaces/{namespace}/{plural}", self._list),
+                web.post("/api/v1/namespaces/{namespace}/{plural}", self._create),
+                web.delete(
+                    "/api/v1/namespaces/{namespace}/{plural}", self._delete_collection
+                ),
+                web.get("/api/v1/namespaces/{namespace}/{plural}/{name}", self._get),
+                web.patch(
+                    "/api/v1/namespaces/{namespace}/{plural}/{name}", self._patch
+                ),
+                web.delete(
+                    "/api/v1/namespaces/{namespace}/{plural}/{name}", self._delete
+                ),
+            ]
+        )
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        # Otherwise the server waits for watches to time out
+        for w in self._watches:
+            w.queue.put_nowait(None)
+        if self._runner:
+            await self._runner.cleanup()
+
+    def kubeconfig(self) -> dict:
+        return {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [{"name": "fake", "cluster": {"server": self.url}}],
+            "users": [{"name": "fake", "user": {"token": "fake"}}],
+            "contexts": [
+                {
+                    "name": "fake",
+                    "context": {"cluster": "fake", "user": "fake"},
+                }
+            ],
+            "current-context": "fake",
+        }
+
+    def reset_requests(self) -> Counter[tuple[str, str]]:
+        """Return and reset the request counts"""
+        requests = self.requests
+        self.requests = Counter()
+        return requests
+
+    def objects(self, plural: str) -> list[dict]:
+        return list(self._objects[plural].values())
+
+    # Helpers
+
+    async def _begin(self, verb: str, plural: str) -> str | None:
+        """Count a request and return its kind, or None if unknown"""
+        kind = RESOURCES.get(plural)
+        self.requests[(verb, kind or plural)] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return kind
+
+    def _later(self, delay: float, callback, *args) -> None:
+        async def run():
+            await asyncio.sleep(delay)
+            callback(*args)
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _next_resource_version(self) -> str:
+        self._resource_version = next(self._resource_versions)
+        return str(self._resource_version)
+
+    def _notify(self, event_type: str, plural: str, obj: dict) -> None:
+        copy = deepcopy(obj)
+        self._history.append((self._resource_version, event_type, plural, copy))
+        for w in self._watches:
+            if w.matches(plural, copy):
+                w.queue.put_nowait((event_type, copy))
+
+    def _store(self, plural: str, obj: dict, event_type: str) -> dict:
+        md = obj["metadata"]
+        md["resourceVersion"] = self._next_resource_version()
+        self._objects[plural][(md["namespace"], md["name"])] = obj
+        self._notify(event_type, plural, obj)
+        return obj
+
+    def _remove(self, plural: str, namespace: str, name: str) -> None:
+        obj = self._objects[plural].pop((namespace, name), None)
+        if obj:
+            obj["metadata"]["resourceVersion"] = self._next_resource_version()
+            self._notify("DELETED", plural, obj)
+
+    def _record_event(self, obj: dict, reason: str, message: str) -> None:
+        md = obj["metadata"]
+        now = _now()
+        event = {
+            "apiVersion": "v1",
+            "kind": "Event",
+            "metadata": {
+                "name": f"{md['name']}.{uuid4().hex[:12]}",
+                "namespace": md["namespace"],
+            },
+            "involvedObject": {
+                "apiVersion": obj["apiVersion"],
+                "kind": obj["kind"],
+                "name": md["name"],
+                "namespace": md["namespace"],
+                "uid": md["uid"],
+            },
+            "reason": reason,
+            "message": message,
+            "type": "Normal",
+            "count": 1,
+            "firstTimestamp": now,
+            "lastTimestamp": now,
+            "source": {"component": "fake-apiserver"},
+        }
+        self._store("events", event, "ADDED")
+
+    def _initialise(self, obj: dict) -> None:
+        """Set the initial status of a new object, and schedule it becoming ready"""
+        kind = obj["kind"]
+        if kind == "Service":
+            n = next(self._pod_ips)
+            obj.setdefault("spec", {})["clusterIP"] = f"10.96.{n // 256}.{n % 256}"
+        elif kind in ("Pod", "PersistentVolumeClaim"):
+            obj["status"] = {"phase": "Pending"}
+            md = obj["metadata"]
+            if self.ready_delay:
+                self._later(self.ready_delay, self._make_ready, kind, md)
+            else:
+                self._make_ready(kind, md, obj)
+
+    def _make_ready(self, kind: str, md: dict, obj: dict | None = None) -> None:
+        plural = "pods" if kind == "Pod" else "persistentvolumeclaims"
+        current = obj or self._objects[plural].get((md["namespace"], md["name"]))
+        if not current or current["metadata"]["uid"] != md["uid"]:
+            return
+        if kind == "Pod":
+            n = next(self._pod_ips)
+            current["status"] = {
+                "phase": "Running",
+                "podIP": f"10.244.{n // 256}.{n % 256}",
+                "conditions": [{"type": "Ready", "status": "True"}],
+            }
+            message = "Started container"
+        else:
+            current["status"] = {"phase": "Bound"}
+            message = "Successfully provisioned volume"
+        if obj is None:
+            self._store(plural, current, "MODIFIED")
+        self._record_event(current, "Ready", message)
+
+    def _create_object(self, plural: str, namespace: str, body: dict) -> dict:
+        obj = deepcopy(body)
+        obj["apiVersion"] = "v1"
+        obj["kind"] = RESOURCES[plural]
+        md = obj.setdefault("metadata", {})
+        md["namespace"] = namespace
+        md["uid"] = str(uuid4())
+        md["creationTimestamp"] = _now()
+        md["generation"] = 1
+        self._initialise(obj)
+        return obj
+
+    def _delete_object(self, plural: str, obj: dict, grace: str | None) -> dict:
+        md = obj["metadata"]
+        if plural == "pods" and self.delete_delay and grace != "0":
+            if "deletionTimestamp" not in md:
+                md["deletionTimestamp"] = _now()
+                self._store(plural, obj, "MODIFIED")
+                self._later(
+                    self.delete_delay,
+                    self._remove,
+                    plural,
+                    md["namespace"],
+                    md["name"],
+                )
+        else:
+            self._remove(plural, md["namespace"], md["name"])
+        return obj
+
+    # Discovery
+
+    async def _version(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"major": "1", "minor": "32", "gitVersion": "v1.32.0-fake"}
+        )
+
+    async def _api_versions(self, request: web.Request) -> web.Response:
+        return web.json_response({"kind": "APIVersions", "versions": ["v1"]})
+
+    async def _api_groups(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"kind": "APIGroupList", "apiVersion": "v1", "groups": []}
+        )
+
+    async def _api_resources(self, request: web.Request) -> web.Response:
+        resources = [
+            {
+                "name": plural,
+                "singularName": kind.lower(),
+                "namespaced": True,
+                "kind": kind,
+                "verbs": VERBS,
+            }
+            for (plural, kind) in RESOURCES.items()
+        ]
+        return web.json_response(
+            {
+                "kind": "APIResourceList",
+                "apiVersion": "v1",
+                "groupVersion": "v1",
+                "resources": resources,
+            }
+        )
+
+    # Collections
+
+    async def _list(self, request: web.Request) -> web.StreamResponse:
+        plural = request.match_info["plural"]
+        namespace = request.match_info["namespace"]
+        query = request.query
+        if query.get("watch") in ("true", "True", "1"):
+            return await self._watch(request)
+
+        kind = await self._begin("list", plural)
+        if not kind:
+            return _status(404, "NotFound", f"{plural} not found")
+        items = [
+            obj
+            for ((ns, _), obj) in self._objects[plural].items()
+            if ns == namespace
+            and label_selector_matches(
+                query.get("labelSelector"), obj["metadata"].get("labels") or {}
+            )
+            and field_selector_matches(query.get("fieldSelector"), obj)
+        ]
+        return web.json_response(
+            {
+                "apiVersion": "v1",
+                "kind": f"{kind}List",
+                "metadata": {"resourceVersion": str(self._resource_version)},
+                "items": items,
+            }
+        )
+
+    async def _watch(self, request: web.Request) -> web.StreamResponse:
+        plural = request.match_info["plural"]
+        namespace = request.match_info["namespace"]
+        query = request.query
+        kind = await self._begin("watch", plural)
+        if not kind:
+            return _status(404, "NotFound", f"{plural} not found")
+
+        w = _Watch(plural, namespace, dict(query))
+        resource_version = query.get("resourceVersion")
+        if resource_version:
+            oldest = self._history[0][0] if self._history else self._resource_version
+            if int(resource_version) < oldest - 1:
+                gone = {
+                    "kind": "Status",
+                    "apiVersion": "v1",
+                    "status": "Failure",
+                    "reason": "Expired",
+                    "message": f"too old resource version: {resource_version}",
+                    "code": 410,
+                }
+                w.queue.put_nowait(("ERROR", gone))
+            else:
+                for rv, event_type, p, obj in self._history:
+                    if rv > int(resource_version) and w.matches(p, obj):
+                        w.queue.put_nowait((event_type, obj))
+        else:
+            for obj in self._objects[plural].values():
+                if w.matches(plural, obj):
+                    w.queue.put_nowait(("ADDED", deepcopy(obj)))
+
+        response = web.StreamResponse()
+        response.content_type = "application/json"
+        await response.prepare(request)
+        self._watches.add(w)
+        try:
+            async with asyncio.timeout(float(query.get("timeoutSeconds", 1800))):
+                while item := await w.queue.get():
+                    event_type, obj = item
+                    line = json.dumps({"type": event_type, "object": obj})
+                    await response.write(line.encode() + b"\n")
+                    if event_type == "ERROR":
+                        break
+        except (TimeoutError, ConnectionResetError):
+            pass
+        finally:
+            self._watches.discard(w)
+        return response
+
+    async def _create(self, request: web.Request) -> web.Response:
+        plural = request.match_info["plural"]
+        namespace = request.match_info["namespace"]
+        kind = await self._begin("create", plural)
+        if not kind:
+            return _status(404, "NotFound", f"{plural} not found")
+        body = await request.json()
+        name = body.get("metadata", {}).get("name")
+        if (namespace, name) in self._objects[plural]:
+            return _status(409, "AlreadyExists", f'{plural} "{name}" already exists')
+        obj = self._create_object(plural, namespace, body)
+        if "dryRun" not in request.query:
+            self._store(plural, obj, "ADDED")
+        return web.json_response(obj, status=201)
+
+    async def _delete_collection(self, request: web.Request) -> web.Response:
+        plural = request.match_info["plural"]
+        namespace = request.match_info["namespace"]
+        query = request.query
+        kind = await self._begin("deletecollection", plural)
+        if not kind:
+            return _status(404, "NotFound", f"{plural} not found")
+        items = [
+            self._delete_object(plural, obj, query.get("gracePeriodSeconds"))
+            for ((ns, _), obj) in list(self._objects[plural].items())
+            if ns == namespace
+            and label_selector_matches(
+                query.get("labelSelector"), obj["metadata"].get("labels") or {}
+            )
+            and field_selector_matches(query.get("fieldSelector"), obj)
+        ]
+        return web.json_response(
+            {"apiVersion": "v1", "kind": f"{kind}List", "metadata": {}, "items": items}
+        )
+
+    # Objects
+
+    async def _get(self, request: web.Request) -> web.Response:
+        plural = request.match_info["plural"]
+        namespace = request.match_info["namespace"]
+        name = request.match_info["name"]
+        kind = await self._begin("get", plural)
+        if not kind:
+            return _status(404, "NotFound", f"{plural} not found")
+        obj = self._objects[plural].get((namespace, name))
+        if not obj:
+            return _object_not_found(plural, name)
+        return web.json_response(obj)
+
+    async def _patch(self, request: web.Request) -> web.Response:
+        plural = request.match_info["plural"]
+        namespace = request.match_info["namespace"]
+        name = request.match_info["name"]
+        apply = request.content_type == "application/apply-patch+yaml"
+        kind = await self._begin("apply" if apply else "patch", plural)
+        if not kind:
+            return _status(404, "NotFound", f"{plural} not found")
+        body = json.loads(await request.text())
+        dry_run = "dryRun" in request.query
+
+        obj = self._objects[plural].get((namespace, name))
+        if obj is None:
+            if not apply:
+                return _object_not_found(plural, name)
+            obj = self._create_object(plural, namespace, body)
+            if not dry_run:
+                self._store(plural, obj, "ADDED")
+            return web.json_response(obj, status=201)
+
+        precondition = body.get("metadata", {}).get("resourceVersion")
+        if precondition and precondition != obj["metadata"]["resourceVersion"]:
+            return _status(
+                409, "Conflict", f'{plural} "{name}": the object has been modified'
+            )
+        patched = _merge(deepcopy(obj), body)
+        patched["metadata"]["uid"] = obj["metadata"]["uid"]
+        if patched.get("spec") != obj.get("spec"):
+            patched["metadata"]["generation"] = obj["metadata"]["generation"] + 1
+        if not dry_run:
+            self._store(plural, patched, "MODIFIED")
+        return web.json_response(patched)
+
+    async def _delete(self, request: web.Request) -> web.Response:
+        plural = request.match_info["plural"]
+        namespace = request.match_info["namespace"]
+        name = request.match_info["name"]
+        kind = await self._begin("delete", plural)
+        if not kind:
+            return _status(404, "NotFound", f"{plural} not found")
+        obj = self._objects[plural].get((namespace, name))
+        if not obj:
+            return _object_not_found(plural, name)
+        obj = self._delete_object(plural, obj, request.query.get("gracePeriodSeconds"))
+        if (namespace, name) in self._objects[plural]:
+            # Graceful deletion, the object is returned
+            return web.json_response(obj)
+        return web.json_response(
+            {
+                "apiVersion": "v1",
+                "kind": "Status",
+                "metadata": {},
+                "status": "Success",
+                "details": {
+                    "name": name,
+                    "kind": plural,
+                    "uid": obj["metadata"]["uid"],
+                },
+            }
+        )
@@ -0,0 +1,164 @@
+# Micro-benchmark of parsing rendered manifests and writing template values
+#
+# Renders the chart in example/ and compares the pure Python YAML loader and
+# dumper with libyaml, and with JSON output from a helm worker. --copies repeats
+# the rendered documents to simulate a larger chart:
+#
+#   python -m benchmarks.parse --copies 1 20 100 --output parse.json
+#
+# Also measures the longest the event loop is blocked while parsing, with and
+# without parsing large output in a thread.
+
+import argparse
+import asyncio
+import gc
+import json
+import statistics
+import sys
+from collections.abc import Callable
+from pathlib import Path
+from time import perf_counter
+from typing import Any
+
+import yaml
+
+from kubetemplatespawner._gotemplate import Chart
+from kubetemplatespawner._kubernetes import SafeDumper, load_manifests
+from kubetemplatespawner._render import parse_manifests
+
+from .run import CHART_DIR
+
+# Template values as produced by KubeTemplateSpawner.template_namespace()
+VALUES = {
+    "userid": 12,
+    "unescaped_username": "user@example.org",
+    "unescaped_servername": "",
+    "escaped_username": "user-40example-2eorg",
+    "escaped_servername": "",
+    "escaped_user_server": "user-40example-2eorg",
+    "username": "user@example.org",
+    "instance": "jupyter",
+    "namespace": "default",
+    "port": 8888,
+    "serviceEnabled": True,
+    "env": {"JUPYTERHUB_API_TOKEN": "benchmark", "MULTILINE": "a\nb"},
+}
+
+
+def timeit(f: Callable[[], Any], min_time: float) -> float:
+    """Median seconds per call of f, called for at least min_time seconds"""
+    times = []
+    end = perf_counter() + min_time
+    while len(times) < 3 or perf_counter() < end:
+        start = perf_counter()
+        f()
+        times.append(perf_counter() - start)
+    return statistics.median(times)
+
+
+async def max_loop_lag(parse: Callable[[], Any]) -> float:
+    """Longest delay of a 1ms ticker while parse() runs"""
+    lag = 0.0
+    done = False
+
+    async def ticker() -> None:
+        nonlocal lag
+        while not done:
+            start = perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, perf_counter() - start - 0.001)
+
+    gc.collect()
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    result = parse()
+    if asyncio.iscoroutine(result):
+        await result
+    done = True
+    await task
+    return lag
+
+
+async def benchmark_copies(copies: int, min_time: float) -> dict[str, Any]:
+    manifests = Chart(CHART_DIR).render(VALUES) * copies
+    text = yaml.safe_dump_all(manifests, explicit_start=True)
+    json_text = json.dumps({"id": 1, "manifests": manifests})
+
+    times = {
+        "dump_values_python": timeit(lambda: yaml.dump(VALUES), min_time),
+        "dump_values_libyaml": timeit(
+            lambda: yaml.dump(VALUES, Dumper=SafeDumper), min_time
+        ),
+        "parse_python": timeit(
+            lambda: [d for d in yaml.safe_load_all(text) if d], min_time
+        ),
+        "parse_libyaml": timeit(lambda: load_manifests(text), min_time),
+        "parse_json": timeit(lambda: json.loads(json_text)["manifests"], min_time),
+    }
+    lag = {
+        "inline": await max_loop_lag(lambda: load_manifests(text)),
+        "parse_manifests": await max_loop_lag(lambda: parse_manifests(text)),
+    }
+    result = {
+        "copies": copies,
+        "documents": len(manifests),
+        "bytes": len(text),
+        "seconds": times,
+        "max_loop_lag": lag,
+        "speedup_libyaml": times["parse_python"] / times["parse_libyaml"],
+        "speedup_json": times["parse_python"] / times["parse_json"],
+    }
+
+    print(f"{copies} copies: {len(manifests)} documents, {len(text)} bytes")
+    for name, seconds in times.items():
+        print(f"  {name}: {seconds * 1e6:.1f}us")
+    print(
+        f"  libyaml {result['speedup_libyaml']:.1f}x, "
+        f"json {result['speedup_json']:.1f}x faster than the Python loader"
+    )
+    print(
+        f"  max event loop lag: inline {lag['inline'] * 1e3:.2f}ms, "
+        f"parse_manifests {lag['parse_manifests'] * 1e3:.2f}ms"
+    )
+    return result
+
+
+async def benchmark(options: argparse.Namespace) -> dict[str, Any]:
+    results = []
+    for copies in options.copies:
+        results.append(await benchmark_copies(copies, options.min_time))
+    return {
+        "metadata": {"libyaml": yaml.__with_libyaml__},
+        "results": results,
+    }
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--copies",
+        type=int,
+        nargs="+",
+        default=[1, 20, 100],
+        help="Number of copies of the rendered documents to parse",
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.5,
+        help="Minimum seconds to time each operation",
+    )
+    parser.add_argument("--output", type=Path, help="Write JSON results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> int:
+    options = parse_args(argv)
+    results = asyncio.run(benchmark(options))
+    if options.output:
+        options.output.write_text(json.dumps(results, indent=2) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
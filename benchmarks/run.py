@@ -0,0 +1,369 @@
+# Offline benchmarks of KubeTemplateSpawner
+#
+# Runs the real spawner against an in-process fake Kubernetes API server and a
+# stub helm, so no cluster or helm binary is needed:
+#
+#   python -m benchmarks.run --servers 10 100 1000 --output results.json
+#   python -m benchmarks.run --servers 100 --compare results.json
+#
+# Any spawner trait can be set with --set, e.g. --set render_skeleton=true
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tracemalloc
+from collections import Counter, namedtuple
+from collections.abc import Awaitable, Callable
+from datetime import UTC, datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any
+
+import yaml
+
+import kubetemplatespawner
+from kubetemplatespawner._kubernetes import close_shared_clients
+from kubetemplatespawner._render import render_cache, skeleton_cache
+from kubetemplatespawner.spawner import KubeTemplateSpawner
+
+from .fake_apiserver import FakeApiServer
+
+BENCHMARKS_DIR = Path(__file__).parent
+STUB_HELM_DIR = BENCHMARKS_DIR / "bin"
+CHART_DIR = BENCHMARKS_DIR.parent / "example"
+
+# Metrics compared by --compare, and whether higher is better
+COMPARED = {
+    "spawns_per_second": True,
+    "start_p50": False,
+    "start_p99": False,
+    "api_calls_per_spawn": False,
+    "memory_per_spawner": False,
+}
+
+User = namedtuple("User", "id name")
+ORMSpawner = namedtuple("ORMSpawner", "name server")
+
+
+class BenchmarkSpawner(KubeTemplateSpawner):
+    def get_env(self):
+        # Avoid needing a Hub
+        return {"JUPYTERHUB_API_TOKEN": "benchmark"}
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def latency_summary(durations: list[float]) -> dict[str, float]:
+    return {
+        "mean": statistics.fmean(durations) if durations else 0,
+        "p50": percentile(durations, 50),
+        "p90": percentile(durations, 90),
+        "p99": percentile(durations, 99),
+        "max": max(durations, default=0),
+    }
+
+
+def api_calls(requests: Counter[tuple[str, str]], n: int) -> dict[str, Any]:
+    """Requests made to the API server, per server"""
+    return {
+        "total": sum(requests.values()) / n,
+        "by_request": {
+            f"{verb} {kind}": count / n
+            for ((verb, kind), count) in sorted(requests.items())
+        },
+    }
+
+
+async def run_phase(
+    n: int,
+    f: Callable[[int], Awaitable[Any]],
+    concurrency: int,
+) -> tuple[float, list[float], list[str]]:
+    """Call f(0)..f(n-1) concurrently, returns wall time, durations and errors"""
+    semaphore = asyncio.Semaphore(concurrency or n)
+    durations: list[float] = []
+    errors: list[str] = []
+
+    async def timed(i: int) -> None:
+        async with semaphore:
+            start = perf_counter()
+            try:
+                await f(i)
+            except Exception as e:
+                errors.append(repr(e))
+            else:
+                durations.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(n)))
+    return perf_counter() - start, durations, errors
+
+
+class Benchmark:
+    """A fake API server, and spawners configured to use it"""
+
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        # For the kubeconfig and API discovery cache, which are per-server
+        self._tmpdir = TemporaryDirectory()
+        self.tmpdir = Path(self._tmpdir.name)
+        self.server = FakeApiServer(
+            latency=options.latency,
+            ready_delay=options.ready_delay,
+            delete_delay=options.delete_delay,
+        )
+
+    async def __aenter__(self) -> "Benchmark":
+        await self.server.start()
+        self.kubeconfig = self.tmpdir / "kubeconfig"
+        self.kubeconfig.write_text(yaml.safe_dump(self.server.kubeconfig()))
+        render_cache.clear()
+        skeleton_cache.clear()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await close_shared_clients()
+        await self.server.stop()
+        self._tmpdir.cleanup()
+
+    def spawner(self, i: int) -> BenchmarkSpawner:
+        return BenchmarkSpawner(
+            template_path=str(CHART_DIR),
+            user=User(i, f"user-{i}"),
+            orm_spawner=ORMSpawner("", None),
+            namespace="benchmark",
+            k8s_config_file=str(self.kubeconfig),
+            k8s_discovery_cache_file=str(self.tmpdir / "discovery.json"),
+            **self.options.traits,
+        )
+
+    async def warm_up(self) -> None:
+        """Create the shared client and API discovery cache outside the timings"""
+        spawner = self.spawner(-1)
+        await spawner._dyn_client()
+        await spawner.stop()
+        self.server.reset_requests()
+
+    async def run(self, n: int) -> dict[str, Any]:
+        await self.warm_up()
+        spawners = [self.spawner(i) for i in range(n)]
+        concurrency = self.options.concurrency
+        result: dict[str, Any] = {"servers": n}
+
+        async def start(i: int) -> None:
+            await spawners[i].start()
+
+        async def poll(i: int) -> None:
+            status = await spawners[i].poll()
+            if status is not None:
+                raise RuntimeError(f"Server {i} not running: {status}")
+
+        async def stop(i: int) -> None:
+            await spawners[i].stop()
+
+        for name, f in [("start", start), ("poll", poll), ("stop", stop)]:
+            wall, durations, errors = await run_phase(n, f, concurrency)
+            result[name] = {
+                "wall_seconds": wall,
+                "per_second": len(durations) / wall if wall else 0,
+                "latency": latency_summary(durations),
+                "errors": len(errors),
+                "api_calls": api_calls(self.server.reset_requests(), n),
+            }
+            if errors:
+                print(f"  {name} errors ({len(errors)}): {errors[0]}", file=sys.stderr)
+
+        result["spawns_per_second"] = result["start"]["per_second"]
+        result["start_p50"] = result["start"]["latency"]["p50"]
+        result["start_p99"] = result["start"]["latency"]["p99"]
+        result["api_calls_per_spawn"] = result["start"]["api_calls"]["total"]
+        return result
+
+    async def memory(self, n: int) -> float:
+        """
+        Bytes allocated per started spawner, excluding the fake API server.
+        Run separately because tracing allocations slows everything down.
+        """
+        await self.warm_up()
+        excluded = [
+            tracemalloc.Filter(False, str(BENCHMARKS_DIR / "*"), all_frames=True),
+            tracemalloc.Filter(False, "*/aiohttp/web*", all_frames=True),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ]
+        gc.collect()
+        tracemalloc.start(25)
+        try:
+            before = tracemalloc.take_snapshot().filter_traces(excluded)
+            spawners = [self.spawner(i) for i in range(n)]
+            await asyncio.gather(*(s.start() for s in spawners))
+            gc.collect()
+            after = tracemalloc.take_snapshot().filter_traces(excluded)
+        finally:
+            tracemalloc.stop()
+        await asyncio.gather(*(s.stop() for s in spawners))
+        growth = sum(s.size_diff for s in after.compare_to(before, "filename"))
+        return growth / n
+
+
+async def benchmark(options: argparse.Namespace) -> dict[str, Any]:
+    results = []
+    for n in options.servers:
+        print(f"Benchmarking {n} servers", file=sys.stderr)
+        async with Benchmark(options) as b:
+            result = await b.run(n)
+        if options.memory:
+            async with Benchmark(options) as b:
+                result["memory_per_spawner"] = await b.memory(n)
+        results.append(result)
+        print(summary(result), file=sys.stderr)
+
+    return {
+        "metadata": {
+            "kubetemplatespawner": kubetemplatespawner.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.now(UTC).isoformat(),
+            "options": {
+                "latency": options.latency,
+                "ready_delay": options.ready_delay,
+                "delete_delay": options.delete_delay,
+                "concurrency": options.concurrency,
+                "traits": options.traits,
+            },
+        },
+        "results": results,
+    }
+
+
+def summary(result: dict[str, Any]) -> str:
+    lines = [
+        f"  servers: {result['servers']}",
+        f"  spawns/s: {result['spawns_per_second']:.1f}",
+        f"  start p50/p99: {result['start_p50']:.3f}s/{result['start_p99']:.3f}s",
+    ]
+    for phase in ("start", "poll", "stop"):
+        lines.append(
+            f"  {phase} API calls/server: {result[phase]['api_calls']['total']:.1f}"
+        )
+    if "memory_per_spawner" in result:
+        lines.append(f"  memory/spawner: {result['memory_per_spawner'] / 1024:.1f} KiB")
+    return "\n".join(lines)
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any], threshold: float) -> int:
+    """Print changes from a baseline, returns the number of regressions"""
+    previous = {r["servers"]: r for r in baseline["results"]}
+    regressions = 0
+    for result in current["results"]:
+        old = previous.get(result["servers"])
+        if not old:
+            continue
+        print(f"{result['servers']} servers:")
+        for metric, higher_is_better in COMPARED.items():
+            if metric not in result or not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = " REGRESSION"
+                regressions += 1
+            print(
+                f"  {metric}: {old[metric]:.4g} -> {result[metric]:.4g} "
+                f"({change:+.1%}){flag}"
+            )
+    return regressions
+
+
+def parse_trait(s: str) -> tuple[str, Any]:
+    name, sep, value = s.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"Expected trait=value: {s}")
+    return name, yaml.safe_load(value)
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--servers",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="Number of servers to start, poll and stop concurrently",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="Maximum concurrent operations, default unlimited",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds added to each API request"
+    )
+    parser.add_argument(
+        "--ready-delay",
+        type=float,
+        default=0,
+        help="Seconds before pods and volumes are ready",
+    )
+    parser.add_argument(
+        "--delete-delay",
+        type=float,
+        default=0,
+        help="Seconds a deleted pod is terminating",
+    )
+    parser.add_argument(
+        "--set",
+        dest="traits",
+        type=parse_trait,
+        action="append",
+        default=[],
+        metavar="TRAIT=VALUE",
+        help="Set a KubeTemplateSpawner trait, value is parsed as YAML",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Also measure memory per spawner (slow)",
+    )
+    parser.add_argument("--output", type=Path, help="Write JSON results to this file")
+    parser.add_argument(
+        "--compare", type=Path, help="Compare with JSON results from a previous run"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative change treated as a regression by --compare",
+    )
+    options = parser.parse_args(argv)
+    options.traits = dict(options.traits)
+    return options
+
+
+def main(argv: list[str] | None = None) -> int:
+    options = parse_args(argv)
+    os.environ["PATH"] = f"{STUB_HELM_DIR}{os.pathsep}{os.environ['PATH']}"
+    results = asyncio.run(benchmark(options))
+    if options.output:
+        options.output.write_text(json.dumps(results, indent=2) + "\n")
+    if options.compare:
+        baseline = json.loads(options.compare.read_text())
+        if compare(baseline, results, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
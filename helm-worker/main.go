@@ -0,0 +1,203 @@
+// Persistent helm template worker for kubetemplatespawner.HelmWorkerRenderer
+//
+// Loads a chart once, and renders it in the same way as `helm template` for each
+// request, so helm isn't started and the chart isn't loaded for every render.
+//
+//	Usage: kubetemplatespawner-helm-worker CHART_PATH
+//
+// Requests are read from stdin and responses are written to stdout, one JSON
+// object per line:
+//
+//	{"id": 1, "op": "render", "values": {...}}  ->  {"id": 1, "yaml": "..."}
+//	                                                {"id": 1, "error": "..."}
+//	{"id": 2, "op": "ping"}                     ->  {"id": 2, "ok": true}
+//
+// If a render request has "format": "json" the manifests are returned as a list
+// of JSON objects in "manifests" instead of a YAML stream in "yaml".
+package main
+
+import (
+	"bufio"
+	"encoding/json"
+	"fmt"
+	"os"
+	"strings"
+
+	"helm.sh/helm/v3/pkg/chart"
+	"helm.sh/helm/v3/pkg/chart/loader"
+	"helm.sh/helm/v3/pkg/chartutil"
+	"helm.sh/helm/v3/pkg/engine"
+	"helm.sh/helm/v3/pkg/releaseutil"
+	"sigs.k8s.io/yaml"
+)
+
+// Maximum size of a request line
+const maxRequestSize = 64 * 1024 * 1024
+
+type request struct {
+	ID     json.Number            `json:"id"`
+	Op     string                 `json:"op"`
+	Format string                 `json:"format"`
+	Values map[string]interface{} `json:"values"`
+}
+
+type response struct {
+	ID        json.Number        `json:"id"`
+	YAML      *string            `json:"yaml,omitempty"`
+	Manifests *[]json.RawMessage `json:"manifests,omitempty"`
+	OK        bool               `json:"ok,omitempty"`
+	Error     string             `json:"error,omitempty"`
+}
+
+type worker struct {
+	path  string
+	chart *chart.Chart
+}
+
+func (w *worker) load() (*chart.Chart, error) {
+	// Dependencies are modified when values are processed, so charts with
+	// dependencies are loaded for each render
+	if w.chart != nil && len(w.chart.Metadata.Dependencies) == 0 {
+		return w.chart, nil
+	}
+	return loader.Load(w.path)
+}
+
+// A rendered manifest
+type document struct {
+	path    string
+	content string
+}
+
+func (w *worker) render(values map[string]interface{}) (docs []document, err error) {
+	defer func() {
+		if r := recover(); r != nil {
+			err = fmt.Errorf("panic: %v", r)
+		}
+	}()
+
+	ch, err := w.load()
+	if err != nil {
+		return nil, err
+	}
+	if values == nil {
+		values = map[string]interface{}{}
+	}
+	if err := chartutil.ProcessDependenciesWithMerge(ch, values); err != nil {
+		return nil, err
+	}
+	options := chartutil.ReleaseOptions{
+		Name:      "release-name",
+		Namespace: "default",
+		Revision:  1,
+		IsInstall: true,
+	}
+	renderValues, err := chartutil.ToRenderValues(ch, values, options, chartutil.DefaultCapabilities)
+	if err != nil {
+		return nil, err
+	}
+	files, err := engine.Render(ch, renderValues)
+	if err != nil {
+		return nil, err
+	}
+	for name := range files {
+		if strings.HasSuffix(name, "NOTES.txt") {
+			delete(files, name)
+		}
+	}
+	hooks, sorted, err := releaseutil.SortManifests(files, nil, releaseutil.InstallOrder)
+	if err != nil {
+		return nil, err
+	}
+
+	for _, m := range sorted {
+		docs = append(docs, document{m.Name, m.Content})
+	}
+	for _, h := range hooks {
+		docs = append(docs, document{h.Path, h.Manifest})
+	}
+	return docs, nil
+}
+
+// Manifests as a YAML stream, as output by `helm template`
+func toYAML(docs []document) string {
+	var out strings.Builder
+	for _, d := range docs {
+		fmt.Fprintf(&out, "---\n# Source: %s\n%s\n", d.path, d.content)
+	}
+	return out.String()
+}
+
+// Manifests as JSON objects, skipping empty documents
+func toJSON(docs []document) (*[]json.RawMessage, error) {
+	manifests := []json.RawMessage{}
+	for _, d := range docs {
+		j, err := yaml.YAMLToJSON([]byte(d.content))
+		if err != nil {
+			return nil, fmt.Errorf("%s: %w", d.path, err)
+		}
+		if string(j) != "null" {
+			manifests = append(manifests, j)
+		}
+	}
+	return &manifests, nil
+}
+
+func (w *worker) handle(line []byte) response {
+	var req request
+	if err := json.Unmarshal(line, &req); err != nil {
+		return response{Error: fmt.Sprintf("invalid request: %v", err)}
+	}
+	resp := response{ID: req.ID}
+	switch req.Op {
+	case "ping":
+		resp.OK = true
+	case "render":
+		docs, err := w.render(req.Values)
+		if err == nil && req.Format == "json" {
+			resp.Manifests, err = toJSON(docs)
+		} else if err == nil {
+			manifests := toYAML(docs)
+			resp.YAML = &manifests
+		}
+		if err != nil {
+			resp.Error = err.Error()
+		}
+	default:
+		resp.Error = fmt.Sprintf("unknown op %q", req.Op)
+	}
+	return resp
+}
+
+func main() {
+	if len(os.Args) != 2 {
+		fmt.Fprintln(os.Stderr, "Usage: kubetemplatespawner-helm-worker CHART_PATH")
+		os.Exit(2)
+	}
+	w := &worker{path: os.Args[1]}
+	ch, err := loader.Load(w.path)
+	if err != nil {
+		fmt.Fprintf(os.Stderr, "Failed to load chart %s: %v\n", w.path, err)
+		os.Exit(1)
+	}
+	w.chart = ch
+
+	scanner := bufio.NewScanner(os.Stdin)
+	scanner.Buffer(make([]byte, 64*1024), maxRequestSize)
+	out := bufio.NewWriter(os.Stdout)
+	encoder := json.NewEncoder(out)
+	for scanner.Scan() {
+		if err := encoder.Encode(w.handle(scanner.Bytes())); err != nil {
+			fmt.Fprintln(os.Stderr, err)
+			os.Exit(1)
+		}
+		if err := out.Flush(); err != nil {
+			fmt.Fprintln(os.Stderr, err)
+			os.Exit(1)
+		}
+	}
+	if err := scanner.Err(); err != nil {
+		fmt.Fprintln(os.Stderr, err)
+		os.Exit(1)
+	}
+}
@@ -1,4 +1,14 @@
+from ._helmworker import HelmWorkerRenderer
+from ._render import GoTemplateRenderer, HelmRenderer, Renderer
 from ._version import __version__
 from .spawner import KubeTemplateException, KubeTemplateSpawner
 
-__all__ = ["KubeTemplateException", "KubeTemplateSpawner", "__version__"]
+__all__ = [
+    "GoTemplateRenderer",
+    "HelmRenderer",
+    "HelmWorkerRenderer",
+    "KubeTemplateException",
+    "KubeTemplateSpawner",
+    "Renderer",
+    "__version__",
+]
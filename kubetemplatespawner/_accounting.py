@@ -0,0 +1,162 @@
+# Accounting of Kubernetes API requests made by spawner operations
+#
+# The shared client's REST transport is instrumented to count every request by
+# verb and resource, and attribute it to the spawner operation (start, stop,
+# poll, ...) running in the current context. Counts are exported as metrics and
+# summarised in a debug log when the operation ends, so that changes in the
+# number of requests per operation are easy to spot.
+
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import Logger
+from time import perf_counter
+from typing import Any
+from urllib.parse import urlparse
+
+from ._metrics import API_REQUESTS, API_REQUESTS_PER_OPERATION
+
+# Operation for requests made outside a spawner operation, e.g. shared informers
+BACKGROUND = "background"
+
+
+class ApiCalls:
+    """Kubernetes API requests made during one operation"""
+
+    def __init__(self, operation: str, instance: str):
+        self.operation = operation
+        self.instance = instance
+        # (verb, resource) -> number of requests
+        self.requests: Counter[tuple[str, str]] = Counter()
+        self.start = perf_counter()
+        self.end: float | None = None
+
+    @property
+    def total(self) -> int:
+        return sum(self.requests.values())
+
+    def by_verb(self) -> Counter[str]:
+        verbs: Counter[str] = Counter()
+        for (verb, _), n in self.requests.items():
+            verbs[verb] += n
+        return verbs
+
+    def summary(self) -> str:
+        """E.g. 'start: 3 get, 2 create, 1 watch, 412 ms'"""
+        duration = (self.end or perf_counter()) - self.start
+        parts = [f"{n} {verb}" for (verb, n) in self.by_verb().most_common()]
+        parts.append(f"{duration * 1000:.0f} ms")
+        return f"{self.operation}: {', '.join(parts)}"
+
+
+# The operation for the running task. Tasks inherit a copy of the context, so
+# background tasks started by an operation may outlive it, their later requests
+# are counted as background requests.
+_current_operation: ContextVar[ApiCalls | None] = ContextVar(
+    "current_operation", default=None
+)
+
+
+@contextmanager
+def api_operation(
+    operation: str, instance: str, log: Logger | None = None
+) -> Iterator[ApiCalls]:
+    """Count API requests made in this context, and log a summary at debug level"""
+    calls = ApiCalls(operation, instance)
+    token = _current_operation.set(calls)
+    try:
+        yield calls
+    finally:
+        _current_operation.reset(token)
+        calls.end = perf_counter()
+        API_REQUESTS_PER_OPERATION.labels(operation, instance).observe(calls.total)
+        if log:
+            log.debug(calls.summary())
+
+
+def _query_value(query_params: Any, key: str) -> Any:
+    if isinstance(query_params, dict):
+        return query_params.get(key)
+    for k, v in query_params or []:
+        if k == key:
+            return v
+    return None
+
+
+def classify_request(
+    method: str,
+    url: str,
+    query_params: Any = None,
+    headers: dict[str, str] | None = None,
+) -> tuple[str, str]:
+    """
+    Kubernetes (verb, resource) of a REST request, e.g. ('list', 'pods').
+    Subresources are included in the resource, e.g. 'pods/log'.
+    """
+    parts = [p for p in urlparse(url).path.split("/") if p]
+    if parts[:1] == ["api"] and len(parts) > 2:
+        # /api/v1/...
+        parts = parts[2:]
+    elif parts[:1] == ["apis"] and len(parts) > 3:
+        # /apis/group/version/...
+        parts = parts[3:]
+    else:
+        return method.lower(), "discovery"
+    if parts[0] == "namespaces" and len(parts) > 2:
+        parts = parts[2:]
+    resource = "/".join([parts[0], *parts[2:3]])
+    named = len(parts) > 1
+
+    method = method.upper()
+    if method == "GET":
+        if str(_query_value(query_params, "watch")).lower() in ("true", "1"):
+            verb = "watch"
+        else:
+            verb = "get" if named else "list"
+    elif method == "POST":
+        verb = "create"
+    elif method == "PUT":
+        verb = "update"
+    elif method == "PATCH":
+        content_type = (headers or {}).get("Content-Type", "")
+        verb = (
+            "apply" if content_type.startswith("application/apply-patch") else "patch"
+        )
+    elif method == "DELETE":
+        verb = "delete" if named else "deletecollection"
+    else:
+        verb = method.lower()
+    return verb, resource
+
+
+def current_operation() -> str:
+    """Name of the operation running in this context"""
+    calls = _current_operation.get()
+    if calls and calls.end is None:
+        return calls.operation
+    return BACKGROUND
+
+
+def record_request(verb: str, resource: str) -> None:
+    calls = _current_operation.get()
+    if calls and calls.end is None:
+        calls.requests[(verb, resource)] += 1
+        API_REQUESTS.labels(calls.operation, verb, resource, calls.instance).inc()
+    else:
+        API_REQUESTS.labels(BACKGROUND, verb, resource, "").inc()
+
+
+def instrument(rest_client: Any) -> None:
+    """Count all requests made by a kubernetes_asyncio RESTClientObject"""
+    request = rest_client.request
+
+    async def counted_request(
+        method: str, url: str, query_params: Any = None, headers: Any = None, **kwargs
+    ) -> Any:
+        record_request(*classify_request(method, url, query_params, headers))
+        return await request(
+            method, url, query_params=query_params, headers=headers, **kwargs
+        )
+
+    rest_client.request = counted_request
@@ -0,0 +1,1320 @@
+# In-process renderer for Helm charts
+#
+# Implements the subset of Go's text/template and the Sprig template functions
+# that's commonly used in Helm charts, so a chart can be rendered without
+# running helm. Values follow Helm's conventions: numbers in values are float64
+# so large integers are printed in exponent form, missing values are printed
+# as an empty string, accessing a field of a missing value is an error, and
+# manifests are returned in Helm's install order.
+#
+# Not supported: subcharts, .Files other than Get, break/continue, and Sprig
+# functions that aren't listed in FUNCTIONS. These raise TemplateUnsupported
+# when the chart is parsed.
+
+import ast
+import base64
+import hashlib
+import json
+import re
+import threading
+from collections.abc import Callable, Iterable
+from copy import deepcopy
+from decimal import Decimal
+from pathlib import Path
+from typing import Any
+
+import yaml
+
+from ._kubernetes import SafeLoader, YamlT
+
+
+class TemplateError(Exception):
+    """A chart couldn't be parsed or rendered"""
+
+
+class TemplateUnsupported(TemplateError):
+    """A chart uses a feature that isn't implemented, helm may be able to render it"""
+
+
+# Lexer
+
+_WHITESPACE = " \t\r\n"
+_NUMBER = re.compile(
+    r"[-+]?(?:0[xX][0-9a-fA-F_]+|(?:\d[\d_]*(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)"
+)
+_IDENT = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_FIELDS = re.compile(r"(?:\.[A-Za-z_][A-Za-z0-9_]*)+")
+_VARIABLE = re.compile(r"\$[A-Za-z0-9_]*")
+
+# Token kinds
+LIT = "lit"
+DOT = "dot"
+FIELD = "field"
+VAR = "var"
+IDENT = "ident"
+OP = "op"
+CHAIN = "chain"
+
+Token = tuple
+
+
+def _lex_string(text: str, i: int) -> tuple[str, int]:
+    j = i + 1
+    while j < len(text):
+        if text[j] == "\\":
+            j += 2
+            continue
+        if text[j] == '"':
+            try:
+                return ast.literal_eval(text[i : j + 1]), j + 1
+            except (SyntaxError, ValueError) as e:
+                raise TemplateError(f"Invalid string {text[i : j + 1]}: {e}")
+        if text[j] == "\n":
+            break
+        j += 1
+    raise TemplateError("Unterminated quoted string")
+
+
+def _lex_action(text: str, i: int) -> tuple[list[Token], int, bool]:
+    """
+    Tokens in an action starting at i.
+    Returns the tokens, the position after the action, and whether the
+    following text should be trimmed.
+    """
+    tokens: list[Token] = []
+    while True:
+        start = i
+        while i < len(text) and text[i] in _WHITESPACE:
+            i += 1
+        if i >= len(text):
+            raise TemplateError("Unclosed action")
+        if text.startswith("}}", i):
+            return tokens, i + 2, False
+        if text.startswith("-}}", i) and i > start:
+            return tokens, i + 3, True
+
+        c = text[i]
+        if c == '"':
+            value, i = _lex_string(text, i)
+            tokens.append((LIT, value))
+        elif c == "`":
+            end = text.find("`", i + 1)
+            if end < 0:
+                raise TemplateError("Unterminated raw string")
+            tokens.append((LIT, text[i + 1 : end]))
+            i = end + 1
+        elif c == "'" and len(text) > i + 2 and text[i + 2] == "'":
+            tokens.append((LIT, ord(text[i + 1])))
+            i += 3
+        elif (m := _NUMBER.match(text, i)) and (c.isdigit() or c in "-+."):
+            number = m.group(0).replace("_", "")
+            if re.fullmatch(r"[-+]?0[xX][0-9a-fA-F]+", number):
+                tokens.append((LIT, int(number, 16)))
+            elif re.fullmatch(r"[-+]?\d+", number):
+                tokens.append((LIT, int(number)))
+            else:
+                tokens.append((LIT, float(number)))
+            i = m.end()
+        elif c == ".":
+            if m := _FIELDS.match(text, i):
+                tokens.append((FIELD, m.group(0)[1:].split(".")))
+                i = m.end()
+            else:
+                tokens.append((DOT,))
+                i += 1
+        elif c == "$":
+            m = _VARIABLE.match(text, i)
+            assert m
+            i = m.end()
+            fields = []
+            if f := _FIELDS.match(text, i):
+                fields = f.group(0)[1:].split(".")
+                i = f.end()
+            tokens.append((VAR, m.group(0), fields))
+        elif text.startswith(":=", i):
+            tokens.append((OP, ":="))
+            i += 2
+        elif c in "=|(),":
+            tokens.append((OP, c))
+            i += 1
+            if c == ")" and (f := _FIELDS.match(text, i)):
+                tokens.append((CHAIN, f.group(0)[1:].split(".")))
+                i = f.end()
+        elif m := _IDENT.match(text, i):
+            word = m.group(0)
+            if word in ("true", "false"):
+                tokens.append((LIT, word == "true"))
+            elif word == "nil":
+                tokens.append((LIT, None))
+            else:
+                tokens.append((IDENT, word))
+            i = m.end()
+        else:
+            raise TemplateError(f"Unexpected {c!r} in action")
+
+
+def _lex(text: str) -> list[tuple]:
+    """Split a template into ("text", str) and ("action", tokens) items"""
+    items: list[list] = []
+    pos = 0
+    while True:
+        start = text.find("{{", pos)
+        if start < 0:
+            items.append(["text", text[pos:]])
+            break
+        items.append(["text", text[pos:start]])
+        i = start + 2
+        trim_left = text.startswith("-", i) and text[i + 1 : i + 2] in tuple(
+            _WHITESPACE
+        )
+        if trim_left:
+            i += 2
+        j = i
+        while j < len(text) and text[j] in _WHITESPACE:
+            j += 1
+        if text.startswith("/*", j):
+            end = text.find("*/", j)
+            if end < 0:
+                raise TemplateError("Unclosed comment")
+            tokens, pos, trim_right = _lex_action(text, end + 2)
+            if tokens:
+                raise TemplateError("Comment ends before closing delimiter")
+            items.append(["comment", None, trim_left, trim_right])
+        else:
+            tokens, pos, trim_right = _lex_action(text, i)
+            items.append(["action", tokens, trim_left, trim_right])
+
+    for n, item in enumerate(items):
+        if item[0] == "text":
+            continue
+        if item[2]:
+            items[n - 1][1] = items[n - 1][1].rstrip(_WHITESPACE)
+        if item[3]:
+            items[n + 1][1] = items[n + 1][1].lstrip(_WHITESPACE)
+    return [tuple(item[:2]) for item in items if item[0] != "comment"]
+
+
+# Parser
+#
+# Nodes are tuples:
+#   ("text", str)
+#   ("output", pipeline)
+#   ("if", [(pipeline, nodes), ...], else_nodes)
+#   ("with", [(pipeline, nodes), ...], else_nodes)
+#   ("range", pipeline, nodes, else_nodes)
+#   ("template", name, pipeline | None)
+# A pipeline is (declared variables, is assignment, commands) and a command is
+# a list of arguments:
+#   ("lit", value), ("dot",), ("field", None, names), ("var", name, names),
+#   ("ident", name), ("pipe", pipeline, names)
+
+
+class _Parser:
+    def __init__(self, items: list[tuple], templates: dict[str, list]):
+        self.items = items
+        self.pos = 0
+        # Named templates from define and block
+        self.templates = templates
+
+    def parse(self, stop: tuple[str, ...] = ()) -> tuple[list, list[Token] | None]:
+        """Parse nodes until an action starting with a word in stop"""
+        nodes: list = []
+        while self.pos < len(self.items):
+            kind, value = self.items[self.pos]
+            self.pos += 1
+            if kind == "text":
+                if value:
+                    nodes.append(("text", value))
+                continue
+
+            tokens = value
+            word = tokens[0][1] if tokens and tokens[0][0] == IDENT else None
+            if word in stop:
+                return nodes, tokens
+            if word in ("end", "else"):
+                raise TemplateError(f"Unexpected {{{{{word}}}}}")
+            if word in ("if", "with"):
+                nodes.append(self._parse_conditional(word, tokens[1:]))
+            elif word == "range":
+                body, end = self.parse(("end", "else"))
+                other: list = []
+                if end and end[0][1] == "else":
+                    other, _ = self._expect_end(self.parse(("end",)))
+                else:
+                    self._expect_end((body, end))
+                nodes.append(("range", _parse_pipeline(tokens[1:]), body, other))
+            elif word in ("define", "block"):
+                if len(tokens) < 2 or tokens[1][0] != LIT:
+                    raise TemplateError(f"{word} requires a template name")
+                name = tokens[1][1]
+                body, _ = self._expect_end(self.parse(("end",)))
+                self.templates[name] = body
+                if word == "block":
+                    nodes.append(("template", name, _parse_pipeline(tokens[2:])))
+            elif word == "template":
+                if len(tokens) < 2 or tokens[1][0] != LIT:
+                    raise TemplateError("template requires a template name")
+                pipeline = _parse_pipeline(tokens[2:]) if len(tokens) > 2 else None
+                nodes.append(("template", tokens[1][1], pipeline))
+            elif word in ("break", "continue"):
+                raise TemplateUnsupported(f"{word} isn't supported")
+            else:
+                nodes.append(("output", _parse_pipeline(tokens)))
+        if stop:
+            raise TemplateError("Unexpected end of template, missing {{end}}")
+        return nodes, None
+
+    def _expect_end(self, parsed: tuple[list, list[Token] | None]) -> tuple:
+        nodes, end = parsed
+        if not end or end[0][1] != "end" or len(end) > 1:
+            raise TemplateError("Expected {{end}}")
+        return nodes, end
+
+    def _parse_conditional(self, word: str, tokens: list[Token]) -> tuple:
+        branches = []
+        other: list = []
+        while True:
+            body, end = self.parse(("end", "else"))
+            branches.append((_parse_pipeline(tokens), body))
+            assert end
+            if end[0][1] == "end":
+                break
+            if len(end) > 1 and end[1] == (IDENT, word):
+                # else if / else with
+                tokens = end[2:]
+                continue
+            other, _ = self._expect_end(self.parse(("end",)))
+            break
+        return (word, branches, other)
+
+
+def _split(tokens: list[Token], separator: Token) -> list[list[Token]]:
+    """Split tokens on a separator that isn't inside parentheses"""
+    parts: list[list[Token]] = [[]]
+    depth = 0
+    for token in tokens:
+        if token == (OP, "("):
+            depth += 1
+        elif token == (OP, ")"):
+            depth -= 1
+        if token == separator and depth == 0:
+            parts.append([])
+        else:
+            parts[-1].append(token)
+    return parts
+
+
+def _parse_pipeline(tokens: list[Token]) -> tuple:
+    declared: list[str] = []
+    assign = False
+    for n in (1, 3):
+        if (
+            len(tokens) > n
+            and tokens[n] in ((OP, ":="), (OP, "="))
+            and all(t[0] == VAR and not t[2] for t in tokens[0:n:2])
+        ):
+            declared = [t[1] for t in tokens[0:n:2]]
+            assign = tokens[n] == (OP, "=")
+            tokens = tokens[n + 1 :]
+            break
+    commands = [_parse_command(c) for c in _split(tokens, (OP, "|"))]
+    if any(not c for c in commands):
+        raise TemplateError("Missing command in pipeline")
+    return (declared, assign, commands)
+
+
+def _parse_command(tokens: list[Token]) -> list:
+    args: list = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == (OP, "("):
+            depth = 1
+            j = i + 1
+            while j < len(tokens) and depth:
+                if tokens[j] == (OP, "("):
+                    depth += 1
+                elif tokens[j] == (OP, ")"):
+                    depth -= 1
+                j += 1
+            if depth:
+                raise TemplateError("Unclosed left paren")
+            inner = tokens[i + 1 : j - 1]
+            chain: list[str] = []
+            if j < len(tokens) and tokens[j][0] == CHAIN:
+                chain = tokens[j][1]
+                j += 1
+            args.append(("pipe", _parse_pipeline(inner), chain))
+            i = j
+            continue
+        if token[0] == FIELD:
+            args.append((FIELD, None, token[1]))
+        elif token[0] in (LIT, DOT, VAR, IDENT):
+            args.append(token)
+        else:
+            raise TemplateError(f"Unexpected {token[1]!r} in command")
+        i += 1
+    return args
+
+
+# Values
+
+
+def go_truth(value: Any) -> bool:
+    if value is None:
+        return False
+    if isinstance(value, (bool, int, float, str, list, tuple, dict)):
+        return bool(value)
+    return True
+
+
+def go_float(value: float) -> str:
+    """Format a float like Go's %v"""
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == 0:
+        return "0"
+    sign, digits, exponent = Decimal(repr(value)).normalize().as_tuple()
+    assert isinstance(exponent, int)
+    mantissa = "".join(map(str, digits))
+    # Position of the decimal point relative to the start of the digits
+    point = len(mantissa) + exponent
+    prefix = "-" if sign else ""
+    # Go uses exponent form if the exponent is < -4 or >= 6 for shortest precision
+    if point - 1 < -4 or point - 1 >= 6:
+        e = point - 1
+        frac = mantissa[1:]
+        return (
+            f"{prefix}{mantissa[0]}{'.' + frac if frac else ''}"
+            f"e{'-' if e < 0 else '+'}{abs(e):02d}"
+        )
+    if point <= 0:
+        return f"{prefix}0.{'0' * -point}{mantissa}"
+    if point >= len(mantissa):
+        return f"{prefix}{mantissa}{'0' * (point - len(mantissa))}"
+    return f"{prefix}{mantissa[:point]}.{mantissa[point:]}"
+
+
+def go_str(value: Any) -> str:
+    """Format a value like Go's %v"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float):
+        return go_float(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + " ".join(go_str(v) for v in value) + "]"
+    if isinstance(value, dict):
+        items = " ".join(f"{k}:{go_str(value[k])}" for k in sorted(value))
+        return f"map[{items}]"
+    return str(value)
+
+
+def go_quote(value: str) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _plain(value: Any) -> Any:
+    """Values as Go would serialise them, i.e. integral floats as integers"""
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e21:
+        return int(value)
+    if isinstance(value, dict):
+        return {str(k): _plain(v) for (k, v) in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def helm_values(value: Any) -> Any:
+    """Values as Helm sees them after converting from JSON, i.e. numbers are floats"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, dict):
+        return {str(k): helm_values(v) for (k, v) in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [helm_values(v) for v in value]
+    return value
+
+
+def coalesce_values(defaults: YamlT, overrides: YamlT) -> YamlT:
+    """Merge overrides into chart defaults, a None override deletes the default"""
+    merged = deepcopy(defaults)
+    for key, value in overrides.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = coalesce_values(merged[key], value)
+        else:
+            merged[key] = deepcopy(value)
+    return merged
+
+
+# Functions
+
+
+def _number(value: Any) -> float | int:
+    if isinstance(value, (int, float)):
+        return value
+    if value is None or value == "":
+        return 0
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0
+
+
+def _to_int(value: Any) -> int:
+    return int(_number(value))
+
+
+def _to_yaml(value: Any) -> str:
+    if value is None:
+        return "null"
+    out = yaml.safe_dump(_plain(value), default_flow_style=False, allow_unicode=True)
+    return out.removesuffix("\n...\n").removesuffix("\n")
+
+
+def _to_json(value: Any) -> str:
+    return json.dumps(_plain(value), sort_keys=True, separators=(",", ":"))
+
+
+def _printf(fmt: str, *args: Any) -> str:
+    remaining = list(args)
+
+    def verb(m: re.Match) -> str:
+        flags, width, precision, v = m.groups()
+        if v == "%":
+            return "%"
+        if not remaining:
+            return f"%!{v}(MISSING)"
+        arg = remaining.pop(0)
+        if v in "sv":
+            s = go_str(arg) if arg is not None or v == "s" else "<nil>"
+        elif v == "q":
+            s = go_quote(go_str(arg))
+        elif v == "t":
+            s = go_str(bool(arg))
+        elif v in "dxXobfFeEgG":
+            spec = f"%{flags}{width or ''}{'.' + precision if precision else ''}{v}"
+            if v in "dxXob":
+                if v == "b":
+                    return _binary(_to_int(arg), flags, width)
+                if isinstance(arg, str) and v in "xX":
+                    s = arg.encode().hex()
+                    return s.upper() if v == "X" else s
+                return spec % _to_int(arg)
+            return spec.replace("F", "f") % float(_number(arg))
+        else:
+            return f"%!{v}({go_str(arg)})"
+        if precision:
+            s = s[: int(precision)]
+        if width:
+            s = s.ljust(int(width)) if "-" in flags else s.rjust(int(width))
+        return s
+
+    return re.sub(r"%([-+# 0]*)(\d+)?(?:\.(\d+))?([a-zA-Z%])", verb, fmt)
+
+
+def _binary(value: int, flags: str, width: str | None) -> str:
+    s = format(value, "b")
+    if width:
+        fill = "0" if "0" in flags else " "
+        s = s.ljust(int(width)) if "-" in flags else s.rjust(int(width), fill)
+    return s
+
+
+def _print(*args: Any) -> str:
+    # Go's fmt.Sprint adds spaces between operands when neither is a string
+    out = ""
+    for n, arg in enumerate(args):
+        if n and not isinstance(arg, str) and not isinstance(args[n - 1], str):
+            out += " "
+        out += go_str(arg)
+    return out
+
+
+def _compare(name: str, op: Callable[[Any, Any], bool]) -> Callable:
+    def compare(a: Any, b: Any) -> bool:
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+            return op(a, b)
+        if isinstance(a, str) and isinstance(b, str):
+            return op(a, b)
+        raise TemplateError(f"{name}: incompatible types for comparison")
+
+    return compare
+
+
+def _eq(a: Any, *others: Any) -> bool:
+    return any(a == b for b in others)
+
+
+def _and(*args: Any) -> Any:
+    for arg in args:
+        if not go_truth(arg):
+            return arg
+    return args[-1]
+
+
+def _or(*args: Any) -> Any:
+    for arg in args:
+        if go_truth(arg):
+            return arg
+    return args[-1]
+
+
+def _index(collection: Any, *keys: Any) -> Any:
+    for key in keys:
+        if collection is None:
+            return None
+        if isinstance(collection, dict):
+            collection = collection.get(key)
+        else:
+            try:
+                collection = collection[_to_int(key)]
+            except (IndexError, TypeError) as e:
+                raise TemplateError(f"index: {e}")
+    return collection
+
+
+def _default(default: Any, *given: Any) -> Any:
+    if given and go_truth(given[0]):
+        return given[0]
+    return default
+
+
+def _required(message: str, value: Any) -> Any:
+    if value is None or value == "":
+        raise TemplateError(message)
+    return value
+
+
+def _fail(message: str) -> None:
+    raise TemplateError(message)
+
+
+def _dict(*args: Any) -> dict:
+    return {
+        go_str(args[i]): args[i + 1] if i + 1 < len(args) else ""
+        for i in range(0, len(args), 2)
+    }
+
+
+def _set(d: dict, key: str, value: Any) -> dict:
+    d[key] = value
+    return d
+
+
+def _unset(d: dict, key: str) -> dict:
+    d.pop(key, None)
+    return d
+
+
+def _merge(dst: dict, *sources: dict, overwrite: bool = False) -> dict:
+    for src in sources:
+        for key, value in src.items():
+            if isinstance(value, dict) and isinstance(dst.get(key), dict):
+                _merge(dst[key], value, overwrite=overwrite)
+            elif overwrite or key not in dst:
+                dst[key] = deepcopy(value)
+    return dst
+
+
+def _trunc(length: int, s: str) -> str:
+    length = _to_int(length)
+    if length < 0:
+        return s[length:] if len(s) + length > 0 else s
+    return s[:length]
+
+
+def _indent(n: int, s: str) -> str:
+    pad = " " * _to_int(n)
+    return pad + go_str(s).replace("\n", "\n" + pad)
+
+
+def _product(args: Iterable[Any]) -> int:
+    result = 1
+    for a in args:
+        result *= _to_int(a)
+    return result
+
+
+def _regex_replace_all(regex: str, s: str, replacement: str) -> str:
+    # Go uses $1 or ${1} for groups
+    replacement = re.sub(r"\$\{?(\d+)\}?", r"\\g<\1>", replacement)
+    return re.sub(regex, replacement, s)
+
+
+def _first(items: Any) -> Any:
+    if items is None:
+        return None
+    if not isinstance(items, (list, tuple)):
+        raise TemplateError(f"first: can't find first on type {type(items).__name__}")
+    return items[0] if items else None
+
+
+# Semantic versions as parsed by github.com/Masterminds/semver/v3, which
+# Sprig's semverCompare uses. Constraint versions may use wildcards.
+_SEMVER = (
+    r"v?([0-9]+|[xX*])(\.(?:[0-9]+|[xX*]))?(\.(?:[0-9]+|[xX*]))?"
+    r"(?:-([0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?"
+    r"(?:\+[0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*)?"
+)
+_SEMVER_RANGE = re.compile(rf"\s*({_SEMVER})\s+-\s+({_SEMVER})\s*")
+_SEMVER_CONSTRAINT = re.compile(
+    rf"(=>|=<|!=|>=|<=|~>|[=><~^]?)\s*({_SEMVER})(?=$|[\s,])"
+)
+
+
+class _Semver:
+    def __init__(self, text: str, constraint: bool = False):
+        m = re.fullmatch(_SEMVER, text.strip())
+        if not m or (not constraint and not (m[1].isdigit())):
+            raise TemplateError(f"invalid semantic version {text!r}")
+        parts = [m[1], (m[2] or "")[1:], (m[3] or "")[1:]]
+        wild = [not p.isdigit() for p in parts]
+        if not constraint and any(w and p for (w, p) in zip(wild, parts)):
+            raise TemplateError(f"invalid semantic version {text!r}")
+        # The first missing or wildcard part, 0-2, or 3 if none
+        self.dirty = wild.index(True) if any(wild) else 3
+        self.parts = tuple(int(p) if p.isdigit() else 0 for p in parts)
+        self.prerelease = m[4] or ""
+        self.major, self.minor, self.patch = self.parts
+
+    def _pre_key(self) -> tuple:
+        if not self.prerelease:
+            # A release sorts after its prereleases
+            return (1,)
+        return (
+            0,
+            *(
+                (0, int(p), "") if p.isdigit() else (1, 0, p)
+                for p in self.prerelease.split(".")
+            ),
+        )
+
+    def compare(self, other: "_Semver") -> int:
+        a = (self.parts, self._pre_key())
+        b = (other.parts, other._pre_key())
+        return (a > b) - (a < b)
+
+
+def _semver_tilde(v: _Semver, c: _Semver) -> bool:
+    if v.compare(c) < 0:
+        return False
+    if c.dirty == 0:
+        return True
+    if v.major != c.major:
+        return False
+    return c.dirty == 1 or v.minor == c.minor
+
+
+def _semver_caret(v: _Semver, c: _Semver) -> bool:
+    if v.compare(c) < 0:
+        return False
+    if c.major > 0 or c.dirty <= 1:
+        return c.dirty == 0 or v.major == c.major
+    if c.minor > 0 or c.dirty == 2:
+        return v.major == 0 and v.minor == c.minor
+    return v.major == 0 and v.minor == 0 and v.patch == c.patch
+
+
+def _semver_greater(v: _Semver, c: _Semver) -> bool:
+    if c.dirty == 3:
+        return v.compare(c) > 0
+    if v.major != c.major:
+        return v.major > c.major
+    if c.dirty <= 1:
+        return False
+    return v.minor > c.minor
+
+
+def _semver_less_equal(v: _Semver, c: _Semver) -> bool:
+    if c.dirty == 3:
+        return v.compare(c) <= 0
+    if v.major != c.major:
+        return v.major < c.major
+    return c.dirty <= 1 or v.minor <= c.minor
+
+
+_SEMVER_OPS: dict[str, Callable[[_Semver, _Semver], bool]] = {
+    "": lambda v, c: _semver_tilde(v, c) if c.dirty < 3 else v.compare(c) == 0,
+    "=": lambda v, c: _semver_tilde(v, c) if c.dirty < 3 else v.compare(c) == 0,
+    "!=": lambda v, c: not (_semver_tilde(v, c) if c.dirty < 3 else v.compare(c) == 0),
+    ">": _semver_greater,
+    "<": lambda v, c: v.compare(c) < 0,
+    ">=": lambda v, c: v.compare(c) >= 0,
+    "=>": lambda v, c: v.compare(c) >= 0,
+    "<=": _semver_less_equal,
+    "=<": _semver_less_equal,
+    "~": _semver_tilde,
+    "~>": _semver_tilde,
+    "^": _semver_caret,
+}
+
+
+def _semver_compare(constraint: str, version: Any) -> bool:
+    v = _Semver(go_str(version))
+    for alternative in constraint.split("||"):
+        alternative = _SEMVER_RANGE.sub(r" >= \1, <= \6 ", alternative)
+        matches = list(_SEMVER_CONSTRAINT.finditer(alternative))
+        rest = _SEMVER_CONSTRAINT.sub("", alternative)
+        if not matches or rest.strip(" ,\t"):
+            raise TemplateError(f"improper constraint: {constraint}")
+        constraints = [(m[1], _Semver(m[2], constraint=True)) for m in matches]
+        # Prereleases only match if a constraint in the group has a prerelease
+        if v.prerelease and not any(c.prerelease for (_, c) in constraints):
+            continue
+        if all(_SEMVER_OPS[op](v, c) for (op, c) in constraints):
+            return True
+    return False
+
+
+FUNCTIONS: dict[str, Callable[..., Any]] = {
+    # Go text/template
+    "and": _and,
+    "or": _or,
+    "not": lambda value: not go_truth(value),
+    "eq": _eq,
+    "ne": lambda a, b: a != b,
+    "lt": _compare("lt", lambda a, b: a < b),
+    "le": _compare("le", lambda a, b: a <= b),
+    "gt": _compare("gt", lambda a, b: a > b),
+    "ge": _compare("ge", lambda a, b: a >= b),
+    "len": lambda value: len(value) if value is not None else 0,
+    "index": _index,
+    "print": _print,
+    "printf": _printf,
+    "println": lambda *args: " ".join(go_str(a) for a in args) + "\n",
+    # Sprig
+    "default": _default,
+    "empty": lambda value: not go_truth(value),
+    "coalesce": lambda *args: next((a for a in args if go_truth(a)), None),
+    "ternary": lambda true, false, condition: true if go_truth(condition) else false,
+    "required": _required,
+    "fail": _fail,
+    "toYaml": _to_yaml,
+    "toJson": _to_json,
+    "toPrettyJson": lambda v: json.dumps(_plain(v), sort_keys=True, indent=2),
+    "toString": go_str,
+    "quote": lambda *args: " ".join(go_quote(go_str(a)) for a in args if a is not None),
+    "squote": lambda *args: " ".join(f"'{go_str(a)}'" for a in args if a is not None),
+    "indent": _indent,
+    "nindent": lambda n, s: "\n" + _indent(n, s),
+    "trim": lambda s: go_str(s).strip(_WHITESPACE),
+    "trimAll": lambda cutset, s: go_str(s).strip(cutset),
+    "trimPrefix": lambda prefix, s: go_str(s).removeprefix(prefix),
+    "trimSuffix": lambda suffix, s: go_str(s).removesuffix(suffix),
+    "upper": lambda s: go_str(s).upper(),
+    "lower": lambda s: go_str(s).lower(),
+    "title": lambda s: go_str(s).title(),
+    "trunc": lambda n, s: _trunc(n, go_str(s)),
+    "replace": lambda old, new, s: go_str(s).replace(old, new),
+    "contains": lambda sub, s: sub in go_str(s),
+    "hasPrefix": lambda prefix, s: go_str(s).startswith(prefix),
+    "hasSuffix": lambda suffix, s: go_str(s).endswith(suffix),
+    "repeat": lambda n, s: go_str(s) * _to_int(n),
+    "cat": lambda *args: " ".join(go_str(a) for a in args if a is not None),
+    "join": lambda sep, items: sep.join(go_str(i) for i in items or []),
+    "splitList": lambda sep, s: go_str(s).split(sep),
+    "regexMatch": lambda regex, s: re.search(regex, go_str(s)) is not None,
+    "regexReplaceAll": lambda regex, s, repl: _regex_replace_all(
+        regex, go_str(s), repl
+    ),
+    "list": lambda *args: list(args),
+    "first": _first,
+    "dict": _dict,
+    "get": lambda d, key: d.get(key, ""),
+    "set": _set,
+    "unset": _unset,
+    "hasKey": lambda d, key: key in (d or {}),
+    "keys": lambda *ds: [k for d in ds for k in d],
+    "merge": lambda dst, *srcs: _merge(dst, *srcs),
+    "mergeOverwrite": lambda dst, *srcs: _merge(dst, *srcs, overwrite=True),
+    "int": _to_int,
+    "int64": _to_int,
+    "atoi": _to_int,
+    "float64": lambda v: float(_number(v)),
+    "add": lambda *args: sum(_to_int(a) for a in args),
+    "add1": lambda a: _to_int(a) + 1,
+    "sub": lambda a, b: _to_int(a) - _to_int(b),
+    "mul": lambda *args: _product(args),
+    "div": lambda a, b: int(_to_int(a) / _to_int(b)),
+    "mod": lambda a, b: _to_int(a) % _to_int(b),
+    "max": lambda *args: max(_to_int(a) for a in args),
+    "min": lambda *args: min(_to_int(a) for a in args),
+    "b64enc": lambda s: base64.b64encode(go_str(s).encode()).decode(),
+    "b64dec": lambda s: base64.b64decode(go_str(s)).decode(),
+    "sha256sum": lambda s: hashlib.sha256(go_str(s).encode()).hexdigest(),
+    "semverCompare": _semver_compare,
+    # Helm
+    "lookup": lambda *args: {},
+}
+
+# Functions and the Helm functions that are implemented by Templates
+BUILTINS = {*FUNCTIONS, "include", "tpl"}
+
+
+# Execution
+
+
+class _Scope:
+    """Template variables, innermost last"""
+
+    def __init__(self, root: Any):
+        self.frames: list[dict[str, Any]] = [{"$": root}]
+
+    def push(self, variables: dict[str, Any] | None = None) -> None:
+        self.frames.append(dict(variables or {}))
+
+    def pop(self) -> None:
+        self.frames.pop()
+
+    def get(self, name: str) -> Any:
+        for frame in reversed(self.frames):
+            if name in frame:
+                return frame[name]
+        raise TemplateError(f"Undefined variable {name}")
+
+    def set(self, name: str, value: Any) -> None:
+        for frame in reversed(self.frames):
+            if name in frame:
+                frame[name] = value
+                return
+        raise TemplateError(f"Undefined variable {name}")
+
+    def declare(self, name: str, value: Any) -> None:
+        self.frames[-1][name] = value
+
+
+class Templates:
+    """A set of parsed templates that can include each other"""
+
+    # Maximum depth of nested template calls
+    MAX_DEPTH = 1000
+
+    def __init__(self) -> None:
+        self.files: dict[str, list] = {}
+        self.defined: dict[str, list] = {}
+        # Templates may be rendered in several threads at once
+        self._local = threading.local()
+
+    def parse(self, name: str, text: str) -> None:
+        try:
+            nodes, defined = self._parse(text)
+        except TemplateError as e:
+            raise type(e)(f"parse error in {name}: {e}") from None
+        self.files[name] = nodes
+        self.defined.update(defined)
+
+    def _parse(self, text: str) -> tuple[list, dict[str, list]]:
+        defined: dict[str, list] = {}
+        nodes, _ = _Parser(_lex(text), defined).parse()
+        # Like Go, functions must be defined when a template is parsed
+        for body in (nodes, *defined.values()):
+            _check_functions(body)
+        return nodes, defined
+
+    def execute(self, name: str, data: Any) -> str:
+        try:
+            return self._execute(self.files[name], data)
+        except TemplateError as e:
+            raise type(e)(f"error rendering {name}: {e}") from None
+        except (
+            TypeError,
+            ValueError,
+            AttributeError,
+            KeyError,
+            ZeroDivisionError,
+        ) as e:
+            raise TemplateError(
+                f"error rendering {name}: {type(e).__name__}: {e}"
+            ) from None
+
+    def include(self, name: str, data: Any) -> str:
+        if name not in self.defined:
+            raise TemplateError(f'no template "{name}" associated with template')
+        return self._execute(self.defined[name], data)
+
+    def tpl(self, text: str, data: Any) -> str:
+        nodes, defined = self._parse(text)
+        self.defined.update(defined)
+        return self._execute(nodes, data)
+
+    def _execute(self, nodes: list, data: Any) -> str:
+        depth = getattr(self._local, "depth", 0) + 1
+        self._local.depth = depth
+        try:
+            if depth > self.MAX_DEPTH:
+                raise TemplateError("Exceeded maximum template depth")
+            out: list[str] = []
+            self._walk(nodes, data, _Scope(data), out)
+            return "".join(out)
+        finally:
+            self._local.depth = depth - 1
+
+    def _walk(self, nodes: list, dot: Any, scope: _Scope, out: list[str]) -> None:
+        for node in nodes:
+            kind = node[0]
+            if kind == "text":
+                out.append(node[1])
+            elif kind == "output":
+                declared = node[1][0]
+                value = self._pipeline(node[1], dot, scope)
+                if not declared:
+                    out.append(go_str(value))
+            elif kind in ("if", "with"):
+                for pipeline, body in node[1]:
+                    scope.push()
+                    try:
+                        value = self._pipeline(pipeline, dot, scope)
+                        if go_truth(value):
+                            self._walk(
+                                body, value if kind == "with" else dot, scope, out
+                            )
+                            break
+                    finally:
+                        scope.pop()
+                else:
+                    self._walk_scoped(node[2], dot, scope, out)
+            elif kind == "range":
+                self._range(node, dot, scope, out)
+            elif kind == "template":
+                _, name, pipeline = node
+                value = self._pipeline(pipeline, dot, scope) if pipeline else None
+                out.append(self.include(name, value))
+
+    def _walk_scoped(
+        self, nodes: list, dot: Any, scope: _Scope, out: list[str]
+    ) -> None:
+        scope.push()
+        try:
+            self._walk(nodes, dot, scope, out)
+        finally:
+            scope.pop()
+
+    def _range(self, node: tuple, dot: Any, scope: _Scope, out: list[str]) -> None:
+        _, pipeline, body, other = node
+        declared, _, commands = pipeline
+        collection = self._pipeline(([], False, commands), dot, scope)
+        if isinstance(collection, dict):
+            items: Iterable = ((k, collection[k]) for k in sorted(collection))
+        elif isinstance(collection, (list, tuple, str)):
+            items = enumerate(collection)
+        elif isinstance(collection, int) and not isinstance(collection, bool):
+            items = ((i, i) for i in range(collection))
+        elif collection is None:
+            items = ()
+        else:
+            raise TemplateError(f"range can't iterate over {go_str(collection)}")
+
+        empty = True
+        for key, value in items:
+            empty = False
+            variables = {}
+            if len(declared) == 1:
+                variables[declared[0]] = value
+            elif len(declared) == 2:
+                variables[declared[0]] = key
+                variables[declared[1]] = value
+            scope.push(variables)
+            try:
+                self._walk(body, value, scope, out)
+            finally:
+                scope.pop()
+        if empty:
+            self._walk_scoped(other, dot, scope, out)
+
+    def _pipeline(self, pipeline: tuple, dot: Any, scope: _Scope) -> Any:
+        declared, assign, commands = pipeline
+        value: Any = None
+        for n, command in enumerate(commands):
+            final = (value,) if n else ()
+            value = self._command(command, dot, scope, final)
+        for name in declared:
+            if assign:
+                scope.set(name, value)
+            else:
+                scope.declare(name, value)
+        return value
+
+    def _command(self, command: list, dot: Any, scope: _Scope, final: tuple) -> Any:
+        first = command[0]
+        if first[0] == IDENT:
+            name = first[1]
+            args = [self._arg(a, dot, scope) for a in command[1:]]
+            args.extend(final)
+            if name == "include":
+                return self.include(*args)
+            if name == "tpl":
+                return self.tpl(*args)
+            return FUNCTIONS[name](*args)
+
+        value = self._arg(first, dot, scope)
+        if len(command) > 1 or final:
+            if not callable(value):
+                raise TemplateError(f"can't give argument to non-function {first}")
+            args = [self._arg(a, dot, scope) for a in command[1:]]
+            return value(*args, *final)
+        if callable(value):
+            return value()
+        return value
+
+    def _arg(self, arg: tuple, dot: Any, scope: _Scope) -> Any:
+        kind = arg[0]
+        if kind == LIT:
+            return arg[1]
+        if kind == DOT:
+            return dot
+        if kind == FIELD:
+            return _fields(dot, arg[2])
+        if kind == VAR:
+            return _fields(scope.get(arg[1]), arg[2])
+        if kind == "pipe":
+            return _fields(self._pipeline(arg[1], dot, scope), arg[2])
+        if kind == IDENT:
+            return self._command([arg], dot, scope, ())
+        raise TemplateError(f"Unexpected argument {arg}")
+
+
+def _pipelines(nodes: list) -> Iterable[tuple]:
+    """Pipelines in parsed nodes, including nested blocks"""
+    for node in nodes:
+        kind = node[0]
+        if kind == "output":
+            yield node[1]
+        elif kind in ("if", "with"):
+            for pipeline, body in node[1]:
+                yield pipeline
+                yield from _pipelines(body)
+            yield from _pipelines(node[2])
+        elif kind == "range":
+            yield node[1]
+            yield from _pipelines(node[2])
+            yield from _pipelines(node[3])
+        elif kind == "template" and node[2]:
+            yield node[2]
+
+
+def _check_functions(nodes: list) -> None:
+    pipelines = list(_pipelines(nodes))
+    while pipelines:
+        for command in pipelines.pop()[2]:
+            for arg in command:
+                if arg[0] == IDENT and arg[1] not in BUILTINS:
+                    raise TemplateUnsupported(f'function "{arg[1]}" not defined')
+                if arg[0] == "pipe":
+                    pipelines.append(arg[1])
+
+
+def _fields(value: Any, names: list[str]) -> Any:
+    for n, name in enumerate(names):
+        if value is None:
+            # Go can't evaluate a field of a nil interface, e.g. a missing value
+            raise TemplateError(f"nil pointer evaluating interface {{}}.{name}")
+        if isinstance(value, dict):
+            value = value.get(name)
+        elif isinstance(value, _Object) and hasattr(value, name):
+            value = getattr(value, name)
+            # Methods without arguments are called, except the last
+            if callable(value) and n < len(names) - 1:
+                value = value()
+        else:
+            raise TemplateError(f"can't evaluate field {name} in {go_str(value)}")
+    return value
+
+
+# Charts
+
+# https://github.com/helm/helm/blob/v3.17.3/pkg/releaseutil/kind_sorter.go
+INSTALL_ORDER = [
+    "PriorityClass",
+    "Namespace",
+    "NetworkPolicy",
+    "ResourceQuota",
+    "LimitRange",
+    "PodSecurityPolicy",
+    "PodDisruptionBudget",
+    "ServiceAccount",
+    "Secret",
+    "SecretList",
+    "ConfigMap",
+    "StorageClass",
+    "PersistentVolume",
+    "PersistentVolumeClaim",
+    "CustomResourceDefinition",
+    "ClusterRole",
+    "ClusterRoleList",
+    "ClusterRoleBinding",
+    "ClusterRoleBindingList",
+    "Role",
+    "RoleList",
+    "RoleBinding",
+    "RoleBindingList",
+    "Service",
+    "DaemonSet",
+    "Pod",
+    "ReplicationController",
+    "ReplicaSet",
+    "Deployment",
+    "HorizontalPodAutoscaler",
+    "StatefulSet",
+    "Job",
+    "CronJob",
+    "IngressClass",
+    "Ingress",
+    "APIService",
+    "MutatingWebhookConfiguration",
+    "ValidatingWebhookConfiguration",
+]
+
+# .Capabilities.KubeVersion and .HelmVersion of `helm template` v3.17.3, whose
+# release builds set the Kubernetes version to that of client-go
+KUBE_VERSION = ("1", "32")
+HELM_VERSION = "v3.17.3"
+
+# API versions reported by .Capabilities.APIVersions.Has
+API_VERSIONS = {
+    "v1",
+    "apps/v1",
+    "batch/v1",
+    "networking.k8s.io/v1",
+    "policy/v1",
+    "rbac.authorization.k8s.io/v1",
+    "storage.k8s.io/v1",
+    "autoscaling/v2",
+}
+
+
+def install_order(kind: str) -> tuple[int, str]:
+    try:
+        return INSTALL_ORDER.index(kind), ""
+    except ValueError:
+        return len(INSTALL_ORDER), kind
+
+
+class _Object:
+    """Built-in objects whose methods can be called from templates"""
+
+
+class _Files(_Object):
+    def __init__(self, path: Path):
+        self._path = path
+
+    def Get(self, name: str) -> str:
+        f = self._path / name
+        if not f.resolve().is_relative_to(self._path.resolve()) or not f.is_file():
+            return ""
+        return f.read_text()
+
+
+class _APIVersions(_Object):
+    def Has(self, version: str) -> bool:
+        return version in API_VERSIONS or version.rsplit("/", 1)[0] in API_VERSIONS
+
+
+class _KubeVersion(_Object):
+    def __init__(self, major: str, minor: str):
+        self.Major = major
+        self.Minor = minor
+        self.Version = f"v{major}.{minor}.0"
+        # A deprecated method in Helm, an attribute so it can be an argument
+        self.GitVersion = self.Version
+
+    def __str__(self) -> str:
+        return self.Version
+
+
+def _chart_metadata(metadata: dict) -> dict:
+    # Chart.yaml fields are exposed with Go struct names, e.g. appVersion is .Chart.AppVersion
+    special = {"apiVersion": "APIVersion", "kubeVersion": "KubeVersion"}
+    return {special.get(k, k[:1].upper() + k[1:]): v for (k, v) in metadata.items()}
+
+
+class Chart:
+    """
+    A Helm chart parsed from a directory, rendered as `helm template` would.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        chart_yaml = self.path / "Chart.yaml"
+        if not chart_yaml.is_file():
+            raise TemplateError(f"{chart_yaml} not found")
+        self.metadata = yaml.load(chart_yaml.read_text(), Loader=SafeLoader) or {}
+        self.name = self.metadata.get("name", self.path.name)
+        if (self.path / "charts").is_dir() and any((self.path / "charts").iterdir()):
+            raise TemplateUnsupported(f"{self.name}: subcharts aren't supported")
+        if self.metadata.get("dependencies"):
+            raise TemplateUnsupported(
+                f"{self.name}: chart dependencies aren't supported"
+            )
+
+        values_yaml = self.path / "values.yaml"
+        values = (
+            yaml.load(values_yaml.read_text(), Loader=SafeLoader)
+            if values_yaml.is_file()
+            else None
+        )
+        self.values = helm_values(values or {})
+
+        self.templates = Templates()
+        template_dir = self.path / "templates"
+        files = (
+            sorted(p for p in template_dir.rglob("*") if p.is_file())
+            if template_dir.is_dir()
+            else []
+        )
+        self.outputs = []
+        for f in files:
+            name = f"{self.name}/{f.relative_to(self.path).as_posix()}"
+            self.templates.parse(name, f.read_text())
+            if not f.name.startswith("_") and f.name != "NOTES.txt":
+                self.outputs.append(name)
+
+    def render(
+        self,
+        values: dict[str, YamlT],
+        release_name: str = "release-name",
+        namespace: str = "default",
+    ) -> list[YamlT]:
+        """Manifests rendered with values overriding the chart values"""
+        data: dict[str, Any] = {
+            "Values": coalesce_values(self.values, helm_values(values)),
+            "Release": {
+                "Name": release_name,
+                "Namespace": namespace,
+                "Service": "Helm",
+                "IsInstall": True,
+                "IsUpgrade": False,
+                "Revision": 1,
+            },
+            "Chart": _chart_metadata(self.metadata),
+            "Capabilities": {
+                "APIVersions": _APIVersions(),
+                "KubeVersion": _KubeVersion(*KUBE_VERSION),
+                "HelmVersion": {"Version": HELM_VERSION},
+            },
+            "Files": _Files(self.path),
+        }
+        docs = []
+        for name in self.outputs:
+            data["Template"] = {
+                "Name": name,
+                "BasePath": f"{self.name}/templates",
+            }
+            text = self.templates.execute(name, data).replace("<no value>", "")
+            try:
+                for doc in yaml.load_all(text, Loader=SafeLoader):
+                    if doc:
+                        docs.append((install_order(doc.get("kind", "")), name, doc))
+            except yaml.YAMLError as e:
+                raise TemplateError(f"YAML parse error in {name}: {e}") from None
+        # Stable sort so documents in a file keep their order
+        docs.sort(key=lambda d: (d[0], d[1]))
+        return [doc for (_, _, doc) in docs]
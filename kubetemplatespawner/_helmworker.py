@@ -0,0 +1,311 @@
+# Persistent helm template workers
+#
+# Running `helm template` for each render pays for process startup and loading
+# the chart every time. A worker (see helm-worker/) loads a chart once and then
+# renders it for each request. Workers are started with the chart path as their
+# only argument, read newline-delimited JSON requests on stdin, and write one
+# JSON response per line on stdout:
+#
+#   {"id": 1, "op": "render", "values": {...}}  ->  {"id": 1, "yaml": "..."}
+#                                                   {"id": 1, "error": "..."}
+#   {"id": 2, "op": "ping"}                     ->  {"id": 2, "ok": true}
+#
+# Render requests ask for `"format": "json"`, and workers that support it return
+# the manifests as JSON objects in `"manifests"` instead of a YAML stream, which
+# avoids parsing YAML in the Hub.
+#
+# Workers are restarted if they exit or fail a health check, and replaced if any
+# file in the chart changes.
+
+import asyncio
+import json
+from collections import deque
+from itertools import count
+from typing import Any
+
+from tornado.log import app_log as log
+
+from ._kubernetes import YamlT
+from ._render import Renderer, RenderError, chart_digest, parse_manifests
+
+# Maximum size of a response line
+MAX_RESPONSE_SIZE = 64 * 1024 * 1024
+
+
+class WorkerError(RenderError):
+    """A worker exited, timed out, or couldn't be started"""
+
+
+class HelmWorker:
+    """A worker process rendering one chart"""
+
+    def __init__(self, command: list[str], path: str):
+        self.command = command
+        self.path = path
+        self.process: asyncio.subprocess.Process | None = None
+        self._ids = count()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._stderr: deque[str] = deque(maxlen=20)
+        self._readers: list[asyncio.Task] = []
+
+    def __repr__(self) -> str:
+        pid = self.process.pid if self.process else None
+        return f"HelmWorker({self.path} pid={pid})"
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def stderr(self) -> str:
+        """The last lines written to stderr"""
+        return "\n".join(self._stderr)
+
+    async def start(self) -> None:
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command,
+                self.path,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=MAX_RESPONSE_SIZE,
+            )
+        except OSError as e:
+            raise WorkerError(f"Failed to start helm worker {self.command}: {e}")
+        self._readers = [
+            asyncio.create_task(self._read_stdout()),
+            asyncio.create_task(self._read_stderr()),
+        ]
+        log.info(f"Started {self}")
+
+    async def _read_stdout(self) -> None:
+        assert self.process and self.process.stdout
+        try:
+            while line := await self.process.stdout.readline():
+                try:
+                    response = json.loads(line)
+                except ValueError:
+                    log.warning(f"{self} invalid response: {line[:200]!r}")
+                    continue
+                future = self._pending.pop(response.get("id"), None)
+                if future and not future.done():
+                    future.set_result(response)
+        except Exception:
+            log.exception(f"{self} failed to read response")
+        finally:
+            error = WorkerError(f"{self} exited: {self.stderr}")
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+
+    async def _read_stderr(self) -> None:
+        assert self.process and self.process.stderr
+        while line := await self.process.stderr.readline():
+            self._stderr.append(line.decode(errors="replace").rstrip())
+            log.debug(f"{self}: {self._stderr[-1]}")
+
+    async def request(self, body: dict[str, Any], timeout: float) -> dict[str, Any]:
+        if not self.alive:
+            raise WorkerError(f"{self} isn't running")
+        assert self.process and self.process.stdin
+        id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[id] = future
+        try:
+            line = json.dumps({"id": id, **body}, default=str)
+            self.process.stdin.write(line.encode() + b"\n")
+            await self.process.stdin.drain()
+            return await asyncio.wait_for(future, timeout)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise WorkerError(f"{self} exited: {e}")
+        except TimeoutError:
+            # It may be stuck, so don't send it any more requests
+            self.kill()
+            raise WorkerError(f"{self} didn't respond within {timeout}s")
+        finally:
+            self._pending.pop(id, None)
+
+    async def render(self, values: dict[str, YamlT], timeout: float) -> list[YamlT]:
+        response = await self.request(
+            {"op": "render", "format": "json", "values": values}, timeout
+        )
+        if "error" in response:
+            raise RenderError(f"Templating failed: {response['error']}")
+        if "manifests" in response:
+            return [doc for doc in response["manifests"] if doc]
+        return await parse_manifests(response["yaml"])
+
+    async def ping(self, timeout: float) -> bool:
+        try:
+            response = await self.request({"op": "ping"}, timeout)
+        except WorkerError as e:
+            log.warning(f"Health check failed: {e}")
+            return False
+        return bool(response.get("ok"))
+
+    def kill(self) -> None:
+        if self.alive:
+            assert self.process
+            self.process.kill()
+
+    async def stop(self, timeout: float = 5) -> None:
+        """Stop the worker after it has responded to pending requests"""
+        if self.alive:
+            assert self.process and self.process.stdin
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout)
+            except TimeoutError:
+                self.kill()
+        if self.process:
+            await self.process.wait()
+        await asyncio.gather(*self._readers, return_exceptions=True)
+        log.info(f"Stopped {self}")
+
+
+class HelmWorkerPool:
+    """
+    Workers for one version of a chart.
+
+    Requests go to the worker with the fewest pending requests. Workers that
+    have exited are restarted when they're next needed, and by the health check.
+    """
+
+    def __init__(
+        self,
+        command: list[str],
+        path: str,
+        digest: str,
+        size: int,
+        timeout: float,
+        health_check_interval: float,
+    ):
+        self.command = command
+        self.path = path
+        self.digest = digest
+        self.size = max(size, 1)
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.workers: list[HelmWorker] = []
+        self.restarts = 0
+        self._lock = asyncio.Lock()
+        self._health_check: asyncio.Task | None = None
+
+    def __repr__(self) -> str:
+        return f"HelmWorkerPool({self.path})"
+
+    async def _start_worker(self) -> HelmWorker:
+        worker = HelmWorker(self.command, self.path)
+        await worker.start()
+        # Waits for the chart to be loaded
+        if not await worker.ping(self.timeout):
+            await worker.stop()
+            raise WorkerError(f"{worker} failed to start: {worker.stderr}")
+        return worker
+
+    async def _ensure_workers(self) -> None:
+        async with self._lock:
+            for n, worker in enumerate(self.workers):
+                if not worker.alive:
+                    log.warning(f"{worker} has exited, restarting: {worker.stderr}")
+                    await worker.stop()
+                    self.workers[n] = await self._start_worker()
+                    self.restarts += 1
+            while len(self.workers) < self.size:
+                self.workers.append(await self._start_worker())
+        if self.health_check_interval > 0 and not self._health_check:
+            self._health_check = asyncio.create_task(self._check_health())
+
+    async def render(self, values: dict[str, YamlT]) -> list[YamlT]:
+        # Retry once on another worker if the worker fails, but not if the
+        # template fails
+        for attempt in range(2):
+            await self._ensure_workers()
+            worker = min(self.workers, key=lambda w: w.pending)
+            try:
+                return await worker.render(values, self.timeout)
+            except WorkerError as e:
+                if attempt:
+                    raise
+                log.warning(f"Render failed, retrying: {e}")
+        raise AssertionError("unreachable")
+
+    async def _check_health(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for worker in list(self.workers):
+                if worker.alive and not await worker.ping(self.timeout):
+                    worker.kill()
+            try:
+                await self._ensure_workers()
+            except WorkerError:
+                log.exception(f"{self} failed to restart workers")
+
+    async def close(self) -> None:
+        if self._health_check:
+            self._health_check.cancel()
+            self._health_check = None
+        async with self._lock:
+            await asyncio.gather(*(w.stop() for w in self.workers))
+            self.workers = []
+
+
+class HelmWorkerRenderer(Renderer):
+    """
+    Renders charts with persistent helm worker processes, so helm and the
+    chart are only loaded once. Workers are restarted if they exit or fail a
+    health check, and replaced if any file in the chart changes.
+    """
+
+    command: list[str] = ["kubetemplatespawner-helm-worker"]
+    workers: int = 1
+    timeout: float = 60
+    health_check_interval: float = 30
+
+    def __init__(self) -> None:
+        # (event loop, chart path) -> workers
+        self._pools: dict[tuple, HelmWorkerPool] = {}
+
+    def pool(self, path: str) -> HelmWorkerPool | None:
+        return self._pools.get((asyncio.get_running_loop(), path))
+
+    async def render(self, path: str, vars: dict[str, YamlT]) -> list[YamlT]:
+        key = (asyncio.get_running_loop(), path)
+        digest = chart_digest(path)
+        pool = self._pools.get(key)
+        if pool and pool.digest != digest:
+            log.info(f"Chart {path} has changed, replacing helm workers")
+            # Let renders in progress finish
+            asyncio.create_task(pool.close())
+            pool = None
+        if not pool:
+            pool = HelmWorkerPool(
+                self.command,
+                path,
+                digest,
+                self.workers,
+                self.timeout,
+                self.health_check_interval,
+            )
+            self._pools[key] = pool
+        return await pool.render(vars)
+
+    async def close(self) -> None:
+        pools = list(self._pools.values())
+        self._pools.clear()
+        await asyncio.gather(*(pool.close() for pool in pools))
+
+
+def configure_helm_workers(
+    command: list[str], workers: int, timeout: float, health_check_interval: float
+) -> None:
+    HelmWorkerRenderer.command = command
+    HelmWorkerRenderer.workers = workers
+    HelmWorkerRenderer.timeout = timeout
+    HelmWorkerRenderer.health_check_interval = health_check_interval
@@ -0,0 +1,516 @@
+# Shared watches of Kubernetes objects and events used by all spawners
+
+import asyncio
+from datetime import datetime
+from time import monotonic
+from typing import Any
+
+from kubernetes_asyncio import client, watch
+from kubernetes_asyncio.client.rest import ApiException
+from kubernetes_asyncio.dynamic import DynamicClient
+from tornado.log import app_log as log
+
+from ._kubernetes import (
+    KubernetesStatusError,
+    ManifestSummary,
+    k8s_request,
+    k8s_resource,
+    wait_for_deleted,
+)
+from ._metrics import INFORMER_STALENESS_SECONDS
+from ._retry import Backoff
+
+USERNAME_LABEL = "hub.jupyter.org/username"
+SERVERNAME_LABEL = "hub.jupyter.org/servername"
+
+
+class Informer:
+    """
+    Maintain an in-memory copy of all objects of one kind in a namespace
+    matching a label selector, using a list followed by a watch.
+
+    Objects are indexed by the username and servername labels.
+    The list is repeated every `resync_period` seconds in case any events
+    were missed. Until the first list completes `synced` is False and
+    callers should read from the API server instead.
+    """
+
+    def __init__(
+        self,
+        dyn_client: DynamicClient,
+        api_version: str,
+        kind: str,
+        namespace: str,
+        label_selector: str,
+        resync_period: float = 300,
+    ):
+        self.dyn_client = dyn_client
+        self.api_version = api_version
+        self.kind = kind
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.resync_period = resync_period
+
+        self.synced = False
+        self.resource_version: Any = None
+        self.last_list = 0.0
+        self.last_event = 0.0
+        self.list_count = 0
+        self.event_count = 0
+
+        # name -> object
+        self._objects: dict[str, Any] = {}
+        # (username, servername) -> names
+        self._index: dict[tuple[str | None, str | None], set[str]] = {}
+        self._task: asyncio.Task | None = None
+
+    def __repr__(self) -> str:
+        return (
+            f"Informer({self.api_version}/{self.kind} ns={self.namespace} "
+            f"selector={self.label_selector})"
+        )
+
+    @property
+    def staleness(self) -> float:
+        """Seconds since the last list or event, infinite if never synced"""
+        if not self.synced:
+            return float("inf")
+        return monotonic() - max(self.last_list, self.last_event)
+
+    @staticmethod
+    def _index_key(obj: Any) -> tuple[str | None, str | None]:
+        labels = obj.metadata.get("labels") or {}
+        return labels.get(USERNAME_LABEL), labels.get(SERVERNAME_LABEL)
+
+    def _add(self, obj: Any) -> None:
+        name = obj.metadata.name
+        self._remove(name)
+        self._objects[name] = obj
+        self._index.setdefault(self._index_key(obj), set()).add(name)
+
+    def _remove(self, name: str) -> None:
+        obj = self._objects.pop(name, None)
+        if obj is not None:
+            key = self._index_key(obj)
+            self._index[key].discard(name)
+            if not self._index[key]:
+                del self._index[key]
+
+    def get(self, name: str) -> Any | None:
+        return self._objects.get(name)
+
+    def by_labels(self, labels: dict[str, str] | None = None) -> list[Any]:
+        """Objects matching all labels"""
+        labels = labels or {}
+        if USERNAME_LABEL in labels and SERVERNAME_LABEL in labels:
+            names = self._index.get(
+                (labels[USERNAME_LABEL], labels[SERVERNAME_LABEL]), set()
+            )
+        elif USERNAME_LABEL in labels:
+            names = set()
+            for (username, _), n in self._index.items():
+                if username == labels[USERNAME_LABEL]:
+                    names.update(n)
+        else:
+            names = set(self._objects)
+
+        matches = []
+        for name in sorted(names):
+            obj = self._objects[name]
+            obj_labels = obj.metadata.get("labels") or {}
+            if all(obj_labels.get(k) == v for (k, v) in labels.items()):
+                matches.append(obj)
+        return matches
+
+    async def _list(self, resource: Any) -> None:
+        objs = await resource.get(
+            namespace=self.namespace, label_selector=self.label_selector
+        )
+        # e.g. a 403 if the hub isn't allowed to list, stay unsynced so
+        # callers read from the API server instead
+        if objs.kind == "Status":
+            raise KubernetesStatusError(f"{self} failed to list", objs)
+        self._objects.clear()
+        self._index.clear()
+        for obj in objs.items:
+            self._add(obj)
+        self.resource_version = objs.metadata.resourceVersion
+        self.last_list = monotonic()
+        self.list_count += 1
+        self.synced = True
+        log.debug(f"{self} listed {len(self._objects)} objects")
+
+    async def _watch(self, resource: Any) -> None:
+        async with watch.Watch() as w:
+            async for event in self.dyn_client.watch(
+                resource,
+                namespace=self.namespace,
+                label_selector=self.label_selector,
+                resource_version=self.resource_version,
+                timeout=int(self.resync_period),
+                watcher=w,
+            ):
+                obj = event["object"]
+                self.resource_version = obj.metadata.resourceVersion
+                if event["type"] == "DELETED":
+                    self._remove(obj.metadata.name)
+                else:
+                    self._add(obj)
+                self.last_event = monotonic()
+                self.event_count += 1
+
+    async def run(self) -> None:
+        resource = await k8s_resource(self.dyn_client, self.api_version, self.kind)
+        backoff = Backoff()
+        while True:
+            try:
+                await self._list(resource)
+                backoff.reset()
+                # Watch ends after resync_period and the list is repeated
+                await self._watch(resource)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not (isinstance(e, ApiException) and e.status == 410):
+                    log.exception(f"{self} failed")
+                    self.synced = False
+                    await backoff.sleep()
+
+    @property
+    def _metric_labels(self) -> tuple[str, str, str]:
+        return self.kind, self.namespace, self.label_selector
+
+    def start(self) -> None:
+        if not self._task:
+            self._task = asyncio.create_task(self.run())
+            INFORMER_STALENESS_SECONDS.labels(*self._metric_labels).set_function(
+                lambda: self.staleness
+            )
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                INFORMER_STALENESS_SECONDS.remove(*self._metric_labels)
+            except KeyError:
+                pass
+        self.synced = False
+
+
+# (event loop, dyn_client, api_version, kind, namespace, label_selector) -> Informer
+_informers: dict[tuple, Informer] = {}
+
+
+def shared_informer(
+    dyn_client: DynamicClient,
+    api_version: str,
+    kind: str,
+    namespace: str,
+    label_selector: str,
+    resync_period: float = 300,
+) -> Informer:
+    """
+    Return a running informer shared by all callers on the running event loop.
+
+    It is stopped when its task is cancelled, either by stop_shared_informers()
+    or by JupyterHub cancelling all tasks on shutdown.
+    """
+    key = (
+        asyncio.get_running_loop(),
+        dyn_client,
+        api_version,
+        kind,
+        namespace,
+        label_selector,
+    )
+    informer = _informers.get(key)
+    if informer is None:
+        informer = Informer(
+            dyn_client, api_version, kind, namespace, label_selector, resync_period
+        )
+        _informers[key] = informer
+        informer.start()
+        assert informer._task
+        informer._task.add_done_callback(lambda _: _informers.pop(key, None))
+    return informer
+
+
+def shared_informers() -> list[Informer]:
+    return list(_informers.values())
+
+
+async def stop_shared_informers() -> None:
+    """Stop all shared informers belonging to the running event loop"""
+    loop = asyncio.get_running_loop()
+    for key, informer in list(_informers.items()):
+        if key[0] is loop:
+            await informer.stop()
+
+
+# Maximum number of event messages buffered for a slow consumer
+EVENT_BUFFER_SIZE = 100
+
+
+def put_dropping_oldest(queue: asyncio.Queue, item: Any) -> bool:
+    """
+    Add an item to a bounded queue, dropping the oldest item if it's full.
+    Returns True if an item was dropped.
+    """
+    dropped = False
+    if queue.full():
+        queue.get_nowait()
+        dropped = True
+    queue.put_nowait(item)
+    return dropped
+
+
+class EventSubscription:
+    """
+    Kubernetes Event messages for a set of objects.
+
+    Messages are buffered up to `maxsize`, after which the oldest are dropped
+    so a slow consumer can't cause unbounded memory growth.
+    """
+
+    def __init__(
+        self,
+        objects: list[ManifestSummary],
+        since: datetime,
+        maxsize: int = EVENT_BUFFER_SIZE,
+    ):
+        self.keys = {(obj.kind, obj.name) for obj in objects}
+        self.since = since
+        self.dropped = 0
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize)
+
+    def put(self, message: str) -> None:
+        if put_dropping_oldest(self._queue, message):
+            self.dropped += 1
+
+    def __aiter__(self) -> "EventSubscription":
+        return self
+
+    async def __anext__(self) -> str:
+        return await self._queue.get()
+
+
+class EventWatcher:
+    """
+    A single watch of Kubernetes Events in a namespace, dispatched to
+    subscribers by the (kind, name) of the involved object.
+
+    The watch runs while there are subscribers.
+    """
+
+    def __init__(self, dyn_client: DynamicClient, namespace: str):
+        self.dyn_client = dyn_client
+        self.namespace = namespace
+        self.event_count = 0
+        # (kind, name) -> subscriptions
+        self._subscriptions: dict[tuple[str, str], set[EventSubscription]] = {}
+        self._task: asyncio.Task | None = None
+
+    def subscribe(
+        self,
+        objects: list[ManifestSummary],
+        since: datetime,
+        maxsize: int = EVENT_BUFFER_SIZE,
+    ) -> EventSubscription:
+        subscription = EventSubscription(objects, since, maxsize)
+        for key in subscription.keys:
+            self._subscriptions.setdefault(key, set()).add(subscription)
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription: EventSubscription) -> None:
+        for key in subscription.keys:
+            subs = self._subscriptions.get(key, set())
+            subs.discard(subscription)
+            if not subs:
+                self._subscriptions.pop(key, None)
+        if not self._subscriptions and self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _dispatch(self, event: Any) -> None:
+        self.event_count += 1
+        involved = event.involved_object
+        subscriptions = self._subscriptions.get((involved.kind, involved.name))
+        if not subscriptions:
+            return
+        timestamp = event.event_time or event.last_timestamp
+        if not timestamp:
+            log.error(f"No timestamp in {event}")
+        m = f"{timestamp} {involved.kind}/{involved.name} {event.message}"
+        for subscription in subscriptions:
+            if timestamp and timestamp < subscription.since:
+                log.info(f"Ignoring old Event: {m}")
+            else:
+                log.info(f"Event: {m}")
+                subscription.put(m)
+
+    async def run(self) -> None:
+        v1 = client.CoreV1Api(self.dyn_client.client)
+        resource_version = None
+        backoff = Backoff()
+        while self._subscriptions:
+            try:
+                async with watch.Watch() as w:
+                    async for event in w.stream(
+                        v1.list_namespaced_event,
+                        namespace=self.namespace,
+                        resource_version=resource_version,
+                        timeout_seconds=300,
+                    ):
+                        resource_version = w.resource_version
+                        backoff.reset()
+                        self._dispatch(event["object"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                resource_version = None
+                if not (isinstance(e, ApiException) and e.status == 410):
+                    log.exception(f"Event watch error ns={self.namespace}")
+                    await backoff.sleep()
+
+
+# (event loop, dyn_client, namespace) -> EventWatcher
+_event_watchers: dict[tuple, EventWatcher] = {}
+
+
+def shared_event_watcher(dyn_client: DynamicClient, namespace: str) -> EventWatcher:
+    """Return the EventWatcher for a namespace shared by all callers"""
+    key = (asyncio.get_running_loop(), dyn_client, namespace)
+    watcher = _event_watchers.get(key)
+    if watcher is None:
+        watcher = _event_watchers[key] = EventWatcher(dyn_client, namespace)
+    return watcher
+
+
+class BatchLister:
+    """
+    Coalesce lookups of objects by name made within `window` seconds into a
+    single list request per (namespace, apiVersion, kind, label selector).
+
+    Lookups made while a list request is in progress go into the next batch,
+    so a result is never older than the lookup.
+    """
+
+    def __init__(self, window: float = 0.1):
+        self.window = window
+        self.list_count = 0
+        self.lookup_count = 0
+        self._pending: dict[tuple, asyncio.Future] = {}
+
+    async def get(
+        self,
+        dyn_client: DynamicClient,
+        api_version: str,
+        kind: str,
+        name: str,
+        namespace: str,
+        label_selector: str,
+    ) -> Any | None:
+        key = (dyn_client, api_version, kind, namespace, label_selector)
+        self.lookup_count += 1
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = asyncio.ensure_future(self._list(key))
+            self._pending[key] = batch
+        objects = await asyncio.shield(batch)
+        return objects.get(name)
+
+    async def _list(self, key: tuple) -> dict[str, Any]:
+        dyn_client, api_version, kind, namespace, label_selector = key
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self._pending.pop(key, None)
+        objs = await k8s_request(
+            dyn_client,
+            api_version,
+            kind,
+            lambda resource: resource.get(
+                namespace=namespace, label_selector=label_selector
+            ),
+        )
+        if objs.kind == "Status":
+            raise KubernetesStatusError(
+                f"Unexpected status listing {api_version}/{kind} ns={namespace}", objs
+            )
+        if not objs.kind.endswith("List"):
+            raise RuntimeError(f"Unexpected object: {objs}")
+        self.list_count += 1
+        log.debug(
+            f"Listed {len(objs.items)} {api_version}/{kind} ns={namespace} "
+            f"({self.lookup_count} lookups in {self.list_count} lists)"
+        )
+        return {obj.metadata.name: obj for obj in objs.items}
+
+
+# Shared by all spawners in this process
+poll_lister = BatchLister()
+
+
+class DeletionReaper:
+    """
+    Track deletions that were requested without waiting for them to complete,
+    and log any that don't complete within their timeout.
+    """
+
+    def __init__(self) -> None:
+        self.completed = 0
+        self.timed_out = 0
+        # (dyn_client, summary) -> task
+        self._tasks: dict[tuple[DynamicClient, ManifestSummary], asyncio.Task] = {}
+
+    @property
+    def pending(self) -> list[ManifestSummary]:
+        return [s for (_, s) in self._tasks]
+
+    def track(
+        self, dyn_client: DynamicClient, s: ManifestSummary, timeout: float
+    ) -> None:
+        key = (dyn_client, s)
+        if key in self._tasks:
+            return
+        task = asyncio.create_task(self._wait(dyn_client, s, timeout))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def _wait(
+        self, dyn_client: DynamicClient, s: ManifestSummary, timeout: float
+    ) -> None:
+        try:
+            resource = await k8s_resource(dyn_client, s.api_version, s.kind)
+            if await wait_for_deleted(dyn_client, resource, s, None, timeout):
+                self.completed += 1
+                log.info(f"Deleted {s}")
+            else:
+                self.timed_out += 1
+                log.error(f"Timeout waiting for {s} to be deleted")
+        except Exception:
+            log.exception(f"Failed to wait for deletion of {s}")
+
+    async def wait(
+        self, dyn_client: DynamicClient, summaries: list[ManifestSummary]
+    ) -> None:
+        """Wait for any pending deletions of these objects"""
+        tasks = [
+            self._tasks[(dyn_client, s)]
+            for s in summaries
+            if (dyn_client, s) in self._tasks
+        ]
+        if tasks:
+            log.info(f"Waiting for deletion of {len(tasks)} objects")
+            await asyncio.gather(*(asyncio.shield(t) for t in tasks))
+
+
+# Shared by all spawners in this process
+deletion_reaper = DeletionReaper()
@@ -1,27 +1,75 @@
 # These are seperated from the spawner to make testing easier
 
 import asyncio
+import atexit
 from collections import namedtuple
+from collections.abc import Awaitable, Callable
 from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime
 from functools import lru_cache
+from math import ceil
+from time import monotonic
 from typing import (
+    TYPE_CHECKING,
     Any,
 )
+from weakref import WeakKeyDictionary
 
+import yaml
 from kubernetes_asyncio import client, config, watch
+from kubernetes_asyncio.client.rest import ApiException
 from kubernetes_asyncio.config import ConfigException
 from kubernetes_asyncio.dynamic import DynamicClient
-from kubernetes_asyncio.dynamic.exceptions import ResourceNotFoundError
-from kubernetes_asyncio.dynamic.resource import ResourceInstance
+from kubernetes_asyncio.dynamic.exceptions import (
+    NotFoundError,
+    ResourceNotFoundError,
+)
+from kubernetes_asyncio.dynamic.resource import Resource, ResourceInstance
 from tornado.log import app_log as log
 
+from ._accounting import instrument
+from ._ratelimit import rate_limit, rate_limiter
+from ._retry import Backoff
+from ._tracing import tracer
+
+if TYPE_CHECKING:
+    from ._informer import Informer
+
 # YamlT = dict[str, Any]
 YamlT = Any
 
+# libyaml is about ten times faster than the pure Python loader and dumper
+try:
+    from yaml import CSafeDumper as SafeDumper  # noqa: F401
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper, SafeLoader  # type: ignore[assignment]  # noqa: F401
+
 ManifestSummary = namedtuple("ManifestSummary", "api_version kind name namespace")
 
 
+class KubernetesTimeout(RuntimeError):
+    """Timed out waiting for a Kubernetes object"""
+
+
+class KubernetesStatusError(RuntimeError):
+    """
+    The API server returned a failure Status instead of an object.
+
+    The dynamic client doesn't raise ApiException for HTTP errors, it returns
+    the Status, so this is raised wherever a Status is unexpected.
+    """
+
+    def __init__(self, message: str, status: ResourceInstance):
+        super().__init__(f"{message}: {status}")
+        self.status = status
+        self.code = getattr(status, "code", None)
+
+
+def load_manifests(text: str | bytes) -> list[YamlT]:
+    """Non-empty documents in a YAML stream"""
+    return [doc for doc in yaml.load_all(text, Loader=SafeLoader) if doc]
+
+
 def manifest_summary(manifest: YamlT) -> ManifestSummary:
     api_version = manifest["apiVersion"]
     kind = manifest["kind"]
@@ -49,6 +97,89 @@ def load_config(config_file: str | None = None) -> None:
         future.result()
 
 
+# (event loop, config_file, max_connections, discovery_cache_file)
+#   -> (client future, keepalive task)
+_shared_clients: dict[tuple, tuple[asyncio.Future, asyncio.Task]] = {}
+
+
+async def _shared_client_task(key: tuple, future: asyncio.Future) -> None:
+    _, config_file, max_connections, discovery_cache_file = key
+    try:
+        load_config(config_file)
+        configuration = client.Configuration.get_default_copy()
+        configuration.connection_pool_maxsize = max_connections
+        async with client.ApiClient(configuration) as api:
+            instrument(api.rest_client)
+            rate_limit(api.rest_client, rate_limiter)
+            dyn_client = await DynamicClient(api, cache_file=discovery_cache_file)
+            future.set_result(dyn_client)
+            # Keep the connection pool open until this task is cancelled
+            while True:
+                await asyncio.sleep(300)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+    finally:
+        _shared_clients.pop(key, None)
+        if not future.done():
+            future.cancel()
+
+
+async def shared_dynamic_client(
+    config_file: str | None = None,
+    max_connections: int = 100,
+    discovery_cache_file: str | None = None,
+) -> DynamicClient:
+    """
+    Return a DynamicClient shared by all callers on the running event loop.
+
+    One client, and therefore one keep-alive connection pool and one API
+    discovery cache, is created per event loop and kubeconfig.
+    The client is closed when its keepalive task is cancelled: by
+    close_shared_clients(), by JupyterHub cancelling all tasks when it's
+    stopped by a signal (JupyterHub.shutdown_cancel_tasks), or at exit by
+    _close_at_exit() if the event loop was stopped without that.
+
+    discovery_cache_file is where API discovery results are persisted between
+    restarts, default is a file in the system temporary directory.
+    """
+    loop = asyncio.get_running_loop()
+    key = (loop, config_file, max_connections, discovery_cache_file)
+    if key not in _shared_clients:
+        if not _shared_clients:
+            # Registered again after an unregister, so it runs before earlier
+            # atexit callbacks that may close the event loop
+            atexit.unregister(_close_at_exit)
+            atexit.register(_close_at_exit)
+        future = loop.create_future()
+        task = loop.create_task(_shared_client_task(key, future))
+        _shared_clients[key] = (future, task)
+    future, _ = _shared_clients[key]
+    # Don't let a cancelled caller cancel the client for everyone else
+    return await asyncio.shield(future)
+
+
+async def close_shared_clients() -> None:
+    """Close all shared clients belonging to the running event loop"""
+    loop = asyncio.get_running_loop()
+    tasks = [task for (k, (_, task)) in _shared_clients.items() if k[0] is loop]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _close_at_exit() -> None:
+    """Close shared clients whose event loop has stopped but isn't closed"""
+    for loop in {k[0] for k in _shared_clients}:
+        if not loop.is_closed() and not loop.is_running():
+            try:
+                loop.run_until_complete(close_shared_clients())
+            except Exception:
+                log.exception("Failed to close Kubernetes clients")
+
+
 def not_found(resource_status: ResourceInstance):
     return not resource_status or resource_status.kind == "Status"
 
@@ -96,24 +227,147 @@ def object_is_ready(obj: ResourceInstance) -> bool:
     return True
 
 
+class DiscoveryCache:
+    """
+    Cache of API resources for one DynamicClient, keyed by (apiVersion, kind).
+
+    The DynamicClient discoverer is never refreshed, and runs a full API
+    discovery on every lookup of a missing kind (e.g. an uninstalled CRD).
+    This cache refreshes discovery at most once every `ttl` seconds, and
+    remembers missing kinds for `negative_ttl` seconds.
+    """
+
+    ttl: float = 600
+    negative_ttl: float = 60
+
+    def __init__(self) -> None:
+        # (apiVersion, kind) -> (expiry, resource or None if missing)
+        self._resources: dict[tuple[str, str], tuple[float, Resource | None]] = {}
+        self.refreshed = monotonic()
+        self._refreshing: asyncio.Future | None = None
+        self.hits = 0
+        self.misses = 0
+
+    async def refresh(self, dyn_client: DynamicClient) -> None:
+        """Re-run API discovery, shared between concurrent callers"""
+
+        async def _refresh():
+            log.info("Refreshing Kubernetes API discovery")
+            await dyn_client.resources.invalidate_cache()
+            self._resources.clear()
+            self.refreshed = monotonic()
+
+        if not self._refreshing or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(_refresh())
+        await asyncio.shield(self._refreshing)
+
+    def invalidate(self, api_version: str, kind: str) -> None:
+        self._resources.pop((api_version, kind), None)
+
+    async def get(self, dyn_client: DynamicClient, api_version: str, kind: str) -> Any:
+        now = monotonic()
+        if now - self.refreshed > self.ttl:
+            await self.refresh(dyn_client)
+
+        key = (api_version, kind)
+        cached = self._resources.get(key)
+        if cached and now < cached[0]:
+            self.hits += 1
+            if cached[1] is None:
+                raise ResourceNotFoundError(f"No matches found for {key} (cached)")
+            return cached[1]
+
+        self.misses += 1
+        try:
+            # On a miss this will already have re-run discovery
+            resource = await dyn_client.resources.get(
+                api_version=api_version, kind=kind
+            )
+        except ResourceNotFoundError:
+            self._resources[key] = (monotonic() + self.negative_ttl, None)
+            raise
+        self._resources[key] = (self.refreshed + self.ttl, resource)
+        return resource
+
+
+_discovery_caches: WeakKeyDictionary[DynamicClient, DiscoveryCache] = (
+    WeakKeyDictionary()
+)
+
+
+def discovery_cache(dyn_client: DynamicClient) -> DiscoveryCache:
+    try:
+        return _discovery_caches[dyn_client]
+    except KeyError:
+        cache = _discovery_caches[dyn_client] = DiscoveryCache()
+        return cache
+
+
+def configure_discovery_cache(ttl: float, negative_ttl: float) -> None:
+    DiscoveryCache.ttl = ttl
+    DiscoveryCache.negative_ttl = negative_ttl
+
+
 async def k8s_resource(dyn_client: DynamicClient, api_version: str, kind: str) -> Any:
     try:
-        resource = await dyn_client.resources.get(api_version=api_version, kind=kind)
-        return resource
+        return await discovery_cache(dyn_client).get(dyn_client, api_version, kind)
     except ResourceNotFoundError:
         log.exception(f"Resource not found: {api_version}/{kind}")
         raise
 
 
+def resource_not_served(obj: ResourceInstance | None) -> bool:
+    """
+    Is obj the 404 Status returned for a resource the API server doesn't serve,
+    e.g. a CRD that was removed or changed version after discovery?
+    A missing object also returns 404, but with its name in the details.
+    """
+    if obj is None or obj.kind != "Status" or obj.code != 404:
+        return False
+    return not (obj.get("details") or {}).get("name")
+
+
+async def k8s_request(
+    dyn_client: DynamicClient,
+    api_version: str,
+    kind: str,
+    request: Callable[[Resource], Awaitable[Any]],
+) -> Any:
+    """
+    Make a request with the discovered resource for a kind.
+    If the resource isn't served any more API discovery is refreshed, unless it
+    already has been since the request started, and the request is retried once.
+    """
+    cache = discovery_cache(dyn_client)
+    started = monotonic()
+    resource = await k8s_resource(dyn_client, api_version, kind)
+    obj = await request(resource)
+    if not resource_not_served(obj):
+        return obj
+    log.warning(f"{api_version}/{kind} isn't served, refreshing API discovery")
+    cache.invalidate(api_version, kind)
+    if cache.refreshed < started:
+        await cache.refresh(dyn_client)
+    resource = await k8s_resource(dyn_client, api_version, kind)
+    return await request(resource)
+
+
 async def wait_for_ready(
-    dyn_client: DynamicClient, obj: ResourceInstance, timeout: int
+    dyn_client: DynamicClient, obj: ResourceInstance, timeout: float
+) -> None:
+    with tracer.span("wait_for_ready", kind=obj.kind, name=obj.metadata.get("name")):
+        await _wait_for_ready(dyn_client, obj, timeout)
+
+
+async def _wait_for_ready(
+    dyn_client: DynamicClient, obj: ResourceInstance, timeout: float
 ) -> None:
     api_version = obj.apiVersion
     kind = obj.kind
     name = obj.metadata.name
     namespace = getattr(obj.metadata, "namespace", "default")
     if kind == "Status":
-        raise RuntimeError(f"Unexpected status: {obj}")
+        raise KubernetesStatusError("Unexpected status", obj)
     resource = await k8s_resource(dyn_client, api_version, kind)
 
     async def is_ready() -> bool:
@@ -124,107 +378,328 @@ async def wait_for_ready(
             log.info(e)
         return False
 
-    log.info(f"Waiting for {kind}/{name} to be ready (timeout={timeout})...")
-    for _ in range(timeout):
-        if await is_ready():
-            log.info(f"{kind}/{name} is ready")
-            return
-        await asyncio.sleep(1)
-    raise RuntimeError(f"Timeout ({timeout}) waiting for {kind}/{name}")
-
+    log.info(f"Waiting for {kind}/{name} to be ready (timeout={timeout:.0f})...")
+    if object_is_ready(obj):
+        log.info(f"{kind}/{name} is ready")
+        return
 
-# kind, name, namespace
-async def stream_events(
-    events: asyncio.Queue | None,
-    objects: list[ManifestSummary],
-    since: datetime,
-    timeout: int,
-) -> None:
-    log.info(f"Watching {objects} since {since} for {timeout} s")
-    namespaces = set(obj.namespace for obj in objects)
-    if len(namespaces) > 1:
-        raise ValueError("All objects must be in the same namespace")
-    namespace = namespaces.pop()
-    obj_match = set((obj.kind, obj.name) for obj in objects)
-    v1 = client.CoreV1Api()
-    w = watch.Watch()
-
-    try:
-        async for event in w.stream(
-            v1.list_namespaced_event, namespace=namespace, timeout_seconds=timeout
-        ):
-            involved = event["object"].involved_object
-            timestamp = event["object"].event_time or event["object"].last_timestamp
-            if not timestamp:
-                log.error(f"No timestamp in {event['object']}")
-            if (involved.kind, involved.name) in obj_match:
-                m = f"{timestamp} {involved.kind}/{involved.name} {event['object'].message}"
-                if timestamp and timestamp < since:
-                    log.info(f"Ignoring old Event: {m}")
-                else:
-                    log.info(f"Event: {m}")
-                    if events:
-                        events.put_nowait({"message": m})
-    except Exception:
-        log.exception(f"Event watch error for {obj_match} ns={namespace}")
+    backoff = Backoff(timeout)
+    resource_version = obj.metadata.get("resourceVersion")
+    while not backoff.expired:
+        try:
+            async with watch.Watch() as w:
+                async for event in dyn_client.watch(
+                    resource,
+                    namespace=namespace,
+                    name=name,
+                    resource_version=resource_version,
+                    timeout=ceil(backoff.remaining),
+                    watcher=w,
+                ):
+                    updated = event["object"]
+                    resource_version = updated.metadata.resourceVersion
+                    if event["type"] != "DELETED" and object_is_ready(updated):
+                        log.info(f"{kind}/{name} is ready")
+                        return
+        except Exception as e:
+            if isinstance(e, ApiException) and e.status == 410:
+                # resourceVersion is too old, restart the watch from the current state
+                log.info(f"Restarting watch for {kind}/{name}: {e.reason}")
+                resource_version = None
+                continue
+            # Fall back to polling if the watch fails
+            log.warning(f"Watch failed for {kind}/{name}: {e}")
+            if await is_ready():
+                log.info(f"{kind}/{name} is ready")
+                return
+            await backoff.sleep()
+    raise KubernetesTimeout(f"Timeout ({timeout}) waiting for {kind}/{name}")
 
 
 async def deploy_manifest(
-    dyn_client: DynamicClient, manifest: YamlT, timeout: int
-) -> None:
+    dyn_client: DynamicClient,
+    manifest: YamlT,
+    timeout: float,
+    *,
+    field_manager: str | None = None,
+    force_conflicts: bool = False,
+    dry_run: bool = False,
+) -> dict[str, float]:
+    """
+    Create or update an object and wait for it to be ready.
+    Returns the time taken by each step in seconds.
+    timeout is a deadline for all steps, not just waiting for the object.
+
+    If field_manager is set server-side apply is used, which is a single request.
+    Otherwise the object is fetched and then patched or created.
+    If dry_run is set the request is validated by the server but not persisted,
+    and readiness is not checked.
+    """
     s = manifest_summary(manifest)
-
-    resource = await k8s_resource(dyn_client, s.api_version, s.kind)
-
-    try:
-        obj = await resource.get(name=s.name, namespace=s.namespace)
-    except Exception:
-        obj = None
-    if obj and obj.kind == s.kind:
-        log.info(f"Updating {s.api_version}/{s.kind}/{s.name}")
-        obj = await resource.patch(body=manifest, name=s.name, namespace=s.namespace)
-    elif not_found(obj):
-        log.info(f"Creating {s.api_version}/{s.kind}/{s.name}")
-        obj = await resource.create(body=manifest, namespace=s.namespace)
+    start = monotonic()
+    timings: dict[str, float] = {}
+
+    dry_run_param = "All" if dry_run else None
+
+    if field_manager:
+        log.info(f"Applying {s.api_version}/{s.kind}/{s.name}")
+        t = monotonic()
+        obj = await k8s_request(
+            dyn_client,
+            s.api_version,
+            s.kind,
+            lambda resource: resource.server_side_apply(
+                body=manifest,
+                name=s.name,
+                namespace=s.namespace,
+                field_manager=field_manager,
+                force_conflicts=force_conflicts or None,
+                dry_run=dry_run_param,
+            ),
+        )
+        if obj and obj.kind == "Status" and obj.code == 409:
+            # Another field manager (e.g. kubectl edit) owns some of the fields
+            raise KubernetesStatusError(
+                f"Conflict applying {s} as {field_manager}: {obj.message}", obj
+            )
+        timings["apply"] = monotonic() - t
     else:
-        raise RuntimeError(f"Unexpected status: {obj}")
+        t = monotonic()
+        try:
+            obj = await k8s_request(
+                dyn_client,
+                s.api_version,
+                s.kind,
+                lambda resource: resource.get(name=s.name, namespace=s.namespace),
+            )
+        except Exception:
+            obj = None
+        timings["get"] = monotonic() - t
+        # Refreshed if the get found it was no longer served
+        resource = await k8s_resource(dyn_client, s.api_version, s.kind)
+
+        t = monotonic()
+        if obj and obj.kind == s.kind:
+            log.info(f"Updating {s.api_version}/{s.kind}/{s.name}")
+            obj = await resource.patch(
+                body=manifest,
+                name=s.name,
+                namespace=s.namespace,
+                dry_run=dry_run_param,
+            )
+            timings["patch"] = monotonic() - t
+        elif not_found(obj):
+            log.info(f"Creating {s.api_version}/{s.kind}/{s.name}")
+            obj = await resource.create(
+                body=manifest, namespace=s.namespace, dry_run=dry_run_param
+            )
+            timings["create"] = monotonic() - t
+        else:
+            raise KubernetesStatusError(f"Unexpected status getting {s}", obj)
 
     if not obj:
         raise RuntimeError(f"No object created: {s}")
+    if obj.kind == "Status":
+        raise KubernetesStatusError(f"Unexpected status deploying {s}", obj)
+
+    if not dry_run:
+        t = monotonic()
+        await wait_for_ready(dyn_client, obj, max(timeout - (t - start), 0))
+        timings["ready"] = monotonic() - t
+
+    timings["total"] = monotonic() - start
+    breakdown = " ".join(f"{k}={v:.3f}s" for (k, v) in timings.items())
+    log.info(
+        f"Deployed {s.api_version}/{s.kind}/{s.name}"
+        f"{' (dry run)' if dry_run else ''} {breakdown}"
+    )
+    return timings
+
 
-    await wait_for_ready(dyn_client, obj, timeout)
+async def wait_for_deleted(
+    dyn_client: DynamicClient,
+    resource: Resource,
+    s: ManifestSummary,
+    resource_version: Any,
+    timeout: float,
+) -> bool:
+    """
+    Watch an object until it's deleted.
+    Returns False if it still exists after timeout.
+    """
+    backoff = Backoff(timeout)
+    while not backoff.expired:
+        if resource_version is None:
+            try:
+                obj = await resource.get(name=s.name, namespace=s.namespace)
+            except NotFoundError:
+                return True
+            if not_found(obj):
+                return True
+            resource_version = obj.metadata.resourceVersion
+        try:
+            async with watch.Watch() as w:
+                async for event in dyn_client.watch(
+                    resource,
+                    namespace=s.namespace,
+                    name=s.name,
+                    resource_version=resource_version,
+                    timeout=ceil(backoff.remaining),
+                    watcher=w,
+                ):
+                    if event["type"] == "DELETED":
+                        return True
+                    resource_version = event["object"].metadata.resourceVersion
+        except Exception as e:
+            resource_version = None
+            if isinstance(e, ApiException) and e.status == 410:
+                log.info(f"Restarting watch for {s}: {e.reason}")
+                continue
+            log.warning(f"Watch failed for {s}: {e}")
+            await backoff.sleep()
+    return False
 
 
 async def delete_manifest(
     dyn_client: DynamicClient,
     manifest: YamlT | ManifestSummary,
-    timeout: int,
-) -> None:
+    timeout: float,
+    *,
+    propagation_policy: str | None = None,
+    grace_period_seconds: int | None = None,
+) -> bool:
+    """
+    Delete an object, and if timeout is non-zero wait for it to be removed.
+    Returns False if the object wasn't removed within the timeout, which
+    includes the delete request.
+
+    propagation_policy and grace_period_seconds are passed to the API server,
+    None uses the server default.
+    """
     if isinstance(manifest, ManifestSummary):
         s = manifest
     else:
         s = manifest_summary(manifest)
-    resource = await k8s_resource(dyn_client, s.api_version, s.kind)
+    start = monotonic()
 
     try:
         log.info(f"Deleting {s}")
-        await resource.delete(name=s.name, namespace=s.namespace)
+        deleted = await k8s_request(
+            dyn_client,
+            s.api_version,
+            s.kind,
+            lambda resource: resource.delete(
+                name=s.name,
+                namespace=s.namespace,
+                propagation_policy=propagation_policy,
+                grace_period_seconds=grace_period_seconds,
+            ),
+        )
+        if deleted and deleted.kind == "Status" and deleted.status == "Failure":
+            if deleted.code == 404:
+                log.info(f"Already deleted {s}")
+                return True
+            raise KubernetesStatusError(f"Failed to delete {s}", deleted)
 
         if timeout:
-            for _ in range(timeout):
-                obj = await resource.get(name=s.name, namespace=s.namespace)
-                if not_found(obj):
-                    log.info(f"Deleted {s}")
-                    return
-                await asyncio.sleep(1)
-            log.error(f"Timeout waiting for {s} to be deleted")
+            # Objects with finalizers or a grace period are returned, otherwise
+            # a Status is returned
+            resource_version = None
+            if deleted and deleted.kind == s.kind:
+                resource_version = deleted.metadata.resourceVersion
+            remaining = max(timeout - (monotonic() - start), 0)
+            resource = await k8s_resource(dyn_client, s.api_version, s.kind)
+            if await wait_for_deleted(
+                dyn_client, resource, s, resource_version, remaining
+            ):
+                log.info(f"Deleted {s}")
+            else:
+                log.error(f"Timeout waiting for {s} to be deleted")
+                return False
         else:
             log.info(f"Delete request sent for {s}")
+        return True
     except Exception:
         log.exception(f"Failed to delete {s}")
         raise
 
 
+# Kinds that are used by other objects are deleted in later batches, e.g. a
+# RoleBinding before its Role, and Pods before the ConfigMaps they mount.
+# Kinds not listed, including workloads and custom resources, are deleted first.
+DELETION_ORDER: list[set[str]] = [
+    {"ConfigMap", "Secret", "PersistentVolumeClaim", "RoleBinding"},
+    {"Role", "ServiceAccount"},
+]
+
+
+def deletion_tier(kind: str) -> int:
+    """Index of the deletion batch for a kind"""
+    for n, kinds in enumerate(DELETION_ORDER, 1):
+        if kind in kinds:
+            return n
+    return 0
+
+
+def deletion_batches(summaries: list[ManifestSummary]) -> list[list[ManifestSummary]]:
+    """Split objects into batches that should be deleted in order"""
+    batches: list[list[ManifestSummary]] = [[] for _ in range(len(DELETION_ORDER) + 1)]
+    for s in summaries:
+        batches[deletion_tier(s.kind)].append(s)
+    return [b for b in batches if b]
+
+
+def deletable(obj: ResourceInstance, annotations: dict[str, str]) -> bool:
+    """Does an object have all the annotations required for it to be deleted?"""
+    obj_annotations = obj.metadata.get("annotations", {})
+    for k, v in annotations.items():
+        if obj_annotations.get(k) != v:
+            s = manifest_summary(obj)
+            log.info(f"Not deleting {s}: Missing annotation {k}={v}")
+            return False
+    return True
+
+
+async def delete_collection(
+    dyn_client: DynamicClient,
+    api_version: str,
+    kind: str,
+    namespace: str,
+    label_selector: str,
+    *,
+    propagation_policy: str | None = None,
+    grace_period_seconds: int | None = None,
+) -> bool:
+    """
+    Delete all objects of a kind matching a label selector in one request.
+    Returns False if the request isn't allowed (403) or supported (405), so the
+    objects must be deleted individually.
+    """
+    log.info(f"Deleting {api_version}/{kind} ns={namespace} {label_selector}")
+    deleted = await k8s_request(
+        dyn_client,
+        api_version,
+        kind,
+        lambda resource: resource.delete(
+            namespace=namespace,
+            label_selector=label_selector,
+            propagation_policy=propagation_policy,
+            grace_period_seconds=grace_period_seconds,
+        ),
+    )
+    if deleted and deleted.kind == "Status" and deleted.status == "Failure":
+        if deleted.code in (403, 405):
+            log.warning(
+                f"Unable to delete {api_version}/{kind} collection: {deleted.message}"
+            )
+            return False
+        raise KubernetesStatusError(
+            f"Failed to delete {api_version}/{kind} ns={namespace} {label_selector}",
+            deleted,
+        )
+    return True
+
+
 async def get_deletions_by_labels(
     dyn_client: DynamicClient,
     api_version: str,
@@ -232,34 +707,38 @@ async def get_deletions_by_labels(
     namespace: str,
     labels: dict[str, str],
     annotations: dict[str, str],
+    informer: "Informer | None" = None,
 ) -> list[ResourceInstance]:
-    to_delete: list[ResourceInstance] = []
-
     objs = await get_resource_by_labels(
-        dyn_client, api_version, kind, labels, namespace
+        dyn_client, api_version, kind, labels, namespace, informer=informer
     )
-    for obj in objs:
-        obj_annotations = obj.metadata.get("annotations", {})
-        for k, v in annotations.items():
-            if obj_annotations.get(k) != v:
-                s = manifest_summary(obj)
-                log.info(f"Not deleting {s}: Missing annotation {k}={v}")
-                break
-        else:
-            to_delete.append(obj)
-
-    return to_delete
+    return [obj for obj in objs if deletable(obj, annotations)]
 
 
 async def get_resource_by_name(
-    dyn_client, api_version, kind, name, namespace="default"
+    dyn_client,
+    api_version,
+    kind,
+    name,
+    namespace="default",
+    informer: "Informer | None" = None,
 ) -> ResourceInstance | None:
-    resource = await k8s_resource(dyn_client, api_version, kind)
-    obj = await resource.get(name=name, namespace=namespace)
+    if informer and informer.synced:
+        obj = informer.get(name)
+        if obj is not None:
+            return obj
+        # The cache may not have caught up with an object that was just created
+        log.debug(f"{kind}/{name} not in {informer}, reading from the API server")
+    obj = await k8s_request(
+        dyn_client,
+        api_version,
+        kind,
+        lambda resource: resource.get(name=name, namespace=namespace),
+    )
     if obj.kind == "Status":
         if obj.code == 404:
             return None
-        raise RuntimeError(f"Unexpected status: {obj}")
+        raise KubernetesStatusError(f"Unexpected status getting {kind}/{name}", obj)
     return obj
 
 
@@ -269,11 +748,58 @@ async def get_resource_by_labels(
     kind,
     labels: dict[str, str] = {},
     namespace="default",
+    informer: "Informer | None" = None,
 ) -> list[ResourceInstance]:
-    resource = await k8s_resource(dyn_client, api_version, kind)
+    if informer and informer.synced:
+        return informer.by_labels(labels)
     label_selector = ",".join(f"{k}={v}" for (k, v) in labels.items())
+    return await get_resource_by_selector(
+        dyn_client, api_version, kind, label_selector, namespace
+    )
+
 
-    obj = await resource.get(label_selector=label_selector, namespace=namespace)
+async def get_resource_by_selector(
+    dyn_client: DynamicClient,
+    api_version: str,
+    kind: str,
+    label_selector: str,
+    namespace: str = "default",
+) -> list[ResourceInstance]:
+    obj = await k8s_request(
+        dyn_client,
+        api_version,
+        kind,
+        lambda resource: resource.get(
+            label_selector=label_selector, namespace=namespace
+        ),
+    )
+    if obj.kind == "Status":
+        raise KubernetesStatusError(f"Unexpected status listing {kind}", obj)
     if not obj.kind.endswith("List"):
         raise RuntimeError(f"Unexpected object: {obj}")
     return obj.items
+
+
+async def patch_object(
+    dyn_client: DynamicClient, s: ManifestSummary, body: YamlT
+) -> ResourceInstance | None:
+    """
+    Merge patch an object, returns None if the patch conflicted, e.g. because
+    body includes a metadata.resourceVersion that's no longer current.
+    """
+    obj = await k8s_request(
+        dyn_client,
+        s.api_version,
+        s.kind,
+        lambda resource: resource.patch(
+            body=body,
+            name=s.name,
+            namespace=s.namespace,
+            content_type="application/merge-patch+json",
+        ),
+    )
+    if obj.kind == "Status":
+        if obj.code == 409:
+            return None
+        raise KubernetesStatusError(f"Unexpected status patching {s}", obj)
+    return obj
@@ -0,0 +1,176 @@
+# Prometheus metrics
+#
+# These are registered in the default registry used by JupyterHub, so they're
+# included in /hub/metrics, e.g. as jupyterhub_kubetemplatespawner_poll_duration_seconds
+
+from jupyterhub.metrics import (
+    metrics_prefix,
+    spawn_duration_buckets,
+    stop_duration_buckets,
+)
+from prometheus_client import Counter, Gauge, Histogram
+
+SUBSYSTEM = "kubetemplatespawner"
+
+RENDER_DURATION_SECONDS = Histogram(
+    "render_duration_seconds",
+    "Time taken to render templates, including cached renders",
+    ["instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+RENDER_QUEUE_DEPTH = Gauge(
+    "render_queue_depth",
+    "Number of renders waiting for a slot in the render queue",
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+RENDER_QUEUE_WAIT_SECONDS = Histogram(
+    "render_queue_wait_seconds",
+    "Time renders waited for a slot in the render queue",
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+DEPLOY_DURATION_SECONDS = Histogram(
+    "deploy_duration_seconds",
+    "Time taken to deploy an object and wait for it to be ready",
+    ["kind", "instance"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+READY_DURATION_SECONDS = Histogram(
+    "ready_duration_seconds",
+    "Time taken for a deployed object to become ready",
+    ["kind", "instance"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+CONNECTION_DURATION_SECONDS = Histogram(
+    "connection_duration_seconds",
+    "Time taken to look up the object used to connect to a server",
+    ["kind", "instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+DELETE_DURATION_SECONDS = Histogram(
+    "delete_duration_seconds",
+    "Time taken to delete an object",
+    ["kind", "instance"],
+    buckets=stop_duration_buckets,
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+POLL_DURATION_SECONDS = Histogram(
+    "poll_duration_seconds",
+    "Time taken to poll a server",
+    ["instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+HELM_FAILURES = Counter(
+    "helm_failures",
+    "Number of failed template renders",
+    ["instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+TIMEOUTS = Counter(
+    "timeouts",
+    "Number of timeouts waiting for an object to be ready or deleted",
+    ["operation", "kind", "instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+API_ERRORS = Counter(
+    "api_errors",
+    "Number of errors returned by the Kubernetes API",
+    ["operation", "kind", "instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+INFORMER_STALENESS_SECONDS = Gauge(
+    "informer_staleness_seconds",
+    "Seconds since an informer's cache was last updated, infinite if not synced",
+    ["kind", "namespace", "label_selector"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+API_REQUESTS = Counter(
+    "api_requests",
+    "Number of Kubernetes API requests by spawner operation",
+    ["operation", "verb", "resource", "instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+API_REQUESTS_PER_OPERATION = Histogram(
+    "api_requests_per_operation",
+    "Number of Kubernetes API requests made by each spawner operation",
+    ["operation", "instance"],
+    buckets=[0, 1, 2, 5, 10, 20, 50, 100, 200],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+RATE_LIMIT_QUEUED_SECONDS = Histogram(
+    "rate_limit_queued_seconds",
+    "Time Kubernetes API requests are queued by the client-side rate limiter",
+    ["lane"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+API_THROTTLED = Counter(
+    "api_throttled",
+    "Number of Kubernetes API requests rejected with 429 Too Many Requests",
+    ["lane"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+START_DURATION_SECONDS = Histogram(
+    "start_duration_seconds",
+    "Time taken to start a server, by whether it was claimed from a warm pool",
+    ["source", "instance"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+WARM_POOL_CLAIMS = Counter(
+    "warm_pool_claims",
+    "Number of attempts to claim a server from a warm pool",
+    ["result", "profile", "instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+IMAGE_PREPULL_SPAWN_IMAGES = Counter(
+    "image_prepull_spawn_images",
+    "Number of images used by spawns, by whether they were pre-pulled",
+    ["prepulled", "instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
+
+IMAGE_PREPULL_IMAGES = Gauge(
+    "image_prepull_images",
+    "Number of images pulled onto all nodes by the pre-puller",
+    ["instance"],
+    namespace=metrics_prefix,
+    subsystem=SUBSYSTEM,
+)
@@ -0,0 +1,276 @@
+# Warm pool of servers deployed before they're needed
+#
+# Each pool slot is a full set of objects rendered from the chart with
+# placeholder user values and labelled as unassigned. A spawn claims a ready
+# slot by relabelling its objects with the user's values, so it doesn't have to
+# wait for scheduling or image pulls, and the pool is then replenished in the
+# background. Claims use the connection object's resourceVersion as a
+# precondition so a slot can't be claimed twice.
+
+import asyncio
+from collections.abc import Awaitable, Callable, Coroutine
+from copy import deepcopy
+from datetime import UTC, datetime
+from typing import Any
+from uuid import uuid4
+
+from kubernetes_asyncio.dynamic import DynamicClient
+from tornado.log import app_log as log
+
+from ._kubernetes import (
+    ManifestSummary,
+    YamlT,
+    get_resource_by_selector,
+    manifest_summary,
+    object_is_ready,
+    patch_object,
+)
+
+POOL_LABEL = "kubetemplatespawner/warm-pool"
+SLOT_LABEL = "kubetemplatespawner/warm-pool-slot"
+STATE_LABEL = "kubetemplatespawner/warm-pool-state"
+UNASSIGNED = "unassigned"
+CLAIMED = "claimed"
+
+# A Secret with this annotation receives the user's environment when the slot
+# is claimed, since the environment of a running container can't be changed
+ENV_ANNOTATION = "kubetemplatespawner/warm-pool-env"
+
+# Deletes one object without waiting
+DeleteObject = Callable[[ManifestSummary], Coroutine[Any, Any, None]]
+
+USER_LABELS = ["hub.jupyter.org/username", "hub.jupyter.org/servername"]
+USER_ANNOTATIONS = ["hub.jupyter.org/username"]
+
+
+def slot_names(slot: str) -> dict[str, str]:
+    """Placeholder user and server names for a pool slot"""
+    username = f"warm-pool-{slot}"
+    return dict(
+        unescaped_username=username,
+        unescaped_servername="",
+        escaped_username=username,
+        escaped_servername="",
+        escaped_user_server=username,
+    )
+
+
+def label_slot(manifests: list[YamlT], profile: str, slot: str) -> list[YamlT]:
+    """Add the pool labels to a slot's manifests"""
+    labelled = deepcopy(manifests)
+    for m in labelled:
+        labels = m["metadata"].setdefault("labels", {})
+        labels[POOL_LABEL] = profile
+        labels[SLOT_LABEL] = slot
+        labels[STATE_LABEL] = UNASSIGNED
+    return labelled
+
+
+def claim_patch(
+    manifest: YamlT, names: dict[str, str], env: dict[str, str] | None = None
+) -> YamlT:
+    """
+    Merge patch that assigns an object to a user.
+    Only user labels and annotations that are already present are changed.
+    """
+    metadata = manifest["metadata"]
+    labels = {STATE_LABEL: CLAIMED}
+    for key, name in zip(USER_LABELS, ["escaped_username", "escaped_servername"]):
+        if key in (metadata.get("labels") or {}):
+            labels[key] = names[name]
+    annotations = {}
+    for key in USER_ANNOTATIONS:
+        if key in (metadata.get("annotations") or {}):
+            annotations[key] = names["unescaped_username"]
+    patch: YamlT = {"metadata": {"labels": labels}}
+    if annotations:
+        patch["metadata"]["annotations"] = annotations
+    if env is not None and is_env_secret(manifest):
+        patch["stringData"] = env
+    return patch
+
+
+def is_env_secret(manifest: YamlT) -> bool:
+    annotations = manifest["metadata"].get("annotations") or {}
+    return manifest["kind"] == "Secret" and annotations.get(ENV_ANNOTATION) == "true"
+
+
+def claimed_manifests(manifests: list[YamlT], names: dict[str, str]) -> list[YamlT]:
+    """A slot's manifests as they are after being claimed, without the env"""
+    claimed = deepcopy(manifests)
+    for m in claimed:
+        patch = claim_patch(m, names)["metadata"]
+        m["metadata"]["labels"].update(patch["labels"])
+        m["metadata"].setdefault("annotations", {}).update(patch.get("annotations", {}))
+    return claimed
+
+
+class WarmPool:
+    """
+    Unassigned servers for one instance, namespace and profile.
+
+    render(slot) returns the manifests for a slot including the pool labels,
+    deploy(manifest) deploys one object and waits for it to be ready, and
+    delete(summary) deletes one object without waiting.
+
+    Slots that fail to deploy, or aren't ready within timeout seconds, are
+    deleted so they aren't counted as unassigned forever.
+    """
+
+    def __init__(self, instance: str, namespace: str, profile: str):
+        self.instance = instance
+        self.namespace = namespace
+        self.profile = profile
+        self.claimed = 0
+        self.misses = 0
+        self.deleted = 0
+        # Slots that are being deployed by this process
+        self.deploying: set[str] = set()
+        # (template path, chart digest) -> connection object of any slot
+        self.connections: dict[tuple[str, str], ManifestSummary] = {}
+        self._fill_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    def __repr__(self) -> str:
+        return f"WarmPool({self.instance} {self.namespace} {self.profile})"
+
+    def selector(self, state: str) -> str:
+        return (
+            f"app.kubernetes.io/instance={self.instance},"
+            f"{POOL_LABEL}={self.profile},{STATE_LABEL}={state}"
+        )
+
+    async def unassigned(
+        self, dyn_client: DynamicClient, connection: ManifestSummary
+    ) -> list:
+        """Unassigned connection objects, ready or not"""
+        return await get_resource_by_selector(
+            dyn_client,
+            connection.api_version,
+            connection.kind,
+            self.selector(UNASSIGNED),
+            self.namespace,
+        )
+
+    async def claim(
+        self,
+        dyn_client: DynamicClient,
+        connection: ManifestSummary,
+        names: dict[str, str],
+    ) -> str | None:
+        """
+        Claim the connection object of a ready slot for a user.
+        Returns the slot, or None if no slot is ready.
+        """
+        async with self._lock:
+            objs = await self.unassigned(dyn_client, connection)
+            ready = [obj for obj in objs if object_is_ready(obj)]
+            for obj in sorted(ready, key=lambda o: o.metadata.creationTimestamp):
+                s = ManifestSummary(
+                    connection.api_version,
+                    connection.kind,
+                    obj.metadata.name,
+                    self.namespace,
+                )
+                patch = claim_patch(obj.to_dict(), names)
+                patch["metadata"]["resourceVersion"] = obj.metadata.resourceVersion
+                if await patch_object(dyn_client, s, patch):
+                    self.claimed += 1
+                    return obj.metadata.labels[SLOT_LABEL]
+                log.info(f"{self} slot {s.name} claimed by someone else")
+        self.misses += 1
+        return None
+
+    async def delete_slot(
+        self,
+        manifests: list[YamlT],
+        delete: DeleteObject,
+    ) -> None:
+        """Delete all objects of a slot, e.g. if it was only partly claimed"""
+        results = await asyncio.gather(
+            *(delete(manifest_summary(m)) for m in manifests), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                log.warning(f"{self} failed to delete slot object: {result}")
+        self.deleted += 1
+
+    def _expired(self, obj: Any, timeout: float) -> bool:
+        """Is a slot not being deployed by us and not ready after timeout?"""
+        if obj.metadata.labels[SLOT_LABEL] in self.deploying or object_is_ready(obj):
+            return False
+        created = datetime.fromisoformat(obj.metadata.creationTimestamp)
+        return (datetime.now(UTC) - created).total_seconds() > timeout
+
+    def replenish(
+        self,
+        dyn_client: DynamicClient,
+        connection: ManifestSummary,
+        size: int,
+        timeout: float,
+        render: Callable[[str], Awaitable[list[YamlT]]],
+        deploy: Callable[[YamlT], Coroutine[Any, Any, None]],
+        delete: DeleteObject,
+    ) -> None:
+        """Deploy slots in the background until there are size unassigned"""
+        if self._fill_task and not self._fill_task.done():
+            return
+        self._fill_task = asyncio.create_task(
+            self._fill(dyn_client, connection, size, timeout, render, deploy, delete)
+        )
+
+    async def _fill(
+        self,
+        dyn_client: DynamicClient,
+        connection: ManifestSummary,
+        size: int,
+        timeout: float,
+        render: Callable[[str], Awaitable[list[YamlT]]],
+        deploy: Callable[[YamlT], Coroutine[Any, Any, None]],
+        delete: DeleteObject,
+    ) -> None:
+        try:
+            existing = []
+            for obj in await self.unassigned(dyn_client, connection):
+                if self._expired(obj, timeout):
+                    slot = obj.metadata.labels[SLOT_LABEL]
+                    log.warning(f"{self} slot {slot} isn't ready, deleting it")
+                    await self.delete_slot(await render(slot), delete)
+                else:
+                    existing.append(obj)
+            missing = size - len(existing)
+            if missing <= 0:
+                return
+            log.info(f"{self} deploying {missing} servers")
+
+            async def deploy_slot() -> None:
+                slot = uuid4().hex[:8]
+                self.deploying.add(slot)
+                manifests: list[YamlT] = []
+                try:
+                    manifests = await render(slot)
+                    async with asyncio.TaskGroup() as tg:
+                        for manifest in manifests:
+                            tg.create_task(deploy(manifest))
+                except Exception:
+                    log.exception(f"{self} failed to deploy slot {slot}, deleting it")
+                    await self.delete_slot(manifests, delete)
+                finally:
+                    self.deploying.discard(slot)
+
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(missing):
+                    tg.create_task(deploy_slot())
+        except Exception:
+            log.exception(f"{self} failed to deploy servers")
+
+
+# (event loop, instance, namespace, profile) -> WarmPool
+_warm_pools: dict[tuple, WarmPool] = {}
+
+
+def shared_warm_pool(instance: str, namespace: str, profile: str) -> WarmPool:
+    key = (asyncio.get_running_loop(), instance, namespace, profile)
+    if key not in _warm_pools:
+        _warm_pools[key] = WarmPool(instance, namespace, profile)
+    return _warm_pools[key]
@@ -0,0 +1,304 @@
+# Pre-pulling of frequently used images
+#
+# The images in each spawn's manifests are recorded, and the most frequently
+# used images over a recent window are pulled onto every node by a DaemonSet,
+# in the same way as the Zero to JupyterHub image puller: each image is an init
+# container that exits immediately, followed by a pause container. Spawns that
+# only use pre-pulled images don't have to wait for an image pull.
+
+import asyncio
+from collections import Counter, deque
+from collections.abc import Callable, Coroutine, Iterable
+from time import monotonic
+from typing import Any
+
+from tornado.log import app_log as log
+
+from ._kubernetes import ManifestSummary, YamlT
+from ._metrics import IMAGE_PREPULL_IMAGES, IMAGE_PREPULL_SPAWN_IMAGES
+
+# Kinds with a pod template in spec.template, CronJob is handled separately
+POD_TEMPLATE_KINDS = {
+    "DaemonSet",
+    "Deployment",
+    "Job",
+    "ReplicaSet",
+    "ReplicationController",
+    "StatefulSet",
+}
+
+COMPONENT = "image-prepuller"
+
+
+def pod_specs(manifest: YamlT) -> list[YamlT]:
+    """Pod specs in a manifest, including pod templates"""
+    kind = manifest.get("kind")
+    spec = manifest.get("spec") or {}
+    if kind == "Pod":
+        return [spec]
+    if kind == "CronJob":
+        spec = (spec.get("jobTemplate") or {}).get("spec") or {}
+    elif kind not in POD_TEMPLATE_KINDS:
+        return []
+    template_spec = (spec.get("template") or {}).get("spec")
+    return [template_spec] if template_spec else []
+
+
+def manifest_images(manifests: Iterable[YamlT]) -> list[str]:
+    """Unique container images used by manifests, in order of appearance"""
+    images: dict[str, None] = {}
+    for manifest in manifests:
+        for spec in pod_specs(manifest):
+            for key in ("initContainers", "containers"):
+                for container in spec.get(key) or []:
+                    if container.get("image"):
+                        images[container["image"]] = None
+    return list(images)
+
+
+def manifest_pull_secrets(manifests: Iterable[YamlT]) -> list[str]:
+    """Unique imagePullSecrets used by manifests"""
+    secrets: dict[str, None] = {}
+    for manifest in manifests:
+        for spec in pod_specs(manifest):
+            for secret in spec.get("imagePullSecrets") or []:
+                if secret.get("name"):
+                    secrets[secret["name"]] = None
+    return list(secrets)
+
+
+def prepuller_daemonset(
+    name: str,
+    namespace: str,
+    instance: str,
+    images: list[str],
+    pull_secrets: list[str],
+    pause_image: str,
+) -> YamlT:
+    labels = {
+        "app.kubernetes.io/instance": instance,
+        "app.kubernetes.io/component": COMPONENT,
+    }
+    pod_spec: YamlT = {
+        "automountServiceAccountToken": False,
+        "terminationGracePeriodSeconds": 0,
+        "initContainers": [
+            {
+                # Named by position so a changed image replaces the old one
+                "name": f"image-{i}",
+                "image": image,
+                "command": ["/bin/sh", "-c", "echo Pulling complete"],
+                "resources": {"requests": {"cpu": "0", "memory": "0"}},
+            }
+            for (i, image) in enumerate(images)
+        ],
+        "containers": [
+            {
+                "name": "pause",
+                "image": pause_image,
+                "resources": {"requests": {"cpu": "0", "memory": "0"}},
+            }
+        ],
+    }
+    if pull_secrets:
+        pod_spec["imagePullSecrets"] = [{"name": s} for s in pull_secrets]
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": name, "namespace": namespace, "labels": labels},
+        "spec": {
+            "selector": {"matchLabels": labels},
+            "updateStrategy": {
+                "type": "RollingUpdate",
+                "rollingUpdate": {"maxUnavailable": "100%"},
+            },
+            "template": {"metadata": {"labels": labels}, "spec": pod_spec},
+        },
+    }
+
+
+class ImagePlanner:
+    """
+    Frequency of images in spawns over the last `window` seconds.
+    """
+
+    def __init__(self, window: float = 3600):
+        self.window = window
+        # (monotonic time, images, pull secrets) for each spawn
+        self._spawns: deque[tuple[float, list[str], list[str]]] = deque()
+
+    def __len__(self) -> int:
+        return len(self._spawns)
+
+    def record(self, images: list[str], pull_secrets: list[str]) -> None:
+        self._spawns.append((monotonic(), images, pull_secrets))
+        self._expire()
+
+    def _expire(self) -> None:
+        cutoff = monotonic() - self.window
+        while self._spawns and self._spawns[0][0] < cutoff:
+            self._spawns.popleft()
+
+    def frequencies(self) -> Counter[str]:
+        self._expire()
+        return Counter(image for (_, images, _) in self._spawns for image in images)
+
+    def top(self, k: int, candidates: Iterable[str] = ()) -> list[str]:
+        """
+        The k most frequent images, ties broken by name.
+        If there are fewer than k, candidates are added in order.
+        """
+        counts = self.frequencies()
+        ranked = sorted(counts, key=lambda image: (-counts[image], image))
+        for image in candidates:
+            if image not in counts:
+                ranked.append(image)
+                counts[image] = 0
+        return ranked[:k]
+
+    def pull_secrets(self, images: Iterable[str]) -> list[str]:
+        """Pull secrets of recent spawns that used any of images"""
+        wanted = set(images)
+        secrets: dict[str, None] = {}
+        for _, spawn_images, spawn_secrets in self._spawns:
+            if wanted.intersection(spawn_images):
+                secrets.update(dict.fromkeys(spawn_secrets))
+        return list(secrets)
+
+
+class ImagePrePuller:
+    """
+    Pre-puller DaemonSet for one instance and namespace.
+
+    `images` are the images in the deployed DaemonSet, and `pulled` are the
+    images that were pulled onto all nodes when it was last ready. `removed`
+    is True once the DaemonSet has been deleted because there are no images
+    to pull, it may have been left by an earlier Hub process.
+    """
+
+    def __init__(self, instance: str, namespace: str):
+        self.instance = instance
+        self.namespace = namespace
+        self.planner = ImagePlanner()
+        self.images: list[str] = []
+        self.pulled: frozenset[str] = frozenset()
+        self.removed = False
+        self._updated = float("-inf")
+        self._update_task: asyncio.Task | None = None
+
+    def __repr__(self) -> str:
+        return f"ImagePrePuller({self.instance} {self.namespace})"
+
+    @property
+    def name(self) -> str:
+        return f"{self.instance}-{COMPONENT}"
+
+    @property
+    def summary(self) -> ManifestSummary:
+        return ManifestSummary("apps/v1", "DaemonSet", self.name, self.namespace)
+
+    def record(self, manifests: list[YamlT]) -> tuple[int, int]:
+        """
+        Record the images used by a spawn.
+        Returns the number of images that were pre-pulled, and the total.
+        """
+        images = manifest_images(manifests)
+        self.planner.record(images, manifest_pull_secrets(manifests))
+        covered = sum(1 for image in images if image in self.pulled)
+        IMAGE_PREPULL_SPAWN_IMAGES.labels("true", self.instance).inc(covered)
+        IMAGE_PREPULL_SPAWN_IMAGES.labels("false", self.instance).inc(
+            len(images) - covered
+        )
+        return covered, len(images)
+
+    def update(
+        self,
+        count: int,
+        interval: float,
+        pause_image: str,
+        candidates: Iterable[str],
+        deploy: Callable[[YamlT], Coroutine[Any, Any, None]],
+        delete: Callable[[ManifestSummary], Coroutine[Any, Any, None]],
+    ) -> None:
+        """
+        Deploy the DaemonSet in the background if the top images have changed,
+        at most once every interval seconds. If there are no images, for
+        instance because count is 0, the DaemonSet is deleted instead.
+
+        The number of images never decreases, since if there are fewer than
+        count recent images the images already being pulled are kept, followed
+        by candidates. This avoids unnecessary rollouts, and leftover init
+        containers when the DaemonSet is updated with a strategic merge patch.
+        """
+        if self._update_task and not self._update_task.done():
+            return
+        if monotonic() - self._updated < interval:
+            return
+        images: list[str] = []
+        if count > 0:
+            images = sorted(self.planner.top(count, [*self.images, *candidates]))
+        if not images:
+            if not self.removed:
+                self._updated = monotonic()
+                self._update_task = asyncio.create_task(self._delete(delete))
+            return
+        if images == self.images:
+            return
+        self._updated = monotonic()
+        manifest = prepuller_daemonset(
+            self.name,
+            self.namespace,
+            self.instance,
+            images,
+            self.planner.pull_secrets(images),
+            pause_image,
+        )
+        self._update_task = asyncio.create_task(self._deploy(images, manifest, deploy))
+
+    async def _deploy(
+        self,
+        images: list[str],
+        manifest: YamlT,
+        deploy: Callable[[YamlT], Coroutine[Any, Any, None]],
+    ) -> None:
+        log.info(f"{self} pre-pulling {images}")
+        previous = self.images
+        self.images = images
+        # Images are still cached on nodes while old pods are replaced
+        self.pulled = self.pulled.intersection(images)
+        try:
+            await deploy(manifest)
+        except Exception:
+            log.exception(f"{self} failed to deploy")
+            # Retry at the next update
+            self.images = previous
+            return
+        self.pulled = frozenset(images)
+        self.removed = False
+        IMAGE_PREPULL_IMAGES.labels(self.instance).set(len(images))
+
+    async def _delete(
+        self, delete: Callable[[ManifestSummary], Coroutine[Any, Any, None]]
+    ) -> None:
+        log.info(f"{self} has no images to pre-pull, deleting {self.name}")
+        try:
+            await delete(self.summary)
+        except Exception:
+            log.exception(f"{self} failed to delete")
+            # Retry at the next update
+            return
+        self.images = []
+        self.pulled = frozenset()
+        self.removed = True
+        IMAGE_PREPULL_IMAGES.labels(self.instance).set(0)
+
+
+# (event loop, instance, namespace) -> ImagePrePuller
+_prepullers: dict[tuple, ImagePrePuller] = {}
+
+
+def shared_image_prepuller(instance: str, namespace: str) -> ImagePrePuller:
+    key = (asyncio.get_running_loop(), instance, namespace)
+    if key not in _prepullers:
+        _prepullers[key] = ImagePrePuller(instance, namespace)
+    return _prepullers[key]
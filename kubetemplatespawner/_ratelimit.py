@@ -0,0 +1,170 @@
+# Client-side rate limiting of Kubernetes API requests
+#
+# All requests made by the shared client go through a token bucket shared by
+# every spawner in the Hub process. Requests that have to wait are queued in
+# priority lanes so that user-facing starts go ahead of background polls, and
+# stops (e.g. by the idle culler) go last. A 429 response from API Priority and
+# Fairness pauses all requests for its Retry-After period and is then retried.
+
+import asyncio
+import heapq
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from itertools import count
+from time import monotonic, time
+from typing import Any
+
+from kubernetes_asyncio.client.rest import ApiException
+from tornado.log import app_log as log
+
+from ._accounting import current_operation
+from ._metrics import API_THROTTLED, RATE_LIMIT_QUEUED_SECONDS
+
+
+class Lane(IntEnum):
+    """Priority of queued requests, lowest value first"""
+
+    START = 0
+    POLL = 1
+    STOP = 2
+
+
+# Spawner operation -> lane, anything else including background requests is
+# treated as a poll
+OPERATION_LANES = {
+    "start": Lane.START,
+    "poll": Lane.POLL,
+    "stop": Lane.STOP,
+    "stop_many": Lane.STOP,
+    "delete_forever": Lane.STOP,
+}
+
+
+def operation_lane(operation: str) -> Lane:
+    return OPERATION_LANES.get(operation, Lane.POLL)
+
+
+def parse_retry_after(value: str | None, default: float = 1) -> float:
+    """Seconds from a Retry-After header, either a number or an HTTP date"""
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter with priority lanes.
+
+    Tokens are added at `qps` per second up to `burst`. If qps is 0 requests
+    aren't limited, but are still paused after a 429 response. Waiting requests
+    are released in lane order, and in arrival order within a lane.
+    """
+
+    def __init__(self, qps: float = 0, burst: int = 10, max_retries: int = 5):
+        self.qps = qps
+        self.burst = burst
+        # Maximum number of times a request is retried after a 429
+        self.max_retries = max_retries
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        # (lane, sequence, future) of waiting requests
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = count()
+        self._dispatcher: asyncio.Task | None = None
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for (_, _, f) in self._waiters if not f.done())
+
+    def pause(self, seconds: float) -> None:
+        """Don't release any requests for this many seconds"""
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    def _delay(self) -> float:
+        """Seconds until a request can be released"""
+        now = monotonic()
+        delay = max(self._paused_until - now, 0)
+        if self.qps > 0:
+            elapsed = now - self._updated
+            self._tokens = min(self.burst, self._tokens + elapsed * self.qps)
+            self._updated = now
+            if self._tokens < 1:
+                delay = max(delay, (1 - self._tokens) / self.qps)
+        return delay
+
+    def _take(self) -> None:
+        if self.qps > 0:
+            self._tokens -= 1
+
+    async def acquire(self, lane: Lane) -> float:
+        """Wait until a request can be made, returns the seconds queued"""
+        if not self._waiters and self._delay() == 0:
+            self._take()
+            return 0
+
+        start = monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._sequence), future))
+        if not self._dispatcher or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+        return monotonic() - start
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            delay = self._delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            # Skip requests that were cancelled while queued
+            if not future.done():
+                self._take()
+                future.set_result(None)
+
+
+def rate_limit(rest_client: Any, limiter: RateLimiter) -> None:
+    """Rate limit all requests made by a kubernetes_asyncio RESTClientObject"""
+    request = rest_client.request
+
+    async def limited_request(*args, **kwargs) -> Any:
+        lane = operation_lane(current_operation())
+        attempt = 0
+        headers: Any
+        while True:
+            queued = await limiter.acquire(lane)
+            RATE_LIMIT_QUEUED_SECONDS.labels(lane.name.lower()).observe(queued)
+            try:
+                r = await request(*args, **kwargs)
+            except ApiException as e:
+                if e.status != 429 or attempt >= limiter.max_retries:
+                    raise
+                headers = e.headers or {}
+            else:
+                # Dynamic client requests return the response without raising
+                if getattr(r, "status", None) != 429 or attempt >= limiter.max_retries:
+                    return r
+                headers = r.headers
+                r.release()
+            attempt += 1
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+            API_THROTTLED.labels(lane.name.lower()).inc()
+            log.warning(
+                f"Kubernetes API throttled request, retrying in {retry_after}s "
+                f"(attempt {attempt})"
+            )
+            limiter.pause(retry_after)
+
+    rest_client.request = limited_request
+
+
+# Shared by all spawners in this process
+rate_limiter = RateLimiter()
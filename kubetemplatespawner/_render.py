@@ -0,0 +1,651 @@
+# Helpers for rendering templates, separated from the spawner to make testing easier
+
+import asyncio
+import hashlib
+import json
+import re
+import shutil
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from copy import deepcopy
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from time import monotonic
+
+import yaml
+from tornado.log import app_log as log
+
+from ._gotemplate import Chart, TemplateError, TemplateUnsupported
+from ._kubernetes import SafeDumper, YamlT, load_manifests
+from ._metrics import RENDER_QUEUE_DEPTH, RENDER_QUEUE_WAIT_SECONDS
+
+
+def _chart_stat(path: str) -> tuple:
+    files = sorted(p for p in Path(path).rglob("*") if p.is_file())
+    return tuple((str(p), p.stat().st_mtime_ns, p.stat().st_size) for p in files)
+
+
+# chart path -> (file stats, content digest)
+_chart_digests: dict[str, tuple[tuple, str]] = {}
+
+
+def chart_digest(path: str) -> str:
+    """
+    Content hash of all files in a chart.
+    Only re-read if any file's modification time or size has changed.
+    """
+    stat = _chart_stat(path)
+    cached = _chart_digests.get(path)
+    if cached and cached[0] == stat:
+        return cached[1]
+
+    h = hashlib.sha256()
+    for filename, _, _ in stat:
+        h.update(str(Path(filename).relative_to(path)).encode())
+        h.update(b"\0")
+        h.update(Path(filename).read_bytes())
+        h.update(b"\0")
+    digest = h.hexdigest()
+    if cached:
+        log.info(f"Chart {path} has changed")
+    _chart_digests[path] = (stat, digest)
+    return digest
+
+
+def values_digest(vars: dict[str, YamlT]) -> str:
+    """Hash of template values, independent of key order"""
+    canonical = json.dumps(vars, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+# Rendered output larger than this is parsed in a thread, so large charts don't
+# block the event loop. Smaller output is parsed in less time than it takes to
+# hand it to a thread.
+PARSE_IN_THREAD_SIZE = 16 * 1024
+
+
+async def parse_manifests(text: str | bytes) -> list[YamlT]:
+    """Non-empty documents in rendered YAML"""
+    if len(text) > PARSE_IN_THREAD_SIZE:
+        return await asyncio.to_thread(load_manifests, text)
+    return load_manifests(text)
+
+
+class RenderError(RuntimeError):
+    """Templates couldn't be rendered"""
+
+
+class Renderer:
+    """
+    Renders a chart directory with template values to a list of manifests.
+    One instance of each renderer class is shared by all spawners.
+    """
+
+    async def render(self, path: str, vars: dict[str, YamlT]) -> list[YamlT]:
+        raise NotImplementedError()
+
+    async def close(self) -> None:
+        """Release any resources held by the renderer"""
+
+
+class HelmRenderer(Renderer):
+    """Runs `helm template` for each render, requires the helm binary"""
+
+    async def render(self, path: str, vars: dict[str, YamlT]) -> list[YamlT]:
+        with NamedTemporaryFile(suffix=".yaml", mode="w") as values:
+            yaml.dump(vars, values, Dumper=SafeDumper)
+            values.flush()
+            cmd = ["helm", "template", path, "-f", values.name]
+            log.info(f"Running command {cmd}")
+            helm = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stdout, stderr = await helm.communicate()
+        if helm.returncode != 0:
+            raise RenderError(f"Templating failed: {stderr.decode()}")
+        return await parse_manifests(stdout)
+
+
+class GoTemplateRenderer(Renderer):
+    """
+    Renders charts in process with a subset of Go templates and Sprig
+    functions, without running helm. Charts are parsed once, and parsed again
+    if any file in the chart changes.
+
+    Charts that use anything that isn't implemented, such as subcharts or
+    other Sprig functions, are rendered with HelmRenderer instead. If helm
+    isn't installed rendering fails.
+    """
+
+    def __init__(self) -> None:
+        # chart path -> (chart digest, parsed chart)
+        self._charts: dict[str, tuple[str, Chart]] = {}
+        # chart path -> digest of a chart that's rendered by helm
+        self._unsupported: dict[str, str] = {}
+        self._helm = HelmRenderer()
+
+    def chart(self, path: str) -> Chart:
+        digest = chart_digest(path)
+        cached = self._charts.get(path)
+        if cached and cached[0] == digest:
+            return cached[1]
+        chart = Chart(path)
+        self._charts[path] = (digest, chart)
+        return chart
+
+    def _render(self, path: str, vars: dict[str, YamlT]) -> list[YamlT]:
+        try:
+            return self.chart(path).render(vars)
+        except TemplateUnsupported:
+            raise
+        except TemplateError as e:
+            raise RenderError(f"Templating failed: {e}") from e
+
+    async def render(self, path: str, vars: dict[str, YamlT]) -> list[YamlT]:
+        if self._unsupported.get(path) == chart_digest(path):
+            return await self._helm.render(path, vars)
+        # Rendering and parsing the output takes as long as parsing helm output,
+        # so it's also done in a thread to avoid blocking the event loop
+        try:
+            return await asyncio.to_thread(self._render, path, vars)
+        except TemplateUnsupported as e:
+            if not shutil.which("helm"):
+                raise RenderError(
+                    f"{path} can't be rendered without helm, which isn't installed: {e}"
+                ) from e
+            log.warning(f"{path} can't be rendered without helm, using helm: {e}")
+            self._unsupported[path] = chart_digest(path)
+            return await self._helm.render(path, vars)
+
+
+# Renderer class -> shared instance
+_renderers: dict[type[Renderer], Renderer] = {}
+
+
+def shared_renderer(cls: type[Renderer]) -> Renderer:
+    if cls not in _renderers:
+        _renderers[cls] = cls()
+    return _renderers[cls]
+
+
+class _Waiter:
+    __slots__ = ("future", "on_position", "position")
+
+    def __init__(
+        self, future: asyncio.Future, on_position: Callable[[int], None] | None
+    ):
+        self.future = future
+        self.on_position = on_position
+        # Last position the waiter was told
+        self.position = 0
+
+
+class RenderQueue:
+    """
+    First-in first-out limit on the number of concurrent renders.
+
+    Waiters are told their position in the queue when it changes, at most once
+    every notify_interval seconds, since every waiter moves up each time a
+    render finishes.
+    """
+
+    def __init__(self, max_concurrent: int = 4, notify_interval: float = 1):
+        self.max_concurrent = max_concurrent
+        self.notify_interval = notify_interval
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._waiters: deque[_Waiter] = deque()
+        self._last_notify = 0.0
+        self._notify_handle: asyncio.TimerHandle | None = None
+        self._notify_loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def depth(self) -> int:
+        """Number of renders waiting for a slot"""
+        return len(self._waiters)
+
+    def _notify_positions(self) -> None:
+        self._notify_handle = None
+        self._last_notify = monotonic()
+        for position, waiter in enumerate(self._waiters, 1):
+            if waiter.on_position and waiter.position != position:
+                waiter.position = position
+                waiter.on_position(position)
+
+    def _positions_changed(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._notify_handle and self._notify_loop is loop:
+            # Already scheduled
+            return
+        delay = self._last_notify + self.notify_interval - monotonic()
+        if delay <= 0:
+            self._notify_positions()
+        else:
+            self._notify_handle = loop.call_later(delay, self._notify_positions)
+            self._notify_loop = loop
+
+    def _release(self) -> None:
+        self.running -= 1
+        while self._waiters and self.running < self.max_concurrent:
+            waiter = self._waiters.popleft()
+            if not waiter.future.done():
+                self.running += 1
+                waiter.future.set_result(None)
+        if self._waiters:
+            self._positions_changed()
+
+    @asynccontextmanager
+    async def slot(
+        self, on_position: Callable[[int], None] | None = None
+    ) -> AsyncIterator[None]:
+        """
+        Wait for a free slot.
+        on_position(n) is called with the queue position if the caller has to wait.
+        """
+        start = monotonic()
+        if self.running < self.max_concurrent and not self._waiters:
+            self.running += 1
+        else:
+            waiter = _Waiter(asyncio.get_running_loop().create_future(), on_position)
+            self._waiters.append(waiter)
+            if on_position:
+                waiter.position = len(self._waiters)
+                on_position(waiter.position)
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._positions_changed()
+                elif waiter.future.done() and not waiter.future.cancelled():
+                    # A slot was handed over after we were cancelled
+                    self._release()
+                raise
+
+        wait = monotonic() - start
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        RENDER_QUEUE_WAIT_SECONDS.observe(wait)
+        try:
+            yield
+        finally:
+            self.completed += 1
+            self._release()
+
+
+class RenderCache:
+    """
+    Bounded LRU cache of rendered manifests.
+
+    Keyed by a digest of the chart directory contents and a digest of the
+    template values, so a changed chart file never returns stale manifests.
+    Concurrent renders of the same key share a single render.
+
+    get() leaves secrets that change on every spawn (SECRET_ENV) out of the
+    key and the cache. They're rendered as placeholders and substituted
+    afterwards, if a check when a chart is first seen shows that's possible.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[str, str], list[YamlT]] = OrderedDict()
+        self._pending: dict[tuple[str, str], asyncio.Future] = {}
+        # chart digest -> whether secrets can be substituted after rendering
+        self._substitutable: dict[str, bool] = {}
+        self._checking: dict[str, asyncio.Future] = {}
+
+    def key(self, path: str, vars: dict[str, YamlT]) -> tuple[str, str]:
+        return chart_digest(path), values_digest(vars)
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._substitutable.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def manifests(self) -> list[list[YamlT]]:
+        """Cached manifests, most recently used first. Don't modify them."""
+        return list(reversed(self._cache.values()))
+
+    async def get_or_render(
+        self,
+        key: tuple[str, str],
+        render: Callable[[], Awaitable[list[YamlT]]],
+    ) -> list[YamlT]:
+        """Return a copy of the cached manifests for key, calling render if missing"""
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return deepcopy(self._cache[key])
+
+        task = self._pending.get(key)
+        if task:
+            self.hits += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._render(key, render))
+            self._pending[key] = task
+        # Don't let a cancelled caller cancel a render that others are waiting for
+        return deepcopy(await asyncio.shield(task))
+
+    async def _render(
+        self,
+        key: tuple[str, str],
+        render: Callable[[], Awaitable[list[YamlT]]],
+    ) -> list[YamlT]:
+        try:
+            manifests = await render()
+        finally:
+            self._pending.pop(key, None)
+        self._put(key, manifests)
+        return manifests
+
+    def _put(self, key: tuple[str, str], manifests: list[YamlT]) -> None:
+        if self.maxsize > 0:
+            self._cache[key] = manifests
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    async def _check_substitution(
+        self,
+        path: str,
+        vars: dict[str, YamlT],
+        render: Callable[[dict[str, YamlT]], Awaitable[list[YamlT]]],
+    ) -> bool:
+        digest = chart_digest(path)
+        try:
+            renders = [secret_values(vars, variant) for variant in (0, 1)]
+            docs = await asyncio.gather(*(render(v) for (v, _) in renders))
+            check_skeleton(docs, [p for (_, p) in renders])
+            self._put(self.key(path, renders[0][0]), docs[0])
+            supported = True
+        except SkeletonUnsupported as e:
+            log.warning(f"Not caching renders of {path} with secrets: {e}")
+            supported = False
+        finally:
+            self._checking.pop(digest, None)
+        self._substitutable[digest] = supported
+        return supported
+
+    async def get(
+        self,
+        path: str,
+        vars: dict[str, YamlT],
+        render: Callable[[dict[str, YamlT]], Awaitable[list[YamlT]]],
+    ) -> list[YamlT]:
+        """Return manifests for vars from the cache, calling render(vars) if missing"""
+        fixed, placeholders = secret_values(vars, 0)
+        if placeholders:
+            digest = chart_digest(path)
+            supported = self._substitutable.get(digest)
+            if supported is None:
+                task = self._checking.get(digest)
+                if not task:
+                    task = asyncio.ensure_future(
+                        self._check_substitution(path, vars, render)
+                    )
+                    self._checking[digest] = task
+                supported = await asyncio.shield(task)
+            if not supported:
+                self.misses += 1
+                return await render(vars)
+        manifests = await self.get_or_render(
+            self.key(path, fixed), lambda: render(fixed)
+        )
+        if not placeholders:
+            return manifests
+        return substitute(manifests, placeholders, vars)
+
+
+# Shared by all spawners in this process
+render_queue = RenderQueue()
+render_cache = RenderCache()
+
+RENDER_QUEUE_DEPTH.set_function(lambda: render_queue.depth)
+
+
+# Environment variables that are different for every spawn
+SECRET_ENV = ("JUPYTERHUB_API_TOKEN", "JPY_API_TOKEN")
+
+# Template values that differ between users and servers
+USER_KEYS = (
+    "userid",
+    "username",
+    "base_url",
+    "unescaped_username",
+    "unescaped_servername",
+    "escaped_username",
+    "escaped_servername",
+    "escaped_user_server",
+)
+
+
+class SkeletonUnsupported(Exception):
+    """The chart output can't be produced by substituting user values"""
+
+
+def _placeholder(index: int, value: YamlT, variant: int) -> str | int:
+    # Placeholders must survive Helm functions such as quote, and be valid in
+    # Kubernetes names. The two variants have different lengths so that
+    # truncation of a user value is detected. Helm prints numbers of 1e6 or
+    # more in exponent form, so integer placeholders are kept below that.
+    if isinstance(value, int) and not isinstance(value, bool):
+        return 910000 + variant * 10000 + index
+    if variant == 0:
+        return f"ktsph{index}x"
+    return f"ktsph{index}x".ljust(48, "z")
+
+
+def _user_values(vars: dict[str, YamlT]) -> dict[tuple[str, ...], YamlT]:
+    """
+    Values to be replaced by placeholders, keyed by their path in vars.
+    Empty values are left alone since charts may test them, e.g. a named server.
+    """
+    values: dict[tuple[str, ...], YamlT] = {}
+    for key in USER_KEYS:
+        if vars.get(key) not in (None, ""):
+            values[(key,)] = vars[key]
+    for key, value in (vars.get("env") or {}).items():
+        if isinstance(value, str) and value:
+            values[("env", key)] = value
+    return values
+
+
+def _secret_values(vars: dict[str, YamlT]) -> dict[tuple[str, ...], YamlT]:
+    values: dict[tuple[str, ...], YamlT] = {}
+    env = vars.get("env") or {}
+    for key in SECRET_ENV:
+        if isinstance(env.get(key), str) and env[key]:
+            values[("env", key)] = env[key]
+    return values
+
+
+def skeleton_values(
+    vars: dict[str, YamlT], variant: int
+) -> tuple[dict[str, YamlT], dict[str | int, tuple[str, ...]]]:
+    """
+    Replace user values with placeholders.
+    Returns the template values and a map of placeholder to path in vars.
+    """
+    return _replace_values(vars, _user_values(vars), variant)
+
+
+def secret_values(
+    vars: dict[str, YamlT], variant: int
+) -> tuple[dict[str, YamlT], dict[str | int, tuple[str, ...]]]:
+    """Replace secrets that change on every spawn with placeholders"""
+    return _replace_values(vars, _secret_values(vars), variant)
+
+
+def _replace_values(
+    vars: dict[str, YamlT], values: dict[tuple[str, ...], YamlT], variant: int
+) -> tuple[dict[str, YamlT], dict[str | int, tuple[str, ...]]]:
+    vars = deepcopy(vars)
+    placeholders: dict[str | int, tuple[str, ...]] = {}
+    for index, (path, value) in enumerate(values.items()):
+        p = _placeholder(index, value, variant)
+        placeholders[p] = path
+        if len(path) == 1:
+            vars[path[0]] = p
+        else:
+            vars[path[0]][path[1]] = p
+    return vars, placeholders
+
+
+def skeleton_key(path: str, vars: dict[str, YamlT]) -> tuple[str, str]:
+    """Charts rendered with the same non-user values share a skeleton"""
+    fixed, placeholders = skeleton_values(vars, 0)
+    return chart_digest(path), values_digest(
+        {"values": fixed, "placeholders": sorted(map(str, placeholders))}
+    )
+
+
+def _walk(obj: YamlT, scalar: Callable[[YamlT], YamlT], key: Callable) -> YamlT:
+    if isinstance(obj, dict):
+        return {key(k): _walk(v, scalar, key) for (k, v) in obj.items()}
+    if isinstance(obj, list):
+        return [_walk(v, scalar, key) for v in obj]
+    return scalar(obj)
+
+
+def _replacer(replacements: dict[str | int, YamlT]) -> Callable[[YamlT], YamlT]:
+    if not replacements:
+        return lambda v: v
+    pattern = re.compile(
+        "|".join(
+            re.escape(str(p)) for p in sorted(replacements, key=lambda p: -len(str(p)))
+        )
+    )
+    as_str = {str(p): v for (p, v) in replacements.items()}
+
+    def replace(value: YamlT) -> YamlT:
+        if isinstance(value, (str, int)) and value in replacements:
+            # Whole scalar is a placeholder so keep the original type
+            return replacements[value]
+        if isinstance(value, str):
+            return pattern.sub(lambda m: str(as_str[m.group(0)]), value)
+        return value
+
+    return replace
+
+
+def check_skeleton(
+    docs: list[list[YamlT]], placeholders: list[dict[str | int, tuple[str, ...]]]
+) -> None:
+    """
+    Check two renders with different placeholders are identical apart from
+    the placeholders, and that placeholders only occur in values.
+    """
+    normalised = []
+    for d, p in zip(docs, placeholders, strict=True):
+        tokens = {k: f"<{'.'.join(path)}>" for (k, path) in p.items()}
+        replace = _replacer(tokens)
+
+        def key(k):
+            if replace(k) != k:
+                raise SkeletonUnsupported(f"User value found in key {k}")
+            return k
+
+        normalised.append(_walk(d, replace, key))
+    if normalised[0] != normalised[1]:
+        raise SkeletonUnsupported("Chart output depends on user values")
+
+
+def substitute(
+    docs: list[YamlT],
+    placeholders: dict[str | int, tuple[str, ...]],
+    vars: dict[str, YamlT],
+) -> list[YamlT]:
+    """Replace placeholders in a skeleton with the values from vars"""
+    replacements = {}
+    for p, path in placeholders.items():
+        value = vars
+        for k in path:
+            value = value[k]
+        replacements[p] = value
+    return _walk(docs, _replacer(replacements), lambda k: k)
+
+
+class SkeletonCache:
+    """
+    Charts rendered once with placeholder user values, so manifests for a
+    user can be produced by substitution instead of running helm.
+
+    Charts whose output changes with the user values in any other way are
+    remembered as unsupported so callers can fall back to a full render.
+    Bounded to maxsize entries, least recently used first out, like
+    RenderCache.
+    """
+
+    def __init__(self, maxsize: int = 256) -> None:
+        self.maxsize = maxsize
+        # key -> (skeleton manifests, placeholders), or None if unsupported
+        self._skeletons: OrderedDict[tuple[str, str], tuple[list, dict] | None] = (
+            OrderedDict()
+        )
+        self._pending: dict[tuple[str, str], asyncio.Future] = {}
+
+    def clear(self) -> None:
+        self._skeletons.clear()
+
+    def __len__(self) -> int:
+        return len(self._skeletons)
+
+    async def _render(
+        self,
+        key: tuple[str, str],
+        vars: dict[str, YamlT],
+        render: Callable[[dict[str, YamlT]], Awaitable[list[YamlT]]],
+    ) -> tuple[list, dict] | None:
+        try:
+            renders = [skeleton_values(vars, variant) for variant in (0, 1)]
+            docs = await asyncio.gather(*(render(v) for (v, _) in renders))
+            placeholders = [p for (_, p) in renders]
+            check_skeleton(docs, placeholders)
+            skeleton: tuple[list, dict] | None = (docs[0], placeholders[0])
+        except SkeletonUnsupported as e:
+            log.warning(f"Skeleton rendering not possible, using full render: {e}")
+            skeleton = None
+        finally:
+            self._pending.pop(key, None)
+        if self.maxsize > 0:
+            self._skeletons[key] = skeleton
+            while len(self._skeletons) > self.maxsize:
+                self._skeletons.popitem(last=False)
+        return skeleton
+
+    async def get(
+        self,
+        path: str,
+        vars: dict[str, YamlT],
+        render: Callable[[dict[str, YamlT]], Awaitable[list[YamlT]]],
+    ) -> list[YamlT] | None:
+        """
+        Return manifests for vars, or None if the chart can't be rendered
+        as a skeleton.
+        """
+        key = skeleton_key(path, vars)
+        if key in self._skeletons:
+            self._skeletons.move_to_end(key)
+            skeleton = self._skeletons[key]
+        else:
+            task = self._pending.get(key)
+            if not task:
+                task = asyncio.ensure_future(self._render(key, vars, render))
+                self._pending[key] = task
+            skeleton = await asyncio.shield(task)
+        if skeleton is None:
+            return None
+        return substitute(skeleton[0], skeleton[1], vars)
+
+
+# Shared by all spawners in this process
+skeleton_cache = SkeletonCache()
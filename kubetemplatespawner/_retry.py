@@ -0,0 +1,63 @@
+# Retry scheduling for loops that wait on the Kubernetes API
+
+import asyncio
+import random
+from time import monotonic
+
+
+class Backoff:
+    """
+    Deadline-based retry schedule with exponential backoff and jitter.
+
+    The first delay is `initial` seconds, and each following delay is `factor`
+    times longer up to `maximum`. Each delay is reduced by a random fraction of
+    up to `jitter` so that spawns started together don't retry in lockstep, and
+    is never longer than the time remaining before the deadline.
+    If timeout is None there's no deadline.
+    """
+
+    initial: float = 0.5
+    maximum: float = 10
+    factor: float = 2
+    jitter: float = 0.5
+
+    def __init__(self, timeout: float | None = None):
+        self.deadline = None if timeout is None else monotonic() + timeout
+        self.attempts = 0
+
+    @property
+    def remaining(self) -> float:
+        """Seconds until the deadline, inf if there's no deadline"""
+        if self.deadline is None:
+            return float("inf")
+        return max(self.deadline - monotonic(), 0)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining <= 0
+
+    def reset(self) -> None:
+        """Start again from the initial delay, e.g. after a success"""
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.initial * self.factor**self.attempts, self.maximum)
+        self.attempts += 1
+        delay *= 1 - random.uniform(0, self.jitter)
+        return min(delay, self.remaining)
+
+    async def sleep(self) -> bool:
+        """Wait before the next attempt, returns False if the deadline has passed"""
+        if self.expired:
+            return False
+        await asyncio.sleep(self.next_delay())
+        return not self.expired
+
+
+def configure_backoff(
+    initial: float, maximum: float, factor: float, jitter: float
+) -> None:
+    Backoff.initial = initial
+    Backoff.maximum = maximum
+    Backoff.factor = factor
+    Backoff.jitter = jitter
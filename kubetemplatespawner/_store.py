@@ -0,0 +1,142 @@
+# Storage of rendered manifests outside the JupyterHub database
+
+import hashlib
+import json
+import os
+import zlib
+from collections.abc import Iterable
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from time import time
+
+from tornado.log import app_log as log
+
+from ._kubernetes import YamlT
+
+
+class ManifestStore:
+    """
+    Content-addressed store of rendered manifests.
+
+    Manifests are serialised as canonical JSON and keyed by their sha256 digest,
+    so identical manifests are only stored once. If `path` is set blobs are
+    written to files in that directory so they survive a Hub restart, and
+    read from there when needed, otherwise they're kept in memory.
+
+    Spawner state that references a blob may be persisted without being loaded
+    in this process, so files aren't deleted when the last reference in this
+    process is released until sweep() has been given the digests of all
+    persisted state. sweep() deletes files that nothing references.
+
+    A missing blob isn't an error, callers should render the manifests again.
+    """
+
+    def __init__(self, path: str | None = None, compress: bool = True):
+        self.path = path
+        self.compress = compress
+        # digest -> serialised (optionally compressed) manifests, if not in a file
+        self._blobs: dict[str, bytes] = {}
+        # digest -> number of references
+        self._refs: dict[str, int] = {}
+        # Digests in persisted state when last swept, None if not swept
+        self._persisted: set[str] | None = None
+
+    def __len__(self) -> int:
+        return len(self._refs)
+
+    @property
+    def swept(self) -> bool:
+        return self._persisted is not None
+
+    @property
+    def size(self) -> int:
+        """Total bytes of blobs held in memory"""
+        return sum(len(b) for b in self._blobs.values())
+
+    def _file(self, digest: str) -> Path:
+        assert self.path
+        return Path(self.path) / f"{digest}.json"
+
+    @staticmethod
+    def _decode(blob: bytes) -> list[YamlT]:
+        # Serialised manifests are a JSON list, anything else is compressed
+        if not blob.startswith(b"["):
+            blob = zlib.decompress(blob)
+        return json.loads(blob)
+
+    def put(self, manifests: list[YamlT]) -> str:
+        """Store manifests, returns their digest and adds a reference"""
+        data = json.dumps(manifests, sort_keys=True, separators=(",", ":")).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        blob = zlib.compress(data) if self.compress else data
+        if not self.path:
+            self._blobs.setdefault(digest, blob)
+        elif not self._file(digest).exists():
+            Path(self.path).mkdir(parents=True, exist_ok=True)
+            with NamedTemporaryFile(dir=self.path, delete=False) as f:
+                f.write(blob)
+            os.replace(f.name, self._file(digest))
+        self.acquire(digest)
+        return digest
+
+    def get(self, digest: str) -> list[YamlT] | None:
+        """Manifests for a digest, or None if not found"""
+        blob = self._blobs.get(digest)
+        if blob is None and self.path:
+            try:
+                blob = self._file(digest).read_bytes()
+            except FileNotFoundError:
+                pass
+        if blob is None:
+            return None
+        try:
+            return self._decode(blob)
+        except (ValueError, zlib.error):
+            log.exception(f"Invalid manifests {digest}")
+            return None
+
+    def acquire(self, digest: str) -> None:
+        """Add a reference to a digest, e.g. when loaded from spawner state"""
+        self._refs[digest] = self._refs.get(digest, 0) + 1
+
+    def release(self, digest: str) -> None:
+        """
+        Remove a reference, deleting the blob if it was the last one and it
+        isn't referenced by persisted state
+        """
+        refs = self._refs.get(digest, 0) - 1
+        if refs > 0:
+            self._refs[digest] = refs
+            return
+        self._refs.pop(digest, None)
+        self._blobs.pop(digest, None)
+        if self.path and self._persisted is not None:
+            if digest not in self._persisted:
+                self._file(digest).unlink(missing_ok=True)
+
+    def sweep(self, persisted: Iterable[str], min_age: float = 3600) -> int:
+        """
+        Delete files that aren't referenced by persisted spawner state or in
+        this process. Files modified in the last min_age seconds are kept, in
+        case another Hub process has stored them but not yet persisted its
+        state. Returns the number of files deleted.
+        """
+        self._persisted = set(persisted)
+        if not self.path or not Path(self.path).is_dir():
+            return 0
+        keep = self._persisted.union(self._refs)
+        cutoff = time() - min_age
+        deleted = 0
+        for f in Path(self.path).glob("*.json"):
+            try:
+                if f.stem not in keep and f.stat().st_mtime < cutoff:
+                    f.unlink()
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+        log.info(f"Deleted {deleted} unreferenced manifests from {self.path}")
+        return deleted
+
+
+# Shared by all spawners in this process
+manifest_store = ManifestStore()
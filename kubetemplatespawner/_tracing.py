@@ -0,0 +1,98 @@
+# Lightweight tracing of spawner operations
+#
+# Spans are only created if an exporter is set, and are passed to the exporter
+# when they end. Exporters can forward spans to a tracing system such as
+# OpenTelemetry, or keep them in memory for testing.
+
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import time
+from typing import Any
+from uuid import uuid4
+
+from tornado.log import app_log as log
+
+
+class Span:
+    """A timed operation, optionally part of a parent operation"""
+
+    def __init__(self, name: str, parent: "Span | None", attributes: dict[str, Any]):
+        self.name = name
+        self.trace_id: str = parent.trace_id if parent else uuid4().hex
+        self.span_id: str = uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start = time()
+        self.end: float | None = None
+        self.error: str | None = None
+
+    def __repr__(self) -> str:
+        return f"Span({self.name} {self.attributes})"
+
+    @property
+    def duration(self) -> float | None:
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+
+Exporter = Callable[[Span], None]
+
+# The span for the running task. Tasks inherit a copy of the context they're
+# created in, so spans in tasks in a TaskGroup are children of the caller's span.
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Create spans if an exporter is set, otherwise do nothing"""
+
+    def __init__(self, exporter: Exporter | None = None):
+        self.exporter = exporter
+
+    @contextmanager
+    def span(self, name: str, /, **attributes: Any) -> Iterator[Span | None]:
+        if self.exporter is None:
+            yield None
+            return
+
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end = time()
+            try:
+                self.exporter(span)
+            except Exception:
+                log.exception(f"Failed to export {span}")
+
+
+class InMemoryExporter:
+    """Keep finished spans in a list, e.g. for tests"""
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+
+    def __call__(self, span: Span) -> None:
+        self.spans.append(span)
+
+    def clear(self) -> None:
+        self.spans.clear()
+
+    def children(self, span: Span) -> list[Span]:
+        return [s for s in self.spans if s.parent_id == span.span_id]
+
+    def by_name(self, name: str) -> list[Span]:
+        return [s for s in self.spans if s.name == name]
+
+
+# Shared by all spawners in this process
+tracer = Tracer()
@@ -3,47 +3,115 @@ import re
 from datetime import UTC, datetime
 from enum import StrEnum
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from time import monotonic
 from typing import (
     Any,
     AsyncGenerator,
 )
 
-import yaml
+from jupyterhub import orm
 from jupyterhub.spawner import Spawner
-from kubernetes_asyncio.client import ApiClient
+from kubernetes_asyncio.client.rest import ApiException
 from kubernetes_asyncio.dynamic import DynamicClient
 
 # from .slugs import multi_slug, safe_slug
 from kubespawner.slugs import multi_slug, safe_slug
+from sqlalchemy.orm import object_session
 from traitlets import (
+    Bool,
     Callable,
     Dict,
+    Enum,
+    Float,
     Int,
     List,
     TraitError,
+    Type,
     Unicode,
     Union,
     default,
     validate,
 )
 
+from ._accounting import api_operation
+from ._helmworker import configure_helm_workers
+from ._informer import (
+    EVENT_BUFFER_SIZE,
+    EventSubscription,
+    Informer,
+    deletion_reaper,
+    poll_lister,
+    put_dropping_oldest,
+    shared_event_watcher,
+    shared_informer,
+)
 from ._kubernetes import (
+    KubernetesStatusError,
+    KubernetesTimeout,
+    ManifestSummary,
     ResourceInstance,
     YamlT,
+    configure_discovery_cache,
+    deletable,
+    delete_collection,
     delete_manifest,
+    deletion_batches,
+    deletion_tier,
     deploy_manifest,
     get_deletions_by_labels,
     get_resource_by_name,
+    get_resource_by_selector,
     load_config,
     manifest_summary,
-    stream_events,
+    patch_object,
+    shared_dynamic_client,
+)
+from ._metrics import (
+    API_ERRORS,
+    CONNECTION_DURATION_SECONDS,
+    DELETE_DURATION_SECONDS,
+    DEPLOY_DURATION_SECONDS,
+    HELM_FAILURES,
+    POLL_DURATION_SECONDS,
+    READY_DURATION_SECONDS,
+    RENDER_DURATION_SECONDS,
+    START_DURATION_SECONDS,
+    TIMEOUTS,
+    WARM_POOL_CLAIMS,
+)
+from ._pool import (
+    DeleteObject,
+    WarmPool,
+    claim_patch,
+    claimed_manifests,
+    is_env_secret,
+    label_slot,
+    shared_warm_pool,
+    slot_names,
 )
+from ._prepull import manifest_images, shared_image_prepuller
+from ._ratelimit import rate_limiter
+from ._render import (
+    HelmRenderer,
+    Renderer,
+    RenderError,
+    chart_digest,
+    render_cache,
+    render_queue,
+    shared_renderer,
+    skeleton_cache,
+)
+from ._retry import configure_backoff
+from ._store import manifest_store
+from ._tracing import tracer
 from ._version import __version__
 
 # alphanumeric chars, space, some punctuation
 SERVER_NAME_PATTERN = r"^[\w \.\-\+_]*$"
 
+# Maximum number of usernames in a single label selector used by stop_many
+STOP_MANY_CHUNK_SIZE = 100
+
 
 class LifeCyclePolicy(StrEnum):
     USER_DELETED = "user-deleted"
@@ -127,7 +195,382 @@ class KubeTemplateSpawner(Spawner):
         ),
     )
 
-    k8s_timeout = Int(config=True, help="Kubernetes API timeout")
+    renderer_class = Type(
+        HelmRenderer,
+        klass=Renderer,
+        config=True,
+        help=(
+            "Class used to render templates. "
+            "kubetemplatespawner.HelmRenderer runs `helm template`. "
+            "kubetemplatespawner.GoTemplateRenderer renders charts in the Hub "
+            "process without helm, but only supports a subset of Go templates "
+            "and Sprig functions, and doesn't support subcharts. Charts that "
+            "need anything else are rendered with helm if it's installed. "
+            "kubetemplatespawner.HelmWorkerRenderer renders charts with "
+            "persistent helm worker processes, see helm_worker_command."
+        ),
+    )
+
+    helm_worker_command = List(
+        Unicode(),
+        ["kubetemplatespawner-helm-worker"],
+        config=True,
+        help=(
+            "Command to start a helm worker for HelmWorkerRenderer, the chart path "
+            "is appended"
+        ),
+    )
+
+    helm_workers = Int(
+        1,
+        config=True,
+        help="Number of helm worker processes for each chart",
+    )
+
+    helm_worker_timeout = Float(
+        60,
+        config=True,
+        help=(
+            "Seconds to wait for a helm worker to start or render, before "
+            "it's restarted"
+        ),
+    )
+
+    helm_worker_health_check_interval = Float(
+        30,
+        config=True,
+        help="Seconds between helm worker health checks, 0 to disable",
+    )
+
+    render_cache_size = Int(
+        256,
+        config=True,
+        help=(
+            "Maximum number of rendered templates cached in memory, shared by all "
+            "spawners. The JupyterHub API token isn't cached, it's substituted "
+            "into the cached manifests. Also limits the number of skeletons "
+            "kept when render_skeleton is enabled. Set to 0 to disable."
+        ),
+    )
+
+    max_concurrent_renders = Int(
+        4,
+        config=True,
+        help=(
+            "Maximum number of templates rendered at the same time, shared by all "
+            "spawners. Further renders are queued."
+        ),
+    )
+
+    render_skeleton = Bool(
+        False,
+        config=True,
+        help=(
+            "Render the chart once with placeholder user values, and produce "
+            "manifests for each user by substituting their values. "
+            "The chart is rendered twice with different placeholders, and if "
+            "the two outputs differ other than in the placeholders, e.g. because "
+            "of string functions or conditionals that the placeholders trigger, "
+            "a full render is used instead. Conditionals on user values that "
+            "give the same output for both placeholders aren't detected."
+        ),
+    )
+
+    warm_pool_sizes = Dict(
+        value_trait=Int(),
+        default_value={},
+        config=True,
+        help=(
+            "Number of unassigned servers to keep deployed for each warm pool "
+            "profile, e.g. {'default': 5}. A spawn claims a ready server from "
+            "its profile's pool instead of deploying new objects. "
+            "Pool servers are rendered with placeholder user names, and are "
+            "assigned by changing their user labels and annotations, so they "
+            "can't have per-user storage or other user-specific fields. "
+            "The user's environment is written to a Secret in the pool server "
+            "with the annotation kubetemplatespawner/warm-pool-env=true, which "
+            "the server must wait for."
+        ),
+    )
+
+    warm_pool_profile = Union(
+        [Unicode(), Callable()],
+        default_value="default",
+        allow_none=True,
+        config=True,
+        help=(
+            "Warm pool profile of a spawner, or a callable "
+            "`def warm_pool_profile(spawner: Spawner) -> str | None`. "
+            "None means the spawner can't use a warm pool."
+        ),
+    )
+
+    image_prepull_count = Int(
+        0,
+        config=True,
+        help=(
+            "Number of images to pull onto every node in advance, chosen from "
+            "the images most frequently used by recent spawns. The images are "
+            "pulled by a DaemonSet {instance_name}-image-prepuller in the "
+            "spawner namespace. Images must include /bin/sh. "
+            "Set to 0 to disable."
+        ),
+    )
+
+    image_prepull_window = Float(
+        3600,
+        config=True,
+        help="Seconds of recent spawns used to choose images to pre-pull",
+    )
+
+    image_prepull_interval = Float(
+        300,
+        config=True,
+        help="Minimum seconds between updates of the image pre-puller DaemonSet",
+    )
+
+    image_prepull_timeout = Float(
+        600,
+        config=True,
+        help="Seconds to wait for the image pre-puller DaemonSet to be ready",
+    )
+
+    image_prepull_pause_image = Unicode(
+        "registry.k8s.io/pause:3.10",
+        config=True,
+        help="Image for the container that keeps the image pre-puller pods running",
+    )
+
+    manifest_store_path = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help=(
+            "Directory for storing rendered manifests so they survive a Hub "
+            "restart. Only a digest of the manifests is stored in the JupyterHub "
+            "database. If not set manifests are held in memory, and rendered "
+            "again if needed after a restart. Files that no spawner state "
+            "references are deleted when the Hub starts, so the directory "
+            "mustn't be shared with a Hub that uses a different database."
+        ),
+    )
+
+    manifest_store_compress = Bool(
+        True,
+        config=True,
+        help="Compress stored manifests",
+    )
+
+    trace_exporter = Callable(
+        None,
+        allow_none=True,
+        config=True,
+        help=(
+            "Callable that is passed each finished tracing span, "
+            "`def trace_exporter(span: kubetemplatespawner._tracing.Span) -> None`. "
+            "Spans cover start, rendering, deploying and waiting for each object, "
+            "Kubernetes events and connection lookups. "
+            "Tracing is disabled if not set."
+        ),
+    )
+
+    k8s_timeout = Int(
+        config=True,
+        help=(
+            "Seconds to wait for Kubernetes objects to be deployed and ready, or "
+            "deleted. This is a deadline that includes the time taken by API "
+            "requests. Default is start_timeout."
+        ),
+    )
+
+    k8s_retry_initial_interval = Float(
+        0.5,
+        config=True,
+        help=(
+            "Seconds before retrying a failed Kubernetes API watch or request "
+            "when waiting for objects"
+        ),
+    )
+
+    k8s_retry_max_interval = Float(
+        10,
+        config=True,
+        help="Maximum seconds between Kubernetes API retries",
+    )
+
+    k8s_retry_backoff_factor = Float(
+        2,
+        config=True,
+        help="Multiply the interval between Kubernetes API retries by this factor",
+    )
+
+    k8s_retry_jitter = Float(
+        0.5,
+        config=True,
+        help=(
+            "Reduce each interval between Kubernetes API retries by a random "
+            "fraction up to this value, so that retries of concurrent spawns "
+            "are spread out"
+        ),
+    )
+
+    @validate("k8s_retry_jitter")
+    def _validate_k8s_retry_jitter(self, proposal):
+        jitter = proposal["value"]
+        if not 0 <= jitter <= 1:
+            raise TraitError("k8s_retry_jitter must be between 0 and 1")
+        return jitter
+
+    k8s_config_file = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help=(
+            "Path to a kubeconfig file. "
+            "Default is the in-cluster config, or ~/.kube/config"
+        ),
+    )
+
+    k8s_max_connections = Int(
+        100,
+        config=True,
+        help=(
+            "Maximum number of concurrent connections to the Kubernetes API. "
+            "All spawners share a single client and connection pool."
+        ),
+    )
+
+    k8s_api_qps = Float(
+        0,
+        config=True,
+        help=(
+            "Maximum sustained rate of Kubernetes API requests per second, "
+            "shared by all spawners. Requests over the limit are queued with "
+            "starts ahead of polls, and stops last. Set to 0 for no limit. "
+            "Requests rejected by the API server with 429 Too Many Requests are "
+            "always retried after the Retry-After period."
+        ),
+    )
+
+    k8s_api_burst = Int(
+        10,
+        config=True,
+        help="Number of Kubernetes API requests allowed above k8s_api_qps in a burst",
+    )
+
+    k8s_max_concurrent_lists = Int(
+        8,
+        config=True,
+        help=(
+            "Maximum number of concurrent list requests made by each spawner "
+            "when searching for objects to delete"
+        ),
+    )
+
+    k8s_delete_propagation_policy = Enum(
+        ["Foreground", "Background", "Orphan"],
+        default_value=None,
+        allow_none=True,
+        config=True,
+        help=(
+            "Kubernetes propagation policy for deleting dependent objects. "
+            "Default is the API server default for each kind."
+        ),
+    )
+
+    k8s_delete_grace_period = Int(
+        None,
+        allow_none=True,
+        config=True,
+        help=(
+            "Seconds to wait for objects to terminate gracefully when deleted. "
+            "Default is the object's own grace period."
+        ),
+    )
+
+    k8s_delete_background = Bool(
+        False,
+        config=True,
+        help=(
+            "Return from stop as soon as delete requests are accepted, instead of "
+            "waiting for the objects to be removed. Completion is tracked in the "
+            "background, and a new start waits for any of its objects that are "
+            "still being deleted."
+        ),
+    )
+
+    k8s_server_side_apply = Bool(
+        False,
+        config=True,
+        help=(
+            "Deploy objects using Kubernetes server-side apply, one request per "
+            "object, with field manager kubetemplatespawner-<instance_name>. "
+            "Default is to get each object and then patch or create it."
+        ),
+    )
+
+    k8s_apply_force_conflicts = Bool(
+        False,
+        config=True,
+        help=(
+            "Take ownership of fields managed by another field manager when using "
+            "server-side apply. If False a conflict fails the spawn."
+        ),
+    )
+
+    informer_enabled = Bool(
+        False,
+        config=True,
+        help=(
+            "Keep an in-memory copy of this instance's Kubernetes objects using "
+            "shared list and watch requests, and use it for poll lookups instead "
+            "of querying the API server. Start and stop still query the API "
+            "server, since the cache may lag behind objects created or deleted "
+            "moments earlier. "
+            "Requires list and watch permissions on all templated kinds."
+        ),
+    )
+
+    informer_resync_period = Float(
+        300,
+        config=True,
+        help="Seconds between full re-lists of objects by the in-memory cache",
+    )
+
+    poll_batch_window = Float(
+        0,
+        config=True,
+        help=(
+            "Combine poll() requests made within this many seconds into a single "
+            "list request per kind, shared by all spawners. "
+            "Set to 0 to make a separate request for each poll."
+        ),
+    )
+
+    k8s_discovery_ttl = Float(
+        600,
+        config=True,
+        help="Seconds before the cached Kubernetes API discovery is refreshed",
+    )
+
+    k8s_discovery_negative_ttl = Float(
+        60,
+        config=True,
+        help=(
+            "Seconds to remember that an apiVersion/kind doesn't exist, "
+            "e.g. because a CRD isn't installed"
+        ),
+    )
+
+    k8s_discovery_cache_file = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help=(
+            "File to persist Kubernetes API discovery results across Hub restarts. "
+            "Default is a file in the system temporary directory."
+        ),
+    )
 
     @default("k8s_timeout")
     def _default_k8s_timeout(self):
@@ -155,39 +598,155 @@ class KubeTemplateSpawner(Spawner):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        # Queue for Kubernetes events that are shown to the user
+        # Queue for Kubernetes events that are shown to the user, bounded like
+        # EventSubscription so it can't grow if progress() isn't being read
         # https://asyncio.readthedocs.io/en/latest/producer_consumer.html
-        self.events = asyncio.Queue()
-
-        self._manifests: list[dict[str, YamlT]] = []
-        self._connection_manifest: dict[str, YamlT] | None = None
-        load_config()
+        self.events = asyncio.Queue(EVENT_BUFFER_SIZE)
+        self.events_dropped = 0
+
+        # Digest of the rendered manifests in the manifest store
+        self._manifests_digest: str | None = None
+        self._summaries: list[ManifestSummary] = []
+        self._connection_summary: ManifestSummary | None = None
+        # monotonic() deadline for deploying objects during start
+        self._k8s_deadline: float | None = None
+        load_config(self.k8s_config_file)
+        configure_discovery_cache(
+            self.k8s_discovery_ttl, self.k8s_discovery_negative_ttl
+        )
+        configure_backoff(
+            self.k8s_retry_initial_interval,
+            self.k8s_retry_max_interval,
+            self.k8s_retry_backoff_factor,
+            self.k8s_retry_jitter,
+        )
+        configure_helm_workers(
+            self.helm_worker_command,
+            self.helm_workers,
+            self.helm_worker_timeout,
+            self.helm_worker_health_check_interval,
+        )
+        render_cache.maxsize = self.render_cache_size
+        skeleton_cache.maxsize = self.render_cache_size
+        render_queue.max_concurrent = self.max_concurrent_renders
+        poll_lister.window = self.poll_batch_window
+        rate_limiter.qps = self.k8s_api_qps
+        rate_limiter.burst = self.k8s_api_burst
+        manifest_store.path = self.manifest_store_path
+        manifest_store.compress = self.manifest_store_compress
+        if self.manifest_store_path and not manifest_store.swept:
+            persisted = self._persisted_manifest_digests()
+            if persisted is not None:
+                manifest_store.sweep(persisted)
+        tracer.exporter = self.trace_exporter
+
+    def _persisted_manifest_digests(self) -> set[str] | None:
+        """
+        Manifest digests in the state of all spawners in the JupyterHub
+        database, or None if there's no database
+        """
+        if not isinstance(self.orm_spawner, orm.Spawner):
+            return None
+        db = object_session(self.orm_spawner)
+        if db is None:
+            return None
+        return {
+            state["manifests_digest"]
+            for (state,) in db.query(orm.Spawner.state)
+            if state and state.get("manifests_digest")
+        }
 
     async def _render_manifests(self, path: str, vars: dict[str, YamlT]) -> list[YamlT]:
-        with NamedTemporaryFile(suffix=".yaml", mode="w") as values:
-            self.log.debug(f"Rendering {path} with {vars}")
-            yaml.dump(vars, values)
-            cmd = ["helm", "template", path, "-f", values.name]
-            self.log.info(f"Running command {cmd}")
-            helm = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
+        with (
+            tracer.span("render_manifests", path=path),
+            RENDER_DURATION_SECONDS.labels(self.instance_name).time(),
+        ):
+            return await self._render_manifests_cached(path, vars)
+
+    async def _render_manifests_cached(
+        self, path: str, vars: dict[str, YamlT]
+    ) -> list[YamlT]:
+        if self.render_skeleton:
+            manifests = await skeleton_cache.get(
+                path, vars, lambda v: self._template(path, v)
             )
-            stdout, stderr = await helm.communicate()
-            if helm.returncode != 0:
-                raise RuntimeError(f"Templating failed: {stderr.decode()}")
-            docs = yaml.safe_load_all(stdout)
+            if manifests is not None:
+                self.log.debug("Rendered manifests from skeleton")
+                return manifests
 
-        return [doc for doc in docs if doc]
+        manifests = await render_cache.get(
+            path, vars, lambda v: self._template(path, v)
+        )
+        self.log.debug(
+            f"Render cache hits={render_cache.hits} misses={render_cache.misses}"
+        )
+        return manifests
+
+    async def _template(self, path: str, vars: dict[str, YamlT]) -> list[YamlT]:
+        renderer = shared_renderer(self.renderer_class)
+        self.log.debug(f"Rendering {path} with {vars}")
+        async with render_queue.slot(self._render_queue_position):
+            try:
+                manifests = await renderer.render(path, vars)
+            except RenderError:
+                HELM_FAILURES.labels(self.instance_name).inc()
+                raise
+        self.log.debug(
+            f"Render queue depth={render_queue.depth} "
+            f"max_wait={render_queue.max_wait:.3f}s "
+            f"total_wait={render_queue.total_wait:.3f}s"
+        )
+        return manifests
+
+    def _render_queue_position(self, position: int) -> None:
+        # Only shown to the user by progress() during a spawn
+        if not self._spawn_pending:
+            return
+        self._put_event(
+            {"message": f"Waiting to render templates (queue position {position})"}
+        )
 
     async def manifests(self) -> list[YamlT]:
-        if self._manifests:
-            self.log.info("Using cached manifests")
-        else:
-            vars = self.template_namespace()
-            self._manifests = await self._render_manifests(self.template_path, vars)
-        return self._manifests
+        if self._manifests_digest:
+            manifests = manifest_store.get(self._manifests_digest)
+            if manifests is not None:
+                self.log.info("Using cached manifests")
+                return manifests
+            self.log.warning(
+                f"Manifests {self._manifests_digest} not found, rendering again"
+            )
+        vars = self.template_namespace()
+        manifests = await self._render_manifests(self.template_path, vars)
+        self._set_manifests(manifests)
+        return manifests
+
+    def _set_manifests(self, manifests: list[YamlT]) -> None:
+        digest = manifest_store.put(manifests)
+        self._release_manifests()
+        self._manifests_digest = digest
+        self._summaries = [manifest_summary(m) for m in manifests]
+        self._connection_summary = self._find_connection_summary(manifests)
+
+    def _find_connection_summary(
+        self, manifests: list[YamlT]
+    ) -> ManifestSummary | None:
+        connection = None
+        for manifest in manifests:
+            annotations = manifest["metadata"].get("annotations") or {}
+            if annotations.get(self.connection_annotation_key) == "true":
+                if connection:
+                    raise ValueError(
+                        f"Multiple manifests with {self.connection_annotation_key}=true found"
+                    )
+                connection = manifest_summary(manifest)
+        return connection
+
+    def _release_manifests(self) -> None:
+        if self._manifests_digest:
+            manifest_store.release(self._manifests_digest)
+        self._manifests_digest = None
+        self._summaries = []
+        self._connection_summary = None
 
     def get_names(self) -> dict[str, str]:
         raw_servername = self.name or ""
@@ -229,8 +788,20 @@ class KubeTemplateSpawner(Spawner):
         )
         return vars
 
-    async def deploy_all_manifests(self, dyn_client: DynamicClient) -> None:
-        """Deploy all manifests concurrently"""
+    @property
+    def field_manager(self) -> str | None:
+        """Server-side apply field manager, or None if not using server-side apply"""
+        if self.k8s_server_side_apply:
+            return f"kubetemplatespawner-{self.instance_name}"
+        return None
+
+    async def deploy_all_manifests(
+        self, dyn_client: DynamicClient, dry_run: bool = False
+    ) -> None:
+        """
+        Deploy all manifests concurrently.
+        If dry_run is set the API server validates the objects without storing them.
+        """
         now = datetime.now(UTC)
         # K8s only supports seconds precision
         # https://github.com/kubernetes/kubernetes/issues/81026
@@ -239,26 +810,114 @@ class KubeTemplateSpawner(Spawner):
         manifests = await self.manifests()
         summaries = [manifest_summary(m) for m in manifests]
         self.log.info(f"Deploying manifests {summaries}")
-        events = asyncio.create_task(
-            stream_events(self.events, summaries, now, self.k8s_timeout)
-        )
+        self._k8s_deadline = monotonic() + self.k8s_timeout
+
+        namespaces = set(s.namespace for s in summaries)
+        if len(namespaces) > 1:
+            raise ValueError("All objects must be in the same namespace")
+        await deletion_reaper.wait(dyn_client, summaries)
+        watcher = shared_event_watcher(dyn_client, namespaces.pop())
+        subscription = watcher.subscribe(summaries, now)
+        events = asyncio.create_task(self._forward_events(subscription))
 
         try:
             async with asyncio.TaskGroup() as tg:
                 for manifest in manifests:
-                    tg.create_task(
-                        deploy_manifest(dyn_client, manifest, self.k8s_timeout)
-                    )
+                    tg.create_task(self._deploy_manifest(dyn_client, manifest, dry_run))
         except ExceptionGroup:
             self.log.exception("Deploy failed")
             raise
         finally:
+            watcher.unsubscribe(subscription)
             events.cancel()
 
         try:
             await events
         except asyncio.CancelledError:
             self.log.info(f"Cancelled: events({summaries})")
+        if subscription.dropped:
+            self.log.warning(f"Dropped {subscription.dropped} events({summaries})")
+
+    async def _deploy_manifest(
+        self, dyn_client: DynamicClient, manifest: YamlT, dry_run: bool
+    ) -> None:
+        kind = manifest["kind"]
+        try:
+            with tracer.span(
+                "deploy_manifest", kind=kind, name=manifest["metadata"]["name"]
+            ):
+                timings = await deploy_manifest(
+                    dyn_client,
+                    manifest,
+                    self._remaining_time(),
+                    field_manager=self.field_manager,
+                    force_conflicts=self.k8s_apply_force_conflicts,
+                    dry_run=dry_run,
+                )
+        except KubernetesTimeout:
+            TIMEOUTS.labels("deploy", kind, self.instance_name).inc()
+            raise
+        except (ApiException, KubernetesStatusError):
+            API_ERRORS.labels("deploy", kind, self.instance_name).inc()
+            raise
+        DEPLOY_DURATION_SECONDS.labels(kind, self.instance_name).observe(
+            timings["total"]
+        )
+        if "ready" in timings:
+            READY_DURATION_SECONDS.labels(kind, self.instance_name).observe(
+                timings["ready"]
+            )
+            self._put_event(
+                {
+                    "message": self._with_remaining_time(
+                        f"{kind}/{manifest['metadata']['name']} is ready"
+                    )
+                }
+            )
+
+    def _remaining_time(self) -> float:
+        """Seconds until the deadline for deploying objects"""
+        if self._k8s_deadline is None:
+            return self.k8s_timeout
+        return max(self._k8s_deadline - monotonic(), 0)
+
+    def _with_remaining_time(self, message: str) -> str:
+        return f"{message} ({self._remaining_time():.0f}s remaining)"
+
+    async def _delete_manifest(
+        self, dyn_client: DynamicClient, s: ManifestSummary, timeout: int
+    ) -> None:
+        try:
+            with DELETE_DURATION_SECONDS.labels(s.kind, self.instance_name).time():
+                deleted = await delete_manifest(
+                    dyn_client,
+                    s,
+                    timeout,
+                    propagation_policy=self.k8s_delete_propagation_policy,
+                    grace_period_seconds=self.k8s_delete_grace_period,
+                )
+        except (ApiException, KubernetesStatusError):
+            API_ERRORS.labels("delete", s.kind, self.instance_name).inc()
+            raise
+        if not deleted:
+            TIMEOUTS.labels("delete", s.kind, self.instance_name).inc()
+
+    def _put_event(self, event: dict[str, str] | None) -> None:
+        """Queue a progress event, dropping the oldest if the queue is full"""
+        if put_dropping_oldest(self.events, event):
+            self.events_dropped += 1
+
+    async def _forward_events(self, subscription: EventSubscription) -> None:
+        with tracer.span("events") as span:
+            count = 0
+            try:
+                async for message in subscription:
+                    self._put_event({"message": self._with_remaining_time(message)})
+                    count += 1
+            finally:
+                if span:
+                    span.set_attribute("events", count)
+                    span.set_attribute("dropped", subscription.dropped)
 
     async def delete_resources(
         self,
@@ -266,31 +925,198 @@ class KubeTemplateSpawner(Spawner):
         labels: dict[str, str],
         annotations: dict[str, str],
     ) -> None:
-        to_delete = []
-        api_kinds = [api_kind.split("/") for api_kind in self.resource_kinds]
-        if not api_kinds:
-            manifests = await self.manifests()
-            for m in manifests:
-                api_kinds.append((m["apiVersion"], m["kind"]))
-
+        api_kinds = await self._deletion_kinds()
         self.log.info(f"Checking {api_kinds} for deletion {labels=} {annotations=}")
-        for api_version, kind in api_kinds:
-            to_delete.extend(
-                await get_deletions_by_labels(
-                    dyn_client, api_version, kind, self.namespace, labels, annotations
+        semaphore = asyncio.Semaphore(self.k8s_max_concurrent_lists)
+
+        async def find(api_version: str, kind: str) -> list[ResourceInstance]:
+            async with semaphore:
+                return await get_deletions_by_labels(
+                    dyn_client,
+                    api_version,
+                    kind,
+                    self.namespace,
+                    labels,
+                    annotations,
                 )
-            )
 
-        summaries = [manifest_summary(obj) for obj in to_delete]
+        async with asyncio.TaskGroup() as tg:
+            found = [tg.create_task(find(*api_kind)) for api_kind in api_kinds]
+
+        summaries = [manifest_summary(obj) for task in found for obj in task.result()]
         self.log.info(f"Deleting manifests {summaries}")
 
-        try:
+        for batch in deletion_batches(summaries):
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    for obj in batch:
+                        tg.create_task(
+                            self._delete_manifest(
+                                dyn_client,
+                                obj,
+                                0 if self.k8s_delete_background else self.k8s_timeout,
+                            )
+                        )
+            except ExceptionGroup:
+                self.log.exception("Delete failed")
+                raise
+            if self.k8s_delete_background:
+                for obj in batch:
+                    deletion_reaper.track(dyn_client, obj, self.k8s_timeout)
+
+    async def _deletion_kinds(self) -> list[tuple[str, str]]:
+        """(apiVersion, kind) of objects that may need to be deleted"""
+        api_kinds = [
+            (api_version, kind)
+            for (api_version, kind) in (k.split("/") for k in self.resource_kinds)
+        ]
+        if not api_kinds:
+            if not self._summaries:
+                await self.manifests()
+            for m in self._summaries:
+                api_kinds.append((m.api_version, m.kind))
+        # Charts often contain several objects of the same kind
+        return list(dict.fromkeys(api_kinds))
+
+    @classmethod
+    async def stop_many(cls, spawners: list["KubeTemplateSpawner"]) -> None:
+        """
+        Delete the objects of many servers, e.g. when culling idle servers.
+
+        Servers are grouped by namespace, kind and server name, and each group
+        is listed with a single label selector. If all listed objects have the
+        server-stopped lifecycle annotation they are removed with one delete
+        collection request, otherwise, or if the hub isn't allowed to delete
+        collections, the deletable objects are deleted individually.
+
+        A delete collection request removes everything matching the selector
+        when it's made, so it isn't used if any of the servers has started
+        spawning since, as it could delete the new server's objects.
+
+        Only the Kubernetes objects are deleted, JupyterHub's record of the
+        servers isn't changed. Options such as timeouts are taken from the
+        first spawner.
+        """
+        if not spawners:
+            return
+        first = spawners[0]
+        with api_operation("stop_many", first.instance_name, first.log):
+            await cls._stop_many(spawners)
+
+    @classmethod
+    async def _stop_many(cls, spawners: list["KubeTemplateSpawner"]) -> None:
+        first = spawners[0]
+        dyn_client = await first._dyn_client()
+
+        # (namespace, api_version, kind, instance, servername, lifecycle key)
+        #   -> usernames
+        groups: dict[tuple[str, str, str, str, str, str], set[str]] = {}
+        # (namespace, instance, servername, username) -> spawners
+        servers: dict[tuple[str, str, str, str], list[KubeTemplateSpawner]] = {}
+        for spawner in spawners:
+            names = spawner.get_names()
+            servers.setdefault(
+                (
+                    spawner.namespace,
+                    spawner.instance_name,
+                    names["escaped_servername"],
+                    names["escaped_username"],
+                ),
+                [],
+            ).append(spawner)
+            for api_version, kind in await spawner._deletion_kinds():
+                key = (
+                    spawner.namespace,
+                    api_version,
+                    kind,
+                    spawner.instance_name,
+                    names["escaped_servername"],
+                    spawner.lifecycle_annotation_key,
+                )
+                groups.setdefault(key, set()).add(names["escaped_username"])
+
+        semaphore = asyncio.Semaphore(first.k8s_max_concurrent_lists)
+        propagation_policy = first.k8s_delete_propagation_policy
+        grace_period_seconds = first.k8s_delete_grace_period
+
+        async def stop_group(
+            key: tuple[str, str, str, str, str, str], usernames: list[str]
+        ) -> list[ManifestSummary]:
+            namespace, api_version, kind, instance, servername, lifecycle_key = key
+            selector = (
+                f"app.kubernetes.io/instance={instance},"
+                f"hub.jupyter.org/servername={servername},"
+                f"hub.jupyter.org/username in ({','.join(usernames)})"
+            )
+            async with semaphore:
+                objs = await get_resource_by_selector(
+                    dyn_client, api_version, kind, selector, namespace
+                )
+            annotations = {lifecycle_key: LifeCyclePolicy.SERVER_STOPPED.value}
+            to_delete = [
+                manifest_summary(obj) for obj in objs if deletable(obj, annotations)
+            ]
+            if not to_delete:
+                return []
+            deleted_collection = False
+            if len(to_delete) == len(objs):
+                async with semaphore:
+                    # Checked immediately before the request, since a spawn may
+                    # have started while waiting
+                    spawning = any(
+                        spawner.pending == "spawn"
+                        for username in usernames
+                        for spawner in servers[
+                            (namespace, instance, servername, username)
+                        ]
+                    )
+                    if spawning:
+                        first.log.info(
+                            f"Deleting {kind} individually, a server is spawning: "
+                            f"{selector}"
+                        )
+                    else:
+                        deleted_collection = await delete_collection(
+                            dyn_client,
+                            api_version,
+                            kind,
+                            namespace,
+                            selector,
+                            propagation_policy=propagation_policy,
+                            grace_period_seconds=grace_period_seconds,
+                        )
+            if not deleted_collection:
+                async with asyncio.TaskGroup() as tg:
+                    for obj in to_delete:
+                        tg.create_task(
+                            delete_manifest(
+                                dyn_client,
+                                obj,
+                                0,
+                                propagation_policy=propagation_policy,
+                                grace_period_seconds=grace_period_seconds,
+                            )
+                        )
+            return to_delete
+
+        for tier in sorted(set(deletion_tier(key[2]) for key in groups)):
             async with asyncio.TaskGroup() as tg:
-                for obj in summaries:
-                    tg.create_task(delete_manifest(dyn_client, obj, self.k8s_timeout))
-        except ExceptionGroup:
-            self.log.exception("Delete failed")
-            raise
+                tasks = []
+                for key, usernames in groups.items():
+                    if deletion_tier(key[2]) != tier:
+                        continue
+                    ordered = sorted(usernames)
+                    for n in range(0, len(ordered), STOP_MANY_CHUNK_SIZE):
+                        chunk = ordered[n : n + STOP_MANY_CHUNK_SIZE]
+                        tasks.append(tg.create_task(stop_group(key, chunk)))
+            deleted = [s for task in tasks for s in task.result()]
+            first.log.info(
+                f"Deleting {len(deleted)} objects for {len(spawners)} servers"
+            )
+            for s in deleted:
+                deletion_reaper.track(dyn_client, s, first.k8s_timeout)
+            if not first.k8s_delete_background:
+                await deletion_reaper.wait(dyn_client, deleted)
 
     def template_namespace(self) -> dict[str, YamlT]:
         d = super().template_namespace()
@@ -319,27 +1145,233 @@ class KubeTemplateSpawner(Spawner):
         return ip, self.port
 
     async def _get_connection_object(
-        self, dyn_client: DynamicClient
-    ) -> ResourceInstance:
-        if not self._connection_manifest:
-            for manifest in await self.manifests():
-                k = (
-                    manifest["metadata"]
-                    .get("annotations")
-                    .get(self.connection_annotation_key)
+        self, dyn_client: DynamicClient, poll: bool = False
+    ) -> ResourceInstance | None:
+        """
+        Polls may read from the informer cache or be batched with other polls.
+        Otherwise, e.g. during start, the object is read from the API server
+        since it may have been created or changed moments ago.
+        """
+        if not self._connection_summary:
+            await self.manifests()
+        m = self._connection_summary
+        if not m:
+            raise ValueError(
+                f"No manifest with {self.connection_annotation_key}=true found"
+            )
+        informer = None
+        if poll:
+            informer = self._informer(dyn_client, m.api_version, m.kind, m.namespace)
+        try:
+            with (
+                tracer.span("get_connection_object", kind=m.kind, name=m.name),
+                CONNECTION_DURATION_SECONDS.labels(m.kind, self.instance_name).time(),
+            ):
+                if (
+                    poll
+                    and self.poll_batch_window > 0
+                    and not (informer and informer.synced)
+                ):
+                    return await poll_lister.get(
+                        dyn_client,
+                        m.api_version,
+                        m.kind,
+                        m.name,
+                        m.namespace,
+                        f"app.kubernetes.io/instance={self.instance_name}",
+                    )
+                return await get_resource_by_name(
+                    dyn_client,
+                    m.api_version,
+                    m.kind,
+                    m.name,
+                    m.namespace,
+                    informer=informer,
                 )
-                if k == "true":
-                    if self._connection_manifest:
-                        raise ValueError(
-                            f"Multiple manifests with {self.connection_annotation_key}=true found"
-                        )
-                    self._connection_manifest = manifest
+        except (ApiException, KubernetesStatusError):
+            API_ERRORS.labels("connection", m.kind, self.instance_name).inc()
+            raise
+
+    def _informer(
+        self, dyn_client: DynamicClient, api_version: str, kind: str, namespace: str
+    ) -> Informer | None:
+        if not self.informer_enabled:
+            return None
+        return shared_informer(
+            dyn_client,
+            api_version,
+            kind,
+            namespace,
+            f"app.kubernetes.io/instance={self.instance_name}",
+            self.informer_resync_period,
+        )
 
-        m = manifest_summary(self._connection_manifest)
-        obj = await get_resource_by_name(
-            dyn_client, m.api_version, m.kind, m.name, m.namespace
+    async def _dyn_client(self) -> DynamicClient:
+        return await shared_dynamic_client(
+            config_file=self.k8s_config_file,
+            max_connections=self.k8s_max_connections,
+            discovery_cache_file=self.k8s_discovery_cache_file,
+        )
+
+    def _warm_pool(self) -> WarmPool | None:
+        profile = self.warm_pool_profile
+        if callable(profile):
+            profile = profile(self)
+        if profile is None or self.warm_pool_sizes.get(profile, 0) <= 0:
+            return None
+        return shared_warm_pool(self.instance_name, self.namespace, profile)
+
+    def _warm_pool_namespace(self, pool: WarmPool, slot: str) -> dict[str, YamlT]:
+        """
+        Template values for a warm pool slot. These are built from scratch since
+        the slot may be claimed by any user, so nothing from the user that
+        triggered the render (base_url, env, extra_vars) can be included.
+        """
+        vars: dict[str, YamlT] = dict(slot_names(slot))
+        vars["username"] = vars["unescaped_username"]
+        vars["userid"] = None
+        vars["instance"] = self.instance_name
+        vars["namespace"] = self.namespace
+        vars["ip"] = self.ip
+        vars["port"] = self.port
+        vars["env"] = {}
+        vars["warm_pool"] = pool.profile
+        return vars
+
+    async def _render_warm_pool_slot(self, pool: WarmPool, slot: str) -> list[YamlT]:
+        """Manifests for a warm pool slot, including the pool labels"""
+        vars = self._warm_pool_namespace(pool, slot)
+        manifests = await self._render_manifests(self.template_path, vars)
+        return label_slot(manifests, pool.profile, slot)
+
+    async def _warm_pool_connection(self, pool: WarmPool) -> ManifestSummary:
+        # The kind is the same for all slots, so it's only rendered once for
+        # each version of the chart
+        key = (self.template_path, chart_digest(self.template_path))
+        connection = pool.connections.get(key)
+        if connection:
+            return connection
+        manifests = await self._render_warm_pool_slot(pool, "0")
+        connection = self._find_connection_summary(manifests)
+        if not connection:
+            raise ValueError(
+                f"No manifest with {self.connection_annotation_key}=true found"
+            )
+        pool.connections[key] = connection
+        return connection
+
+    async def _claim_warm_server(
+        self, dyn_client: DynamicClient, pool: WarmPool, connection: ManifestSummary
+    ) -> bool:
+        """
+        Assign a ready server from the warm pool. Returns False if none is ready,
+        or if it couldn't be assigned, in which case the slot is deleted.
+        """
+        names = self.get_names()
+        slot = await pool.claim(dyn_client, connection, names)
+        if not slot:
+            WARM_POOL_CLAIMS.labels("miss", pool.profile, self.instance_name).inc()
+            return False
+        WARM_POOL_CLAIMS.labels("claimed", pool.profile, self.instance_name).inc()
+        self.log.info(f"Claimed {pool} slot {slot}")
+
+        manifests = await self._render_warm_pool_slot(pool, slot)
+        if not any(is_env_secret(m) for m in manifests):
+            self.log.warning(
+                f"{pool} slot {slot} has no Secret to receive the user's environment"
+            )
+        env = self.get_env()
+        connection_summary = self._find_connection_summary(manifests)
+        patches = [
+            patch_object(dyn_client, s, claim_patch(m, names, env))
+            for m in manifests
+            # Already claimed
+            if (s := manifest_summary(m)) != connection_summary
+        ]
+        results = await asyncio.gather(*patches, return_exceptions=True)
+        failed = [r for r in results if r is None or isinstance(r, Exception)]
+        if failed:
+            # Some objects still have the placeholder user, so the slot can't
+            # be used or returned to the pool
+            self.log.error(f"Failed to claim {pool} slot {slot}: {failed}")
+            WARM_POOL_CLAIMS.labels("failed", pool.profile, self.instance_name).inc()
+            await pool.delete_slot(manifests, self._delete_warm_pool_object(dyn_client))
+            return False
+        self._set_manifests(claimed_manifests(manifests, names))
+        self._put_event({"message": "Assigned a pre-started server"})
+        return True
+
+    def _replenish_warm_pool(
+        self, dyn_client: DynamicClient, pool: WarmPool, connection: ManifestSummary
+    ) -> None:
+        async def deploy(manifest: YamlT) -> None:
+            await deploy_manifest(
+                dyn_client,
+                manifest,
+                self.k8s_timeout,
+                field_manager=self.field_manager,
+                force_conflicts=self.k8s_apply_force_conflicts,
+            )
+
+        pool.replenish(
+            dyn_client,
+            connection,
+            self.warm_pool_sizes[pool.profile],
+            self.k8s_timeout,
+            lambda slot: self._render_warm_pool_slot(pool, slot),
+            deploy,
+            self._delete_warm_pool_object(dyn_client),
+        )
+
+    def _delete_warm_pool_object(self, dyn_client: DynamicClient) -> DeleteObject:
+        async def delete(s: ManifestSummary) -> None:
+            await self._delete_manifest(dyn_client, s, 0)
+            deletion_reaper.track(dyn_client, s, self.k8s_timeout)
+
+        return delete
+
+    async def _update_image_prepuller(self, dyn_client: DynamicClient) -> None:
+        """
+        Record the images used by this spawn, and update the pre-puller.
+        If pre-pulling is disabled the DaemonSet is deleted.
+        """
+        prepuller = shared_image_prepuller(self.instance_name, self.namespace)
+        candidates: list[str] = []
+        if self.image_prepull_count > 0:
+            prepuller.planner.window = self.image_prepull_window
+            covered, total = prepuller.record(await self.manifests())
+            self.log.debug(f"{covered}/{total} images were pre-pulled")
+            # Images from other recent renders, in case there aren't enough spawns
+            candidates = manifest_images(
+                m for manifests in render_cache.manifests() for m in manifests
+            )
+
+        async def deploy(manifest: YamlT) -> None:
+            await deploy_manifest(
+                dyn_client,
+                manifest,
+                self.image_prepull_timeout,
+                field_manager=self.field_manager,
+                force_conflicts=self.k8s_apply_force_conflicts,
+            )
+
+        async def delete(s: ManifestSummary) -> None:
+            try:
+                await self._delete_manifest(dyn_client, s, 0)
+            except KubernetesStatusError as e:
+                # Without permission for DaemonSets there can't be one to delete
+                if e.code != 403 or self.image_prepull_count > 0:
+                    raise
+                self.log.debug(f"Not allowed to delete {s}, skipping")
+
+        prepuller.update(
+            self.image_prepull_count,
+            self.image_prepull_interval,
+            self.image_prepull_pause_image,
+            candidates,
+            deploy,
+            delete,
         )
-        return obj
 
     # JupyterHub Spawner
 
@@ -350,40 +1382,68 @@ class KubeTemplateSpawner(Spawner):
 
     def load_state(self, state: dict) -> None:
         super().load_state(state)
-        # TODO: Assert type of state.get("manifests")
-        self._manifests = state.get("manifests")  # type: ignore[assignment]
-        self._connection_manifest = state.get("connection_manifest")
         kubetemplatespawner_version = state.get("kubetemplatespawner_version")
+        self._release_manifests()
+        if state.get("manifests"):
+            # Older versions stored the full manifests, move them to the store
+            self._set_manifests(state["manifests"])
+            self.log.info(f"Migrated state {kubetemplatespawner_version=}")
+        elif state.get("manifests_digest"):
+            self._manifests_digest = state["manifests_digest"]
+            manifest_store.acquire(self._manifests_digest)
+            self._summaries = [ManifestSummary(*s) for s in state.get("summaries", [])]
+            connection = state.get("connection")
+            if connection is not None:
+                self._connection_summary = self._summaries[connection]
         self.log.info(f"Loaded state {kubetemplatespawner_version=}")
 
     def get_state(self) -> Any:
         state = super().get_state()
         state["kubetemplatespawner_version"] = __version__
-        if self._manifests:
-            state["manifests"] = self._manifests
-        if self._connection_manifest:
-            state["connection_manifest"] = self._connection_manifest
+        if self._manifests_digest:
+            state["manifests_digest"] = self._manifests_digest
+            state["summaries"] = [list(s) for s in self._summaries]
+            if self._connection_summary:
+                state["connection"] = self._summaries.index(self._connection_summary)
         return state
 
     def clear_state(self) -> None:
         super().clear_state()
-        self._manifests = []
-        self._connection_manifest = None
+        self._release_manifests()
 
     async def start(self) -> str:
+        with (
+            tracer.span("start", username=self.user.name, servername=self.name or ""),
+            api_operation("start", self.instance_name, self.log),
+        ):
+            return await self._start()
+
+    async def _start(self) -> str:
         if not self.port:
             self.port = 8888
 
-        async with ApiClient() as api:
-            async with DynamicClient(api) as dyn_client:
-                await self.deploy_all_manifests(dyn_client)
-                connection_obj = await self._get_connection_object(dyn_client)
-                if not connection_obj:
-                    raise KubeTemplateException("Failed to get connection object")
-                ip, port = self.get_connection(connection_obj)
+        start = monotonic()
+        dyn_client = await self._dyn_client()
+        source = "cold"
+        pool = self._warm_pool()
+        if pool:
+            connection = await self._warm_pool_connection(pool)
+            if await self._claim_warm_server(dyn_client, pool, connection):
+                source = "warm_pool"
+            self._replenish_warm_pool(dyn_client, pool, connection)
+        if source == "cold":
+            await self.deploy_all_manifests(dyn_client)
+        connection_obj = await self._get_connection_object(dyn_client)
+        if not connection_obj:
+            raise KubeTemplateException("Failed to get connection object")
+        ip, port = self.get_connection(connection_obj)
+        START_DURATION_SECONDS.labels(source, self.instance_name).observe(
+            monotonic() - start
+        )
+        await self._update_image_prepuller(dyn_client)
 
         self.log.info(f"Started server on {ip}:{port}")
-        self.events.put_nowait(None)
+        self._put_event(None)
         proto = "http"
         if ":" in ip:
             ip = f"[{ip}]"
@@ -392,23 +1452,28 @@ class KubeTemplateSpawner(Spawner):
     async def stop(self, now=False) -> None:
         # now=False: shutdown the server gracefully
         # now=True: terminate the server immediately (not implemented)
+        with api_operation("stop", self.instance_name, self.log):
+            await self._stop()
+
+    async def _stop(self) -> None:
         names = self.get_names()
-        async with ApiClient() as api:
-            async with DynamicClient(api) as dyn_client:
-                await self.delete_resources(
-                    dyn_client,
-                    {
-                        "app.kubernetes.io/instance": self.instance_name,
-                        "hub.jupyter.org/servername": names["escaped_servername"],
-                        "hub.jupyter.org/username": names["escaped_username"],
-                    },
-                    {
-                        self.lifecycle_annotation_key: LifeCyclePolicy.SERVER_STOPPED.value
-                    },
-                )
+        dyn_client = await self._dyn_client()
+        await self.delete_resources(
+            dyn_client,
+            {
+                "app.kubernetes.io/instance": self.instance_name,
+                "hub.jupyter.org/servername": names["escaped_servername"],
+                "hub.jupyter.org/username": names["escaped_username"],
+            },
+            {self.lifecycle_annotation_key: LifeCyclePolicy.SERVER_STOPPED.value},
+        )
 
     async def delete_forever(self):
         # This is called when deleting a user, or when deleting a named server.
+        with api_operation("delete_forever", self.instance_name, self.log):
+            await self._delete_forever()
+
+    async def _delete_forever(self) -> None:
         names = self.get_names()
 
         labels = {
@@ -422,9 +1487,8 @@ class KubeTemplateSpawner(Spawner):
             lifecycle_policy = LifeCyclePolicy.USER_DELETED.value
         annotations = {self.lifecycle_annotation_key: lifecycle_policy}
 
-        async with ApiClient() as api:
-            async with DynamicClient(api) as dyn_client:
-                await self.delete_resources(dyn_client, labels, annotations)
+        dyn_client = await self._dyn_client()
+        await self.delete_resources(dyn_client, labels, annotations)
 
     async def poll(self) -> None | int:
         # None: single-user process is running.
@@ -434,18 +1498,28 @@ class KubeTemplateSpawner(Spawner):
         # May be called before start when state is loaded on Hub launch,
         #   if spawner not initialized via load_state or start: unknown (0)
         # If called while start is in progress (yielded): running (None)
+        with (
+            POLL_DURATION_SECONDS.labels(self.instance_name).time(),
+            api_operation("poll", self.instance_name, self.log),
+        ):
+            return await self._poll()
 
-        async with ApiClient() as api:
-            async with DynamicClient(api) as dyn_client:
-                try:
-                    obj = await self._get_connection_object(dyn_client)
-                    if not obj:
-                        # clear state if the process is done
-                        self.clear_state()
-                        return 0
-                    return None
-                except RuntimeError:
-                    self.log.exception("Failed to get server")
+    async def _poll(self) -> None | int:
+        dyn_client = await self._dyn_client()
+        try:
+            obj = await self._get_connection_object(dyn_client, poll=True)
+            if not obj:
+                # clear state if the process is done
+                self.clear_state()
+                return 0
+            return None
+        except (ApiException, KubernetesStatusError):
+            # The lookup failed, e.g. a batched list shared with other polls,
+            # so it's unknown whether the server is still running
+            self.log.exception("Failed to get server, assuming it's running")
+            return None
+        except RuntimeError:
+            self.log.exception("Failed to get server")
         # Probably not running
         self.clear_state()
         return 0
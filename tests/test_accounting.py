@@ -0,0 +1,124 @@
+import logging
+
+import pytest
+from prometheus_client import REGISTRY
+
+from kubetemplatespawner._accounting import (
+    api_operation,
+    classify_request,
+    instrument,
+)
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+@pytest.mark.parametrize(
+    "method,path,query,headers,expected",
+    [
+        ("GET", "/version", None, None, ("get", "discovery")),
+        ("GET", "/apis/apps/v1", None, None, ("get", "discovery")),
+        ("GET", "/api/v1/namespaces/ns/pods/p", None, None, ("get", "pods")),
+        ("GET", "/api/v1/namespaces/ns/pods", None, None, ("list", "pods")),
+        (
+            "GET",
+            "/api/v1/namespaces/ns/events",
+            [("watch", True)],
+            None,
+            ("watch", "events"),
+        ),
+        ("GET", "/api/v1/namespaces/ns/pods/p/log", None, None, ("get", "pods/log")),
+        ("GET", "/api/v1/namespaces", None, None, ("list", "namespaces")),
+        ("GET", "/api/v1/namespaces/ns", None, None, ("get", "namespaces")),
+        (
+            "POST",
+            "/apis/apps/v1/namespaces/ns/deployments",
+            None,
+            None,
+            ("create", "deployments"),
+        ),
+        (
+            "PUT",
+            "/api/v1/namespaces/ns/configmaps/c",
+            None,
+            None,
+            ("update", "configmaps"),
+        ),
+        (
+            "PATCH",
+            "/api/v1/namespaces/ns/pods/p",
+            None,
+            {"Content-Type": "application/merge-patch+json"},
+            ("patch", "pods"),
+        ),
+        (
+            "PATCH",
+            "/api/v1/namespaces/ns/pods/p",
+            None,
+            {"Content-Type": "application/apply-patch+yaml"},
+            ("apply", "pods"),
+        ),
+        ("DELETE", "/api/v1/namespaces/ns/pods/p", None, None, ("delete", "pods")),
+        (
+            "DELETE",
+            "/api/v1/namespaces/ns/pods",
+            None,
+            None,
+            ("deletecollection", "pods"),
+        ),
+    ],
+)
+async def test_classify_request(method, path, query, headers, expected):
+    url = f"https://k8s.example.org:6443{path}"
+    assert classify_request(method, url, query, headers) == expected
+
+
+def requests_metric(operation, verb, resource, instance):
+    return (
+        REGISTRY.get_sample_value(
+            "jupyterhub_kubetemplatespawner_api_requests_total",
+            {
+                "operation": operation,
+                "verb": verb,
+                "resource": resource,
+                "instance": instance,
+            },
+        )
+        or 0
+    )
+
+
+async def test_api_operation(caplog):
+    class RestClient:
+        async def request(self, method, url, query_params=None, headers=None, **kw):
+            return method, url, query_params, headers, kw
+
+    rest_client = RestClient()
+    instrument(rest_client)
+    url = "http://k8s/api/v1/namespaces/ns/pods"
+
+    before = requests_metric("start", "list", "pods", "test-accounting")
+    background = requests_metric("background", "list", "pods", "")
+    log = logging.getLogger("test_accounting")
+    with caplog.at_level(logging.DEBUG, logger="test_accounting"):
+        with api_operation("start", "test-accounting", log) as calls:
+            r = await rest_client.request("GET", url, _preload_content=False)
+            assert r == ("GET", url, None, None, {"_preload_content": False})
+            await rest_client.request("GET", url)
+            await rest_client.request("GET", f"{url}/p", query_params=[("a", 1)])
+            await rest_client.request("GET", url, query_params=[("watch", True)])
+
+    assert calls.requests == {
+        ("list", "pods"): 2,
+        ("get", "pods"): 1,
+        ("watch", "pods"): 1,
+    }
+    assert calls.total == 4
+    assert requests_metric("start", "list", "pods", "test-accounting") == before + 2
+    [record] = caplog.records
+    assert record.message.startswith("start: 2 list, 1 get, 1 watch, ")
+    assert record.message.endswith(" ms")
+
+    # Requests after the operation has finished aren't attributed to it
+    await rest_client.request("GET", url)
+    assert calls.total == 4
+    assert requests_metric("background", "list", "pods", "") == background + 1
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from benchmarks import parse
+from benchmarks.fake_apiserver import label_selector_matches
+from benchmarks.run import STUB_HELM_DIR, benchmark, compare, parse_args
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+@pytest.mark.parametrize(
+    "selector,expected",
+    [
+        ("", True),
+        ("a=1", True),
+        ("a==1,b=2", True),
+        ("a!=1", False),
+        ("a in (0, 1),b", True),
+        ("a notin (1)", False),
+        ("!c", True),
+        ("c", False),
+    ],
+)
+async def test_label_selector_matches(selector, expected):
+    assert label_selector_matches(selector, {"a": "1", "b": "2"}) == expected
+
+
+async def test_benchmark(monkeypatch):
+    monkeypatch.setenv("PATH", f"{STUB_HELM_DIR}{os.pathsep}{os.environ['PATH']}")
+    options = parse_args(
+        ["--servers", "3", "--ready-delay", "0.1", "--set", "poll_batch_window=0.05"]
+    )
+    results = await benchmark(options)
+
+    assert results["metadata"]["options"]["traits"] == {"poll_batch_window": 0.05}
+    [r] = results["results"]
+    assert r["servers"] == 3
+    for phase in ("start", "poll", "stop"):
+        assert r[phase]["errors"] == 0
+    assert r["start"]["latency"]["p50"] >= 0.1
+    assert r["start"]["api_calls"]["by_request"]["create Pod"] == 1
+    # Polls are combined into one list request
+    assert r["poll"]["api_calls"]["by_request"] == {"list Pod": 1 / 3}
+    assert r["stop"]["api_calls"]["by_request"]["delete Pod"] == 1
+
+    assert compare(results, results, 0.2) == 0
+    slower = {"results": [dict(r, spawns_per_second=r["spawns_per_second"] / 2)]}
+    assert compare(results, slower, 0.2) == 1
+
+
+async def test_parse_benchmark():
+    results = await parse.benchmark(
+        parse.parse_args(["--copies", "1", "--min-time", "0"])
+    )
+    [r] = results["results"]
+    assert r["documents"] == 3
+    assert set(r["seconds"]) == {
+        "dump_values_python",
+        "dump_values_libyaml",
+        "parse_python",
+        "parse_libyaml",
+        "parse_json",
+    }
+    assert r["speedup_json"] > 1
@@ -0,0 +1,377 @@
+import asyncio
+import re
+import shutil
+import subprocess
+
+import pytest
+
+from kubetemplatespawner._gotemplate import (
+    Chart,
+    TemplateError,
+    Templates,
+    TemplateUnsupported,
+    go_float,
+)
+from kubetemplatespawner._render import (
+    GoTemplateRenderer,
+    HelmRenderer,
+    RenderError,
+)
+
+from .conftest import ROOT_DIR
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+def render(text, values=None, **templates):
+    t = Templates()
+    for name, body in templates.items():
+        t.parse(name, body)
+    t.parse("test", text)
+    return t.execute("test", {"Values": values or {}})
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        (8888.0, "8888"),
+        (123456.0, "123456"),
+        (1e6, "1e+06"),
+        (1234567.0, "1.234567e+06"),
+        (0.5, "0.5"),
+        (1e-05, "1e-05"),
+        (-3.25, "-3.25"),
+    ],
+)
+async def test_go_float(value, expected):
+    assert go_float(value) == expected
+
+
+async def test_actions():
+    assert render("a {{- 1 }} {{ 2 -}} b") == "a1 2b"
+    assert render("{{/* comment */}}x{{- /* comment */ -}} y") == "xy"
+    assert render('{{ "a\\"b" | quote }} {{ `raw\\n` }}') == '"a\\"b" raw\\n'
+    assert render("{{ .Values.missing }}|{{ .Values.a.b }}", {"a": {}}) == "|"
+    assert render("{{ (.Values.a).b }} {{ .Values.a | toJson }}", {"a": {"b": 1}}) == (
+        '1 {"b":1}'
+    )
+    assert render('{{ printf "%s-%03d %v" "a" 7 .Values.l }}', {"l": [1, "x"]}) == (
+        "a-007 [1 x]"
+    )
+    assert render('{{ default "d" .Values.x }} {{ .Values.y | default "d" }}') == (
+        "d d"
+    )
+
+
+async def test_control_structures():
+    text = (
+        "{{ if eq .Values.n 1 }}one{{ else if eq .Values.n 2 }}two"
+        "{{ else }}many{{ end }}"
+    )
+    assert [render(text, {"n": n}) for n in (1, 2, 3)] == ["one", "two", "many"]
+
+    text = "{{ range $k, $v := .Values.m }}{{ $k }}={{ $v }};{{ else }}empty{{ end }}"
+    assert render(text, {"m": {"b": 2, "a": "x"}}) == "a=x;b=2;"
+    assert render(text, {"m": {}}) == "empty"
+    assert render("{{ range .Values.l }}[{{ . }}]{{ end }}", {"l": ["a", "b"]}) == (
+        "[a][b]"
+    )
+    assert render("{{ with .Values.w }}{{ .x }}{{ else }}none{{ end }}", {}) == "none"
+    assert render("{{ with .Values.w }}{{ .x }}{{ end }}", {"w": {"x": 1}}) == "1"
+
+    # Variables are scoped to their block
+    text = "{{ $a := 1 }}{{ if true }}{{ $a = 2 }}{{ $b := 3 }}{{ end }}{{ $a }}"
+    assert render(text) == "2"
+    with pytest.raises(TemplateError, match=r"Undefined variable \$b"):
+        render("{{ if true }}{{ $b := 3 }}{{ end }}{{ $b }}")
+
+
+async def test_named_templates():
+    helpers = (
+        '{{- define "labels" -}}\n'
+        "app: {{ .Values.app }}\n"
+        "user: {{ .Values.user | quote }}\n"
+        "{{- end }}"
+    )
+    text = 'metadata:\n  labels:\n    {{- include "labels" . | nindent 4 }}\n'
+    assert render(text, {"app": "x", "user": "u"}, _helpers=helpers) == (
+        'metadata:\n  labels:\n    app: x\n    user: "u"\n'
+    )
+    text = '{{ template "labels" . }}'
+    assert render(text, {"app": "x", "user": "u"}, _helpers=helpers) == (
+        'app: x\nuser: "u"'
+    )
+    text = "spec:\n  {{- toYaml .Values.spec | nindent 2 }}\n"
+    assert render(text, {"spec": {"b": [1, 2], "a": "x"}}) == (
+        "spec:\n  a: x\n  b:\n  - 1\n  - 2\n"
+    )
+
+
+async def test_errors():
+    with pytest.raises(TemplateError, match="value is required"):
+        render('{{ required "value is required" .Values.x }}')
+    with pytest.raises(TemplateUnsupported, match='function "unknown" not defined'):
+        render("{{ if false }}{{ 1 | unknown }}{{ end }}")
+    with pytest.raises(TemplateUnsupported, match='function "unknown" not defined'):
+        render("", _helpers='{{ define "x" }}{{ (unknown) }}{{ end }}')
+    with pytest.raises(TemplateError, match=r"nil pointer evaluating interface \{\}.b"):
+        render("{{ .Values.a.b }}")
+    with pytest.raises(TemplateError, match=r"nil pointer evaluating interface \{\}.c"):
+        render("{{ $x := .Values.a }}{{ $x.b.c }}", {"a": {"b": None}})
+    with pytest.raises(TemplateError, match="parse error in test"):
+        render("{{ if true }}")
+    with pytest.raises(TemplateError, match="no template"):
+        render('{{ include "missing" . }}')
+
+
+async def test_chart(tmp_path):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "Chart.yaml").write_text("apiVersion: v2\nname: test\nversion: 1.0.0\n")
+    (tmp_path / "values.yaml").write_text("replicas: 1\nlabels: {a: b, c: d}\n")
+    (tmp_path / "templates" / "_helpers.tpl").write_text(
+        '{{ define "name" }}{{ .Chart.Name }}-{{ .Release.Name }}{{ end }}'
+    )
+    (tmp_path / "templates" / "workloads.yaml").write_text(
+        "kind: Deployment\n"
+        "metadata:\n"
+        '  name: {{ include "name" . }}\n'
+        "  labels: {{ toYaml .Values.labels | nindent 4 }}\n"
+        "spec:\n"
+        "  replicas: {{ .Values.replicas }}\n"
+        "---\n"
+        "kind: ConfigMap\n"
+        "metadata:\n"
+        "  name: {{ .Template.Name | base }}\n"
+    )
+    with pytest.raises(TemplateUnsupported, match='function "base" not defined'):
+        Chart(tmp_path)
+
+    (tmp_path / "templates" / "workloads.yaml").write_text(
+        "kind: Deployment\n"
+        "metadata:\n"
+        '  name: {{ include "name" . }}\n'
+        "  labels: {{ toYaml .Values.labels | nindent 4 }}\n"
+        "spec:\n"
+        "  replicas: {{ .Values.replicas }}\n"
+        "---\n"
+        "kind: ConfigMap\n"
+        "metadata:\n"
+        '  name: {{ .Template.Name | replace "/" "-" | trimSuffix ".yaml" }}\n'
+    )
+    [config_map, deployment] = Chart(tmp_path).render({"labels": {"c": None}})
+    # Manifests are in Helm's install order
+    assert config_map == {
+        "kind": "ConfigMap",
+        "metadata": {"name": "test-templates-workloads"},
+    }
+    assert deployment == {
+        "kind": "Deployment",
+        "metadata": {"name": "test-release-name", "labels": {"a": "b"}},
+        "spec": {"replicas": 1},
+    }
+
+
+async def test_renderer_reloads_chart(tmp_path):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "Chart.yaml").write_text("name: test\n")
+    template = tmp_path / "templates" / "cm.yaml"
+    template.write_text("kind: ConfigMap\ndata: {a: {{ .Values.a | quote }}}\n")
+
+    renderer = GoTemplateRenderer()
+    assert await renderer.render(str(tmp_path), {"a": 1}) == [
+        {"kind": "ConfigMap", "data": {"a": "1"}}
+    ]
+    template.write_text('kind: Secret\ndata: {{ fail "broken" }}\n')
+    with pytest.raises(RenderError, match="broken"):
+        await renderer.render(str(tmp_path), {"a": 1})
+
+
+async def test_renderer_helm_fallback(tmp_path, mocker):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "Chart.yaml").write_text("name: test\n")
+    (tmp_path / "templates" / "cm.yaml").write_text(
+        "kind: ConfigMap\ndata: {a: {{ .Values.a | base }}}\n"
+    )
+    renderer = GoTemplateRenderer()
+    mocker.patch("shutil.which", return_value=None)
+    with pytest.raises(RenderError, match="helm, which isn't installed"):
+        await renderer.render(str(tmp_path), {"a": 1})
+
+    mocker.patch("shutil.which", return_value="/usr/bin/helm")
+    helm = mocker.patch.object(HelmRenderer, "render", return_value=[{"a": 1}])
+    chart = mocker.spy(renderer, "chart")
+    assert await renderer.render(str(tmp_path), {"a": 1}) == [{"a": 1}]
+    # The chart isn't parsed again until it changes
+    assert await renderer.render(str(tmp_path), {"a": 2}) == [{"a": 1}]
+    assert chart.call_count == 1
+    assert helm.call_count == 2
+
+
+async def test_renderer_in_thread(tmp_path, mocker):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "Chart.yaml").write_text("name: test\n")
+    (tmp_path / "templates" / "cm.yaml").write_text(
+        '{{ define "nested" }}{{ if gt . 0 }}{{ include "nested" (sub . 1) }}'
+        "{{ end }}{{ end }}"
+        "kind: ConfigMap\n"
+        "data: {a: {{ .Values.a | quote }}}\n"
+        '{{ include "nested" 50 }}\n'
+    )
+    to_thread = mocker.spy(asyncio, "to_thread")
+    renderer = GoTemplateRenderer()
+    # Nesting depth is tracked separately for concurrent renders
+    results = await asyncio.gather(
+        *(renderer.render(str(tmp_path), {"a": n}) for n in range(20))
+    )
+    assert results == [
+        [{"kind": "ConfigMap", "data": {"a": str(n)}}] for n in range(20)
+    ]
+    assert to_thread.call_count == 20
+
+
+def helm_installed():
+    if not shutil.which("helm"):
+        return False
+    try:
+        subprocess.run(["helm", "version"], check=True, capture_output=True)
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+# Template values as produced by KubeTemplateSpawner.template_namespace()
+EXAMPLE_VALUES = {
+    "userid": 12,
+    "unescaped_username": "user@example.org",
+    "unescaped_servername": "",
+    "escaped_username": "user-40example-2eorg",
+    "escaped_servername": "",
+    "escaped_user_server": "user-40example-2eorg",
+    "username": "user@example.org",
+    "instance": "jupyter",
+    "namespace": "default",
+    "port": 8888,
+    "env": {
+        "JUPYTERHUB_API_TOKEN": "abc",
+        "MULTILINE": "a\nb",
+        "QUOTES": 'it\'s "quoted"',
+    },
+}
+
+
+@pytest.mark.parametrize(
+    "constraint,version,expected",
+    [
+        (">=1.19-0", "v1.32.0", True),
+        ("<1.32", "v1.32.0", False),
+        ("~1.2.3", "1.2.9", True),
+        ("~1.2.3", "1.3.0", False),
+        ("^1.2", "1.9.0", True),
+        ("^1.2", "2.0.0", False),
+        ("^0.2.3", "0.3.0", False),
+        ("1.2.x", "1.2.7", True),
+        (">1.x", "1.5.0", False),
+        ("<=1.2", "1.2.9", True),
+        ("!=1.2.x", "1.3.0", True),
+        ("1.2 - 1.4.5", "1.4.6", False),
+        (">1.2, <1.4 || 2.0.0", "2.0.0", True),
+        ("*", "1.0.0-beta", False),
+        (">=1.0.0-0", "1.0.0-beta", True),
+        (">1.0.0-alpha.10", "1.0.0-alpha.9", False),
+    ],
+)
+async def test_semver_compare(constraint, version, expected):
+    text = f'{{{{ semverCompare "{constraint}" "{version}" }}}}'
+    assert render(text) == str(expected).lower()
+
+
+async def test_capabilities(tmp_path):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "Chart.yaml").write_text("name: test\n")
+    (tmp_path / "templates" / "cm.yaml").write_text(
+        "kind: ConfigMap\n"
+        "data:\n"
+        "  kube: {{ .Capabilities.KubeVersion }}\n"
+        "  helm: {{ .Capabilities.HelmVersion.Version }}\n"
+    )
+    [config_map] = Chart(tmp_path).render({})
+    assert config_map["data"] == {"kube": "v1.32.0", "helm": "v3.17.3"}
+
+
+# Template expressions, values, and Helm's output or an error message.
+# The expected output doesn't depend on the version of helm.
+CONFORMANCE = [
+    (".Values.missing", {}, ""),
+    (".Values.a.b", {"a": {"b": "x"}}, "x"),
+    (
+        ".Values.missing.deep",
+        {},
+        TemplateError("nil pointer evaluating interface {}.deep"),
+    ),
+    (
+        "(.Values.a).b.c",
+        {"a": {}},
+        TemplateError("nil pointer evaluating interface {}.c"),
+    ),
+    ("first .Values.l", {"l": ["a", "b"]}, "a"),
+    ("first .Values.l", {"l": []}, ""),
+    (".Capabilities.KubeVersion.Major", {}, "1"),
+    ('semverCompare ">=1.20-0" .Capabilities.KubeVersion.Version', {}, "true"),
+    ('semverCompare ">=1.20-0" .Capabilities.KubeVersion.GitVersion', {}, "true"),
+    ('.Capabilities.APIVersions.Has "apps/v1"', {}, "true"),
+    ('semverCompare "^1.2" "2.0.0"', {}, "false"),
+    ('semverCompare "1.2 - 1.4.5" "1.4.5"', {}, "true"),
+    ('semverCompare "*" "1.0.0-beta"', {}, "false"),
+]
+
+
+@pytest.mark.parametrize("renderer", ["go", "helm"])
+@pytest.mark.parametrize("expression,values,expected", CONFORMANCE)
+async def test_conformance(tmp_path, renderer, expression, values, expected):
+    if renderer == "helm" and not helm_installed():
+        pytest.skip("helm isn't installed")
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "Chart.yaml").write_text("apiVersion: v2\nname: test\nversion: 1.0.0\n")
+    (tmp_path / "templates" / "cm.yaml").write_text(
+        "apiVersion: v1\n"
+        "kind: ConfigMap\n"
+        "metadata:\n"
+        "  name: test\n"
+        "data:\n"
+        "  out: |-\n"
+        f"    {{{{ {expression} }}}}\n"
+    )
+    r = HelmRenderer() if renderer == "helm" else GoTemplateRenderer()
+    if isinstance(expected, Exception):
+        with pytest.raises(RenderError, match=re.escape(str(expected))):
+            await r.render(str(tmp_path), values)
+    else:
+        [config_map] = await r.render(str(tmp_path), values)
+        assert config_map["data"]["out"] == expected
+
+
+@pytest.mark.skipif(not helm_installed(), reason="helm isn't installed")
+@pytest.mark.parametrize(
+    "values",
+    [
+        EXAMPLE_VALUES,
+        EXAMPLE_VALUES | {"serviceEnabled": True},
+        EXAMPLE_VALUES
+        | {
+            "unescaped_servername": "My Server",
+            "escaped_servername": "my-server",
+            "escaped_user_server": "user-40example-2eorg--my-server",
+            "userid": 1234567,
+            "env": {},
+        },
+    ],
+)
+async def test_conformance_with_helm(values):
+    path = str(ROOT_DIR / "example")
+    expected = await HelmRenderer().render(path, values)
+    actual = await GoTemplateRenderer().render(path, values)
+
+    def key(m):
+        return (m["kind"], m["metadata"]["name"])
+
+    assert sorted(actual, key=key) == sorted(expected, key=key)
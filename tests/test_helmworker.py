@@ -0,0 +1,180 @@
+import asyncio
+import os
+import shutil
+import signal
+import subprocess
+import sys
+
+import pytest
+import yaml
+
+from benchmarks.run import STUB_HELM_DIR
+from kubetemplatespawner._helmworker import HelmWorkerRenderer, WorkerError
+from kubetemplatespawner._render import GoTemplateRenderer, HelmRenderer, RenderError
+
+from .conftest import ROOT_DIR
+from .test_gotemplate import EXAMPLE_VALUES, helm_installed
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+STUB_WORKER = [sys.executable, str(STUB_HELM_DIR / "kubetemplatespawner-helm-worker")]
+
+
+@pytest.fixture
+def chart(tmp_path):
+    path = tmp_path / "chart"
+    shutil.copytree(ROOT_DIR / "example", path)
+    return path
+
+
+async def renderer(**kwargs):
+    r = HelmWorkerRenderer()
+    r.command = STUB_WORKER
+    r.timeout = 10
+    r.health_check_interval = 0
+    for k, v in kwargs.items():
+        setattr(r, k, v)
+    return r
+
+
+async def test_render(chart):
+    r = await renderer()
+    try:
+        manifests = await r.render(str(chart), EXAMPLE_VALUES)
+        assert manifests == await GoTemplateRenderer().render(
+            str(chart), EXAMPLE_VALUES
+        )
+        [worker] = r.pool(str(chart)).workers
+        pid = worker.process.pid
+
+        # Workers that don't support JSON output return YAML
+        async def request(body, timeout):
+            response = await request_json(body, timeout)
+            response["yaml"] = yaml.safe_dump_all(response.pop("manifests"))
+            return response
+
+        request_json = worker.request
+        worker.request = request
+        assert await r.render(str(chart), EXAMPLE_VALUES) == manifests
+        worker.request = request_json
+
+        # Template errors don't affect the worker
+        with pytest.raises(RenderError, match="Templating failed"):
+            await r.render(str(chart), {})
+        await r.render(str(chart), EXAMPLE_VALUES)
+        [worker] = r.pool(str(chart)).workers
+        assert worker.process.pid == pid
+    finally:
+        await r.close()
+    assert not worker.alive
+
+
+async def test_restart_after_exit(chart):
+    r = await renderer(workers=2)
+    try:
+        await r.render(str(chart), EXAMPLE_VALUES)
+        pool = r.pool(str(chart))
+        assert len(pool.workers) == 2
+        pool.workers[0].kill()
+        await pool.workers[0].process.wait()
+        await asyncio.gather(*(r.render(str(chart), EXAMPLE_VALUES) for _ in range(4)))
+        assert pool.restarts == 1
+        assert all(w.alive for w in pool.workers)
+    finally:
+        await r.close()
+
+
+async def test_chart_changed(chart):
+    r = await renderer()
+    try:
+        await r.render(str(chart), EXAMPLE_VALUES)
+        pool = r.pool(str(chart))
+        (chart / "values.yaml").write_text(
+            (chart / "values.yaml").read_text() + "\nserviceEnabled: true\n"
+        )
+        manifests = await r.render(str(chart), EXAMPLE_VALUES)
+        assert "Service" in [m["kind"] for m in manifests]
+        assert r.pool(str(chart)) is not pool
+        await asyncio.sleep(0.1)
+        assert not pool.workers
+    finally:
+        await r.close()
+
+
+async def test_health_check(chart):
+    r = await renderer(timeout=5, health_check_interval=0.2)
+    try:
+        await r.render(str(chart), EXAMPLE_VALUES)
+        pool = r.pool(str(chart))
+        [worker] = pool.workers
+        # A stuck worker fails the health check and is replaced
+        os.kill(worker.process.pid, signal.SIGSTOP)
+        for _ in range(150):
+            await asyncio.sleep(0.1)
+            if pool.restarts:
+                break
+        assert pool.restarts == 1
+        assert not worker.alive
+        assert pool.workers[0].alive
+        await r.render(str(chart), EXAMPLE_VALUES)
+    finally:
+        await r.close()
+
+
+async def test_worker_not_found(chart):
+    r = await renderer(command=["kubetemplatespawner-missing-helm-worker"])
+    with pytest.raises(WorkerError, match="Failed to start helm worker"):
+        await r.render(str(chart), EXAMPLE_VALUES)
+    await r.close()
+
+
+@pytest.fixture(scope="module")
+def go_worker(tmp_path_factory):
+    """The real helm worker, built from helm-worker/"""
+    if not shutil.which("go"):
+        pytest.skip("go isn't installed")
+    src = ROOT_DIR / "helm-worker"
+    download = subprocess.run(
+        ["go", "mod", "download"], cwd=src, capture_output=True, text=True
+    )
+    if download.returncode:
+        pytest.skip(f"Go modules aren't available: {download.stderr}")
+    path = tmp_path_factory.mktemp("helm-worker") / "kubetemplatespawner-helm-worker"
+    # As in the Dockerfile
+    ldflags = (
+        "-X helm.sh/helm/v3/pkg/chartutil.k8sVersionMajor=1 "
+        "-X helm.sh/helm/v3/pkg/chartutil.k8sVersionMinor=32"
+    )
+    subprocess.run(
+        ["go", "build", "-mod=readonly", "-ldflags", ldflags, "-o", str(path), "."],
+        cwd=src,
+        check=True,
+    )
+    return [str(path)]
+
+
+async def test_go_worker(chart, go_worker):
+    r = await renderer(command=go_worker)
+    try:
+        manifests = await r.render(str(chart), EXAMPLE_VALUES)
+        if helm_installed():
+            expected = await HelmRenderer().render(str(chart), EXAMPLE_VALUES)
+        else:
+            expected = await GoTemplateRenderer().render(str(chart), EXAMPLE_VALUES)
+
+        def key(m):
+            return (m["kind"], m["metadata"]["name"])
+
+        assert sorted(manifests, key=key) == sorted(expected, key=key)
+
+        [worker] = r.pool(str(chart)).workers
+        assert await worker.ping(5)
+
+        # Template errors are returned, and don't stop the worker
+        (chart / "templates" / "broken.yaml").write_text('{{ fail "broken" }}\n')
+        with pytest.raises(RenderError, match="broken"):
+            await r.render(str(chart), EXAMPLE_VALUES)
+        [worker] = r.pool(str(chart)).workers
+        assert await worker.ping(5)
+    finally:
+        await r.close()
@@ -0,0 +1,294 @@
+import asyncio
+from datetime import UTC, datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+from kubernetes_asyncio.dynamic import ResourceInstance
+from prometheus_client import REGISTRY
+
+from kubetemplatespawner._informer import (
+    BatchLister,
+    DeletionReaper,
+    EventWatcher,
+    Informer,
+)
+from kubetemplatespawner._kubernetes import (
+    KubernetesStatusError,
+    ManifestSummary,
+    get_resource_by_name,
+)
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+def _config_map(name, username, servername, resource_version="1"):
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {
+            "name": name,
+            "namespace": "ns",
+            "resourceVersion": resource_version,
+            "labels": {
+                "app.kubernetes.io/instance": "jupyter",
+                "hub.jupyter.org/username": username,
+                "hub.jupyter.org/servername": servername,
+            },
+        },
+    }
+
+
+def _dyn_client(items, events):
+    resource = Mock()
+    resource.get = AsyncMock(
+        return_value=ResourceInstance(
+            None,
+            {
+                "apiVersion": "v1",
+                "kind": "ConfigMapList",
+                "metadata": {"resourceVersion": "10"},
+                "items": items,
+            },
+        )
+    )
+    watched = asyncio.Event()
+
+    async def watch(resource, resource_version, **kwargs):
+        assert resource_version == "10"
+        for event_type, obj in events:
+            yield {"type": event_type, "object": ResourceInstance(None, obj)}
+        watched.set()
+        await asyncio.sleep(3600)
+
+    dyn_client = Mock()
+    dyn_client.resources.get = AsyncMock(return_value=resource)
+    dyn_client.watch = watch
+    return dyn_client, watched
+
+
+async def test_informer():
+    dyn_client, watched = _dyn_client(
+        [
+            _config_map("a-default", "a", ""),
+            _config_map("a-named", "a", "named"),
+            _config_map("b-default", "b", ""),
+        ],
+        [
+            ("ADDED", _config_map("c-default", "c", "", "11")),
+            ("DELETED", _config_map("a-named", "a", "named", "12")),
+            ("MODIFIED", _config_map("b-default", "b", "", "13")),
+        ],
+    )
+    informer = Informer(
+        dyn_client, "v1", "ConfigMap", "ns", "app.kubernetes.io/instance=jupyter"
+    )
+    assert not informer.synced
+    assert informer.staleness == float("inf")
+
+    informer.start()
+    await asyncio.wait_for(watched.wait(), 5)
+    assert informer.synced
+    assert informer.list_count == 1
+    assert informer.event_count == 3
+    assert informer.resource_version == "13"
+    assert informer.staleness < 5
+    staleness = REGISTRY.get_sample_value(
+        "jupyterhub_kubetemplatespawner_informer_staleness_seconds",
+        {
+            "kind": "ConfigMap",
+            "namespace": "ns",
+            "label_selector": "app.kubernetes.io/instance=jupyter",
+        },
+    )
+    assert 0 <= staleness < 5
+
+    assert informer.get("a-named") is None
+    assert informer.get("c-default").metadata.name == "c-default"
+    assert informer.get("b-default").metadata.resourceVersion == "13"
+
+    def names(labels):
+        return [o.metadata.name for o in informer.by_labels(labels)]
+
+    assert names({}) == ["a-default", "b-default", "c-default"]
+    assert names({"hub.jupyter.org/username": "a"}) == ["a-default"]
+    assert names(
+        {"hub.jupyter.org/username": "b", "hub.jupyter.org/servername": ""}
+    ) == ["b-default"]
+    assert names({"app.kubernetes.io/instance": "other"}) == []
+
+    # Objects missing from the cache are read from the API server
+    resource = await dyn_client.resources.get()
+    resource.get = AsyncMock(
+        return_value=ResourceInstance(None, _config_map("d-default", "d", ""))
+    )
+    obj = await get_resource_by_name(
+        dyn_client, "v1", "ConfigMap", "d-default", "ns", informer=informer
+    )
+    assert obj.metadata.name == "d-default"
+    resource.get.assert_awaited_once_with(name="d-default", namespace="ns")
+    obj = await get_resource_by_name(
+        dyn_client, "v1", "ConfigMap", "c-default", "ns", informer=informer
+    )
+    assert obj.metadata.resourceVersion == "11"
+    assert resource.get.await_count == 1
+
+    await informer.stop()
+    assert not informer.synced
+    assert (
+        REGISTRY.get_sample_value(
+            "jupyterhub_kubetemplatespawner_informer_staleness_seconds",
+            {
+                "kind": "ConfigMap",
+                "namespace": "ns",
+                "label_selector": "app.kubernetes.io/instance=jupyter",
+            },
+        )
+        is None
+    )
+
+
+async def test_informer_list_status():
+    dyn_client, _ = _dyn_client([_config_map("a-default", "a", "")], [])
+    resource = await dyn_client.resources.get()
+    informer = Informer(dyn_client, "v1", "ConfigMap", "ns", "")
+    await informer._list(resource)
+    assert informer.synced
+
+    # A failed list isn't an empty list
+    resource.get = AsyncMock(
+        return_value=ResourceInstance(
+            None,
+            {
+                "kind": "Status",
+                "metadata": {},
+                "status": "Failure",
+                "code": 403,
+                "message": "denied",
+            },
+        )
+    )
+    with pytest.raises(KubernetesStatusError, match="denied"):
+        await informer._list(resource)
+    assert informer.get("a-default")
+    assert informer.list_count == 1
+
+    # run() marks the informer as unsynced and retries
+    informer.start()
+    await asyncio.sleep(0.1)
+    assert not informer.synced
+    await informer.stop()
+
+
+def _event(kind, name, message, timestamp):
+    return SimpleNamespace(
+        involved_object=SimpleNamespace(kind=kind, name=name),
+        event_time=None,
+        last_timestamp=timestamp,
+        message=message,
+    )
+
+
+async def test_event_watcher(monkeypatch):
+    run = asyncio.Event()
+    monkeypatch.setattr(EventWatcher, "run", lambda self: run.wait())
+
+    since = datetime(2025, 1, 1, tzinfo=UTC)
+    later = since + timedelta(seconds=1)
+    watcher = EventWatcher(Mock(), "ns")
+    sub1 = watcher.subscribe(
+        [ManifestSummary("v1", "Pod", "pod-1", "ns")], since, maxsize=2
+    )
+    sub2 = watcher.subscribe(
+        [
+            ManifestSummary("v1", "Pod", "pod-2", "ns"),
+            ManifestSummary("v1", "PersistentVolumeClaim", "pvc-2", "ns"),
+        ],
+        since,
+    )
+    assert watcher._task
+
+    watcher._dispatch(_event("Pod", "pod-1", "old", since - timedelta(seconds=1)))
+    for n in range(3):
+        watcher._dispatch(_event("Pod", "pod-1", f"msg-{n}", later))
+    watcher._dispatch(_event("Pod", "pod-2", "pod", later))
+    watcher._dispatch(_event("PersistentVolumeClaim", "pvc-2", "pvc", later))
+    watcher._dispatch(_event("Pod", "pod-3", "other", later))
+    assert watcher.event_count == 7
+
+    # Oldest message dropped
+    assert sub1.dropped == 1
+    assert [await anext(sub1) for _ in range(2)] == [
+        f"{later} Pod/pod-1 msg-1",
+        f"{later} Pod/pod-1 msg-2",
+    ]
+    assert [await anext(sub2) for _ in range(2)] == [
+        f"{later} Pod/pod-2 pod",
+        f"{later} PersistentVolumeClaim/pvc-2 pvc",
+    ]
+
+    watcher.unsubscribe(sub1)
+    assert watcher._task
+    watcher.unsubscribe(sub2)
+    assert not watcher._task
+
+
+async def test_batch_lister():
+    dyn_client, _ = _dyn_client(
+        [_config_map("a-default", "a", ""), _config_map("b-default", "b", "")], []
+    )
+    resource = await dyn_client.resources.get()
+    lister = BatchLister(window=0.1)
+    selector = "app.kubernetes.io/instance=jupyter"
+
+    objs = await asyncio.gather(
+        *(
+            lister.get(dyn_client, "v1", "ConfigMap", name, "ns", selector)
+            for name in ("a-default", "b-default", "c-default")
+        )
+    )
+    assert [o and o.metadata.name for o in objs] == ["a-default", "b-default", None]
+    assert lister.lookup_count == 3
+    assert lister.list_count == 1
+    resource.get.assert_awaited_once_with(namespace="ns", label_selector=selector)
+
+    # A later lookup makes a new request
+    obj = await lister.get(dyn_client, "v1", "ConfigMap", "a-default", "ns", selector)
+    assert obj.metadata.name == "a-default"
+    assert lister.list_count == 2
+    assert not lister._pending
+
+
+async def test_deletion_reaper(monkeypatch):
+    deleted = {}
+
+    async def wait_for_deleted(dyn_client, resource, s, resource_version, timeout):
+        await deleted[s.name].wait()
+        return s.name == "a"
+
+    monkeypatch.setattr(
+        "kubetemplatespawner._informer.wait_for_deleted", wait_for_deleted
+    )
+    dyn_client, _ = _dyn_client([], [])
+    a = ManifestSummary("v1", "Pod", "a", "ns")
+    b = ManifestSummary("v1", "Pod", "b", "ns")
+    deleted = {"a": asyncio.Event(), "b": asyncio.Event()}
+
+    reaper = DeletionReaper()
+    reaper.track(dyn_client, a, 10)
+    reaper.track(dyn_client, a, 10)
+    reaper.track(dyn_client, b, 10)
+    assert reaper.pending == [a, b]
+
+    waiter = asyncio.create_task(reaper.wait(dyn_client, [a]))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    deleted["a"].set()
+    await asyncio.wait_for(waiter, 5)
+    assert reaper.completed == 1
+    assert reaper.pending == [b]
+
+    deleted["b"].set()
+    await reaper.wait(dyn_client, [a, b])
+    assert reaper.timed_out == 1
+    assert reaper.pending == []
@@ -1,18 +1,32 @@
+import asyncio
+import atexit
+from unittest.mock import AsyncMock, Mock
 from uuid import uuid4
 
 import pytest
 from kubernetes_asyncio import client
+from kubernetes_asyncio.client.rest import ApiException
 from kubernetes_asyncio.dynamic import ResourceInstance
+from kubernetes_asyncio.dynamic.exceptions import ResourceNotFoundError
 
+import kubetemplatespawner._kubernetes
 from kubetemplatespawner._kubernetes import (
+    DiscoveryCache,
+    KubernetesStatusError,
     ManifestSummary,
+    close_shared_clients,
+    delete_collection,
     delete_manifest,
+    deletion_batches,
     deploy_manifest,
     get_deletions_by_labels,
     get_resource_by_labels,
     get_resource_by_name,
     manifest_summary,
     not_found,
+    shared_dynamic_client,
+    wait_for_deleted,
+    wait_for_ready,
 )
 
 pytestmark = pytest.mark.asyncio(loop_scope="module")
@@ -63,8 +77,144 @@ async def test_not_found(k8s_dynclient):
 # load_config()
 # object_is_ready()
 # k8s_resource()
-# wait_for_ready()
-# stream_events()
+
+
+async def test_discovery_cache(monkeypatch):
+    async def get(api_version, kind):
+        if kind == "Missing":
+            raise ResourceNotFoundError(kind)
+        return f"{api_version}/{kind}"
+
+    dyn_client = Mock()
+    dyn_client.resources.get = AsyncMock(side_effect=get)
+    dyn_client.resources.invalidate_cache = AsyncMock()
+
+    cache = DiscoveryCache()
+    assert await cache.get(dyn_client, "v1", "Pod") == "v1/Pod"
+    assert await cache.get(dyn_client, "v1", "Pod") == "v1/Pod"
+    assert dyn_client.resources.get.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Missing kinds are cached
+    for _ in range(2):
+        with pytest.raises(ResourceNotFoundError):
+            await cache.get(dyn_client, "example.org/v1", "Missing")
+    assert dyn_client.resources.get.call_count == 2
+
+    cache.invalidate("v1", "Pod")
+    assert await cache.get(dyn_client, "v1", "Pod") == "v1/Pod"
+    assert dyn_client.resources.get.call_count == 3
+    assert not dyn_client.resources.invalidate_cache.called
+
+    # Expired cache re-runs discovery
+    monkeypatch.setattr(cache, "ttl", -1)
+    assert await cache.get(dyn_client, "v1", "Pod") == "v1/Pod"
+    assert dyn_client.resources.invalidate_cache.call_count == 1
+    assert dyn_client.resources.get.call_count == 4
+
+
+def _pod(ready, resource_version):
+    return ResourceInstance(
+        None,
+        {
+            "apiVersion": "v1",
+            "kind": "Pod",
+            "metadata": {
+                "name": "pod",
+                "namespace": "ns",
+                "resourceVersion": resource_version,
+            },
+            "status": {"conditions": [{"type": "Ready", "status": str(ready)}]},
+        },
+    )
+
+
+async def test_wait_for_ready_watch():
+    watches = []
+
+    async def watch(resource, resource_version, **kwargs):
+        watches.append(resource_version)
+        if len(watches) == 1:
+            raise ApiException(status=410, reason="Gone")
+        yield {"type": "MODIFIED", "object": _pod(False, "2")}
+        yield {"type": "MODIFIED", "object": _pod(True, "3")}
+
+    dyn_client = Mock()
+    dyn_client.resources.get = AsyncMock()
+    dyn_client.watch = watch
+
+    await wait_for_ready(dyn_client, _pod(False, "1"), 10)
+    # Restarted without a resourceVersion after 410 Gone
+    assert watches == ["1", None]
+    assert not dyn_client.resources.get.return_value.get.called
+
+
+async def test_wait_for_deleted_watch():
+    watches = []
+
+    async def watch(resource, resource_version, **kwargs):
+        watches.append(resource_version)
+        if len(watches) == 1:
+            raise ApiException(status=410, reason="Gone")
+        yield {"type": "MODIFIED", "object": _pod(False, "4")}
+        yield {"type": "DELETED", "object": _pod(False, "5")}
+
+    resource = Mock()
+    resource.get = AsyncMock(return_value=_pod(False, "3"))
+    dyn_client = Mock()
+    dyn_client.watch = watch
+
+    s = ManifestSummary("v1", "Pod", "pod", "ns")
+    assert await wait_for_deleted(dyn_client, resource, s, "2", 10)
+    # Object fetched again after 410 Gone
+    assert watches == ["2", "3"]
+    resource.get.assert_awaited_once_with(name="pod", namespace="ns")
+
+    resource.get = AsyncMock(return_value=ResourceInstance(None, {"kind": "Status"}))
+    assert await wait_for_deleted(dyn_client, resource, s, None, 10)
+
+
+async def test_shared_dynamic_client(k8s_client):
+    c1 = await shared_dynamic_client(max_connections=10)
+    c2 = await shared_dynamic_client(max_connections=10)
+    assert c1 is c2
+    assert c1.configuration.connection_pool_maxsize == 10
+
+    await close_shared_clients()
+    c3 = await shared_dynamic_client(max_connections=10)
+    assert c3 is not c1
+    await close_shared_clients()
+
+
+async def test_shared_clients_closed_at_exit(monkeypatch):
+    async def dynamic_client(api, cache_file=None):
+        return Mock()
+
+    monkeypatch.setattr(kubetemplatespawner._kubernetes, "load_config", Mock())
+    monkeypatch.setattr(
+        kubetemplatespawner._kubernetes, "DynamicClient", dynamic_client
+    )
+    register = Mock()
+    monkeypatch.setattr(atexit, "register", register)
+    shared = kubetemplatespawner._kubernetes._shared_clients
+    close_at_exit = kubetemplatespawner._kubernetes._close_at_exit
+
+    # e.g. the Hub's event loop was stopped without cancelling tasks
+    loop = asyncio.new_event_loop()
+
+    def run():
+        loop.run_until_complete(shared_dynamic_client(max_connections=3))
+        [(_, task)] = [v for (k, v) in shared.items() if k[0] is loop]
+        assert not task.done()
+        close_at_exit()
+        assert task.done()
+        assert not [k for k in shared if k[0] is loop]
+
+    try:
+        await asyncio.to_thread(run)
+    finally:
+        loop.close()
+    assert close_at_exit in [c.args[0] for c in register.call_args_list]
 
 
 async def test_deploy_manifest(k8s_client, k8s_dynclient, k8s_namespace):
@@ -82,6 +232,176 @@ async def test_deploy_manifest(k8s_client, k8s_dynclient, k8s_namespace):
     assert cm.data == m["data"]
 
 
+async def test_deploy_manifest_server_side_apply(
+    k8s_client, k8s_dynclient, k8s_namespace
+):
+    v1 = client.CoreV1Api(k8s_client)
+
+    name = f"config-{uuid4()}"
+    m = config_map(name, k8s_namespace)
+    await deploy_manifest(k8s_dynclient, m, 30, field_manager="test", dry_run=True)
+    assert not await _list_cm_names(v1, k8s_namespace, name)
+
+    await deploy_manifest(k8s_dynclient, m, 30, field_manager="test")
+    cm = await v1.read_namespaced_config_map(name, k8s_namespace)
+    assert cm.data == m["data"]
+    assert [f.manager for f in cm.metadata.managed_fields] == ["test"]
+
+    # Fields owned by another manager
+    m["data"]["abc"] = "456"
+    with pytest.raises(RuntimeError, match="Conflict"):
+        await deploy_manifest(k8s_dynclient, m, 30, field_manager="other")
+    await deploy_manifest(
+        k8s_dynclient, m, 30, field_manager="other", force_conflicts=True
+    )
+    cm = await v1.read_namespaced_config_map(name, k8s_namespace)
+    assert cm.data == m["data"]
+
+
+async def test_deploy_manifest_apply_conflict():
+    resource = Mock()
+    # The dynamic client returns errors as a Status instead of raising them
+    resource.server_side_apply = AsyncMock(
+        return_value=ResourceInstance(
+            None,
+            {"kind": "Status", "code": 409, "message": "conflict with other"},
+        )
+    )
+    dyn_client = Mock()
+    dyn_client.resources.get = AsyncMock(return_value=resource)
+
+    with pytest.raises(RuntimeError, match="Conflict applying .* as test: conflict"):
+        await deploy_manifest(dyn_client, config_map(), 10, field_manager="test")
+    assert resource.server_side_apply.call_args.kwargs["force_conflicts"] is None
+    assert resource.server_side_apply.call_args.kwargs["dry_run"] is None
+    assert not resource.get.called
+
+
+async def test_delete_manifest_status():
+    resource = Mock()
+    dyn_client = Mock()
+    dyn_client.resources.get = AsyncMock(return_value=resource)
+    s = ManifestSummary("v1", "ConfigMap", "a", "ns")
+
+    resource.delete = AsyncMock(
+        return_value=ResourceInstance(
+            None,
+            {"kind": "Status", "status": "Failure", "code": 403, "message": "no"},
+        )
+    )
+    with pytest.raises(KubernetesStatusError, match="Failed to delete") as e:
+        await delete_manifest(dyn_client, s, 0)
+    assert e.value.code == 403
+
+    # Already deleted
+    resource.delete = AsyncMock(
+        return_value=ResourceInstance(
+            None,
+            {
+                "kind": "Status",
+                "status": "Failure",
+                "code": 404,
+                "details": {"name": "a", "kind": "configmaps"},
+            },
+        )
+    )
+    assert await delete_manifest(dyn_client, s, 10)
+    assert not resource.get.called
+
+
+async def test_delete_collection_status():
+    resource = Mock()
+    dyn_client = Mock()
+    dyn_client.resources.get = AsyncMock(return_value=resource)
+
+    def status(code):
+        return ResourceInstance(
+            None,
+            {"kind": "Status", "status": "Failure", "code": code, "message": "no"},
+        )
+
+    resource.delete = AsyncMock(
+        return_value=ResourceInstance(None, {"kind": "PodList", "items": []})
+    )
+    assert await delete_collection(dyn_client, "v1", "Pod", "ns", "a=b")
+
+    # Not allowed or supported, so objects must be deleted individually
+    for code in (403, 405):
+        resource.delete = AsyncMock(return_value=status(code))
+        assert not await delete_collection(dyn_client, "v1", "Pod", "ns", "a=b")
+
+    resource.delete = AsyncMock(return_value=status(500))
+    with pytest.raises(KubernetesStatusError, match="Failed to delete") as e:
+        await delete_collection(dyn_client, "v1", "Pod", "ns", "a=b")
+    assert e.value.code == 500
+
+
+async def test_resource_not_served():
+    # e.g. a CRD that changed version after discovery
+    stale = Mock()
+    stale.get = AsyncMock(
+        return_value=ResourceInstance(
+            None,
+            {
+                "kind": "Status",
+                "status": "Failure",
+                "code": 404,
+                "message": "the server could not find the requested resource",
+            },
+        )
+    )
+    current = Mock()
+    current.get = AsyncMock(
+        side_effect=[
+            ResourceInstance(None, {"kind": "ConfigMap", "metadata": {"name": "a"}}),
+            ResourceInstance(
+                None,
+                {
+                    "kind": "Status",
+                    "status": "Failure",
+                    "code": 404,
+                    "details": {"name": "b", "kind": "configmaps"},
+                },
+            ),
+        ]
+    )
+    dyn_client = Mock()
+    dyn_client.resources.get = AsyncMock(side_effect=[stale, current, current])
+    dyn_client.resources.invalidate_cache = AsyncMock()
+
+    # Discovery is refreshed and the request retried once
+    obj = await get_resource_by_name(dyn_client, "v1", "ConfigMap", "a", "ns")
+    assert obj.metadata.name == "a"
+    assert dyn_client.resources.invalidate_cache.call_count == 1
+    assert stale.get.call_count == 1
+
+    # A missing object isn't a missing resource
+    assert await get_resource_by_name(dyn_client, "v1", "ConfigMap", "b", "ns") is None
+    assert dyn_client.resources.invalidate_cache.call_count == 1
+
+
+async def test_deletion_batches():
+    def summary(kind, name="a"):
+        return ManifestSummary("v1", kind, name, "ns")
+
+    batches = deletion_batches(
+        [
+            summary("ServiceAccount"),
+            summary("ConfigMap", "a"),
+            summary("Pod"),
+            summary("RoleBinding"),
+            summary("ConfigMap", "b"),
+            summary("Custom"),
+        ]
+    )
+    assert batches == [
+        [summary("Pod"), summary("Custom")],
+        [summary("ConfigMap", "a"), summary("RoleBinding"), summary("ConfigMap", "b")],
+        [summary("ServiceAccount")],
+    ]
+    assert deletion_batches([summary("Secret")]) == [[summary("Secret")]]
+
+
 async def _list_cm_names(v1, namespace, prefix):
     all_config_maps = await v1.list_namespaced_config_map(namespace)
     return sorted(
@@ -0,0 +1,239 @@
+import os
+from collections import namedtuple
+from datetime import UTC, datetime, timedelta
+
+import pytest
+import pytest_asyncio
+import yaml
+from kubernetes_asyncio.dynamic import ResourceInstance
+
+from benchmarks.fake_apiserver import FakeApiServer
+from benchmarks.run import STUB_HELM_DIR
+from kubetemplatespawner._kubernetes import ManifestSummary, close_shared_clients
+from kubetemplatespawner._pool import (
+    SLOT_LABEL,
+    STATE_LABEL,
+    WarmPool,
+    claim_patch,
+    claimed_manifests,
+    label_slot,
+    shared_warm_pool,
+    slot_names,
+)
+from kubetemplatespawner.spawner import KubeTemplateSpawner
+
+from .conftest import ROOT_DIR
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+def manifest(kind, annotations=None):
+    return {
+        "apiVersion": "v1",
+        "kind": kind,
+        "metadata": {
+            "name": "jupyter-warm-pool-abc",
+            "labels": {
+                "app.kubernetes.io/instance": "jupyter",
+                "hub.jupyter.org/username": "warm-pool-abc",
+                "hub.jupyter.org/servername": "",
+            },
+            "annotations": {"hub.jupyter.org/username": "warm-pool-abc"}
+            | (annotations or {}),
+        },
+    }
+
+
+async def test_claim_patch():
+    assert slot_names("abc")["escaped_user_server"] == "warm-pool-abc"
+    names = {
+        "unescaped_username": "user@1",
+        "escaped_username": "user-1",
+        "escaped_servername": "",
+    }
+    [pod, secret] = label_slot(
+        [
+            manifest("Pod"),
+            manifest("Secret", {"kubetemplatespawner/warm-pool-env": "true"}),
+        ],
+        "default",
+        "abc",
+    )
+    assert pod["metadata"]["labels"][STATE_LABEL] == "unassigned"
+    assert pod["metadata"]["labels"][SLOT_LABEL] == "abc"
+
+    expected = {
+        "metadata": {
+            "labels": {
+                STATE_LABEL: "claimed",
+                "hub.jupyter.org/username": "user-1",
+                "hub.jupyter.org/servername": "",
+            },
+            "annotations": {"hub.jupyter.org/username": "user@1"},
+        }
+    }
+    assert claim_patch(pod, names, {"A": "1"}) == expected
+    assert claim_patch(secret, names, {"A": "1"}) == expected | {
+        "stringData": {"A": "1"}
+    }
+
+    [claimed, _] = claimed_manifests([pod, secret], names)
+    assert claimed["metadata"]["labels"]["hub.jupyter.org/username"] == "user-1"
+    assert claimed["metadata"]["labels"][STATE_LABEL] == "claimed"
+    assert claimed["metadata"]["annotations"]["hub.jupyter.org/username"] == "user@1"
+    # The original isn't modified
+    assert pod["metadata"]["labels"][STATE_LABEL] == "unassigned"
+
+
+class WarmPoolSpawner(KubeTemplateSpawner):
+    def get_env(self):
+        return {"JUPYTERHUB_USER": self.user.name}
+
+
+@pytest_asyncio.fixture
+async def fake_k8s(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", f"{STUB_HELM_DIR}{os.pathsep}{os.environ['PATH']}")
+    server = FakeApiServer()
+    await server.start()
+    kubeconfig = tmp_path / "kubeconfig"
+    kubeconfig.write_text(yaml.safe_dump(server.kubeconfig()))
+    yield server, kubeconfig
+    await close_shared_clients()
+    await server.stop()
+
+
+def warm_pool_spawner(kubeconfig, tmp_path):
+    def spawner(i):
+        return WarmPoolSpawner(
+            template_path=str(ROOT_DIR / "example"),
+            user=namedtuple("User", "id name")(i, f"user-{i}"),
+            orm_spawner=namedtuple("ORMSpawner", "name server")("", None),
+            namespace="pool",
+            k8s_config_file=str(kubeconfig),
+            k8s_discovery_cache_file=str(tmp_path / "discovery.json"),
+            warm_pool_sizes={"default": 2},
+        )
+
+    return spawner
+
+
+async def test_warm_pool(fake_k8s, tmp_path):
+    server, kubeconfig = fake_k8s
+    spawner = warm_pool_spawner(kubeconfig, tmp_path)
+
+    # Pool is empty so the first server is deployed, and the pool is filled
+    s1 = spawner(1)
+    await s1.start()
+    assert s1._connection_summary.name == "jupyter-user-1"
+    pool = shared_warm_pool("jupyter", "pool", "default")
+    assert (pool.claimed, pool.misses) == (0, 1)
+    await pool._fill_task
+    unassigned = [
+        p
+        for p in server.objects("pods")
+        if p["metadata"]["labels"].get(STATE_LABEL) == "unassigned"
+    ]
+    assert len(unassigned) == 2
+
+    # The next server is claimed from the pool
+    s2 = spawner(2)
+    url = await s2.start()
+    assert (pool.claimed, pool.misses) == (1, 1)
+    name = s2._connection_summary.name
+    assert name.startswith("jupyter-warm-pool-")
+    [pod] = [p for p in server.objects("pods") if p["metadata"]["name"] == name]
+    assert url == f"http://{pod['status']['podIP']}:8888"
+    labels = pod["metadata"]["labels"]
+    assert labels["hub.jupyter.org/username"] == "user-2"
+    assert labels[STATE_LABEL] == "claimed"
+    assert pod["metadata"]["annotations"]["hub.jupyter.org/username"] == "user-2"
+    [pvc] = [
+        p
+        for p in server.objects("persistentvolumeclaims")
+        if p["metadata"]["name"] == name
+    ]
+    assert pvc["metadata"]["labels"]["hub.jupyter.org/username"] == "user-2"
+
+    # The pool is replenished
+    await pool._fill_task
+    unassigned = [
+        p
+        for p in server.objects("pods")
+        if p["metadata"]["labels"].get(STATE_LABEL) == "unassigned"
+    ]
+    assert len(unassigned) == 2
+
+    assert await s2.poll() is None
+    await s2.stop()
+    assert name not in [p["metadata"]["name"] for p in server.objects("pods")]
+    await s1.stop()
+
+
+async def test_warm_pool_claim_failed(fake_k8s, tmp_path, mocker):
+    server, kubeconfig = fake_k8s
+    spawner = warm_pool_spawner(kubeconfig, tmp_path)
+    s1 = spawner(1)
+    await s1.start()
+    pool = shared_warm_pool("jupyter", "pool", "default")
+    await pool._fill_task
+
+    # The connection object is claimed, but another object conflicts
+    mocker.patch("kubetemplatespawner.spawner.patch_object", return_value=None)
+    s2 = spawner(2)
+    await s2.start()
+    assert s2._connection_summary.name == "jupyter-user-2"
+    assert pool.deleted == 1
+    # Only the partly claimed slot is deleted, the pool is then refilled
+    await pool._fill_task
+    pods = [p["metadata"] for p in server.objects("pods")]
+    assert sum(p["labels"].get(STATE_LABEL) == "unassigned" for p in pods) == 2
+    assert not [p for p in pods if p["labels"].get(STATE_LABEL) == "claimed"]
+
+
+async def test_warm_pool_expired_slot():
+    def pod(slot, age):
+        created = datetime.now(UTC) - timedelta(seconds=age)
+        return ResourceInstance(
+            None,
+            {
+                "kind": "Pod",
+                "metadata": {
+                    "name": f"jupyter-warm-pool-{slot}",
+                    "labels": {SLOT_LABEL: slot},
+                    "creationTimestamp": created.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                },
+                "status": {},
+            },
+        )
+
+    pool = WarmPool("jupyter", "pool", "expired")
+
+    async def unassigned(dyn_client, connection):
+        return [pod("old", 100), pod("new", 1)]
+
+    pool.unassigned = unassigned
+    deployed = []
+    deleted = []
+
+    async def render(slot):
+        return [
+            {
+                "apiVersion": "v1",
+                "kind": "Pod",
+                "metadata": {"name": f"jupyter-warm-pool-{slot}"},
+            }
+        ]
+
+    async def deploy(manifest):
+        deployed.append(manifest["metadata"]["name"])
+
+    async def delete(s):
+        deleted.append(s.name)
+
+    connection = ManifestSummary("v1", "Pod", "", "pool")
+    pool.replenish(None, connection, 2, 30, render, deploy, delete)
+    await pool._fill_task
+    # The slot that isn't ready after the timeout is replaced
+    assert deleted == ["jupyter-warm-pool-old"]
+    assert len(deployed) == 1
+    assert pool.deleted == 1
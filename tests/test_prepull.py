@@ -0,0 +1,184 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from kubetemplatespawner._prepull import (
+    ImagePlanner,
+    ImagePrePuller,
+    manifest_images,
+    manifest_pull_secrets,
+)
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+def pod(*images, pull_secret=None):
+    spec = {
+        "containers": [{"name": f"c{i}", "image": im} for i, im in enumerate(images)]
+    }
+    if pull_secret:
+        spec["imagePullSecrets"] = [{"name": pull_secret}]
+    return {"apiVersion": "v1", "kind": "Pod", "spec": spec}
+
+
+async def test_manifest_images():
+    manifests = [
+        {"apiVersion": "v1", "kind": "Service", "spec": {"ports": []}},
+        pod("jupyter/base", "sidecar", pull_secret="registry"),
+        {
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "spec": {
+                "template": {
+                    "spec": {
+                        "initContainers": [{"name": "init", "image": "busybox"}],
+                        "containers": [{"name": "c", "image": "jupyter/base"}],
+                    }
+                }
+            },
+        },
+        {
+            "apiVersion": "batch/v1",
+            "kind": "CronJob",
+            "spec": {
+                "jobTemplate": {
+                    "spec": {
+                        "template": {
+                            "spec": {"containers": [{"name": "c", "image": "backup"}]}
+                        }
+                    }
+                }
+            },
+        },
+    ]
+    assert manifest_images(manifests) == [
+        "jupyter/base",
+        "sidecar",
+        "busybox",
+        "backup",
+    ]
+    assert manifest_pull_secrets(manifests) == ["registry"]
+
+
+async def test_planner_top():
+    planner = ImagePlanner(window=0.2)
+    planner.record(["a", "b"], [])
+    planner.record(["b"], ["secret"])
+    planner.record(["c"], [])
+    assert planner.top(2) == ["b", "a"]
+    assert planner.top(5, ["d", "b"]) == ["b", "a", "c", "d"]
+    assert planner.pull_secrets(["a"]) == []
+    assert planner.pull_secrets(["a", "b"]) == ["secret"]
+
+    await asyncio.sleep(0.3)
+    planner.record(["c"], [])
+    assert len(planner) == 1
+    assert planner.top(2) == ["c"]
+
+
+async def test_prepuller_update():
+    deployed = []
+
+    async def deploy(manifest):
+        deployed.append(manifest)
+
+    async def delete(s):
+        raise AssertionError(f"{s} deleted")
+
+    def covered():
+        return REGISTRY.get_sample_value(
+            "jupyterhub_kubetemplatespawner_image_prepull_spawn_images_total",
+            {"prepulled": "true", "instance": "test-prepull"},
+        )
+
+    prepuller = ImagePrePuller("test-prepull", "ns")
+    assert prepuller.record([pod("a", "b", pull_secret="registry")]) == (0, 2)
+    prepuller.record([pod("a")])
+    prepuller.update(1, 0, "pause", ["c"], deploy, delete)
+    await prepuller._update_task
+
+    [daemonset] = deployed
+    assert daemonset["kind"] == "DaemonSet"
+    assert daemonset["metadata"]["name"] == "test-prepull-image-prepuller"
+    spec = daemonset["spec"]["template"]["spec"]
+    assert [c["image"] for c in spec["initContainers"]] == ["a"]
+    assert spec["imagePullSecrets"] == [{"name": "registry"}]
+    assert prepuller.pulled == {"a"}
+    assert prepuller.record([pod("a", "b")]) == (1, 2)
+    assert covered() == 1
+
+    # Unchanged images aren't deployed again
+    prepuller.update(1, 0, "pause", [], deploy, delete)
+    await prepuller._update_task
+    assert len(deployed) == 1
+
+    # The DaemonSet doesn't shrink when there are fewer recent images
+    prepuller.planner.window = 0
+    prepuller.update(2, 0, "pause", ["c"], deploy, delete)
+    await prepuller._update_task
+    spec = deployed[-1]["spec"]["template"]["spec"]
+    assert [c["image"] for c in spec["initContainers"]] == ["a", "c"]
+    assert prepuller.pulled == {"a", "c"}
+
+    # Updates are limited by the interval
+    prepuller.update(3, 3600, "pause", ["d"], deploy, delete)
+    await prepuller._update_task
+    assert len(deployed) == 2
+
+
+async def test_prepuller_deploy_failure():
+    async def deploy(manifest):
+        raise RuntimeError("failed")
+
+    async def delete(s):
+        raise AssertionError(f"{s} deleted")
+
+    prepuller = ImagePrePuller("test-prepull-failure", "ns")
+    prepuller.record([pod("a")])
+    prepuller.update(1, 0, "pause", [], deploy, delete)
+    await prepuller._update_task
+    assert prepuller.images == []
+    assert prepuller.pulled == set()
+
+
+async def test_prepuller_delete():
+    deployed = []
+    deleted = []
+    fail = True
+
+    async def deploy(manifest):
+        deployed.append(manifest)
+
+    async def delete(s):
+        if fail:
+            raise RuntimeError("failed")
+        deleted.append(s)
+
+    # A DaemonSet may be left by an earlier Hub, delete it when disabled
+    prepuller = ImagePrePuller("test-prepull-delete", "ns")
+    prepuller.update(0, 0, "pause", ["a"], deploy, delete)
+    await prepuller._update_task
+    assert not prepuller.removed
+    fail = False
+    prepuller.update(0, 0, "pause", ["a"], deploy, delete)
+    await prepuller._update_task
+    assert prepuller.removed
+    assert deleted == [
+        ("apps/v1", "DaemonSet", "test-prepull-delete-image-prepuller", "ns")
+    ]
+    prepuller.update(0, 0, "pause", ["a"], deploy, delete)
+    await prepuller._update_task
+    assert len(deleted) == 1
+
+    # Enabled again, then disabled
+    prepuller.record([pod("a")])
+    prepuller.update(1, 0, "pause", [], deploy, delete)
+    await prepuller._update_task
+    assert len(deployed) == 1
+    assert not prepuller.removed
+    prepuller.update(0, 0, "pause", [], deploy, delete)
+    await prepuller._update_task
+    assert len(deleted) == 2
+    assert prepuller.images == []
+    assert prepuller.pulled == set()
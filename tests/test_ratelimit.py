@@ -0,0 +1,106 @@
+import asyncio
+from email.utils import formatdate
+from time import monotonic, time
+
+import pytest
+from kubernetes_asyncio.client.rest import ApiException
+
+from kubetemplatespawner._accounting import api_operation
+from kubetemplatespawner._ratelimit import (
+    Lane,
+    RateLimiter,
+    parse_retry_after,
+    rate_limit,
+)
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+async def test_parse_retry_after():
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after(None) == 1
+    assert parse_retry_after("invalid", default=2) == 2
+    assert 8 < parse_retry_after(formatdate(time() + 10, usegmt=True)) <= 10
+
+
+async def test_token_bucket():
+    limiter = RateLimiter(qps=20, burst=5)
+    start = monotonic()
+    queued = [await limiter.acquire(Lane.START) for _ in range(10)]
+    # Burst is immediate, the remaining 5 requests take 0.25s
+    assert queued[:5] == [0] * 5
+    assert all(q > 0 for q in queued[5:])
+    assert 0.2 < monotonic() - start < 0.5
+
+
+async def test_priority_lanes():
+    limiter = RateLimiter()
+    limiter.pause(0.1)
+    order = []
+
+    async def request(lane, name):
+        await limiter.acquire(lane)
+        order.append(name)
+
+    tasks = [
+        asyncio.create_task(request(lane, name))
+        for (lane, name) in [
+            (Lane.STOP, "stop-1"),
+            (Lane.POLL, "poll-1"),
+            (Lane.START, "start-1"),
+            (Lane.STOP, "stop-2"),
+            (Lane.START, "start-2"),
+        ]
+    ]
+    await asyncio.sleep(0)
+    assert limiter.queued == 5
+    await asyncio.gather(*tasks)
+    assert order == ["start-1", "start-2", "poll-1", "stop-1", "stop-2"]
+
+
+class Response:
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+
+async def test_rate_limit_retry_after():
+    throttled = Response(429, {"Retry-After": "0.2"})
+    responses = [throttled, ApiException(status=429), Response(200)]
+
+    class RestClient:
+        calls = 0
+
+        async def request(self, method, url, **kwargs):
+            self.calls += 1
+            r = responses.pop(0)
+            if isinstance(r, Exception):
+                raise r
+            return r
+
+    rest_client = RestClient()
+    rate_limit(rest_client, RateLimiter())
+    start = monotonic()
+    with api_operation("start", "test-ratelimit"):
+        r = await rest_client.request("GET", "http://k8s/api/v1/namespaces/ns/pods")
+    assert r.status == 200
+    assert rest_client.calls == 3
+    assert throttled.released
+    # Retry-After 0.2s, then the default 1s
+    assert monotonic() - start > 1.2
+
+
+async def test_rate_limit_max_retries():
+    class RestClient:
+        async def request(self, method, url, **kwargs):
+            return Response(429, {"Retry-After": "0"})
+
+    rest_client = RestClient()
+    rate_limit(rest_client, RateLimiter(max_retries=2))
+    r = await rest_client.request("GET", "http://k8s/api/v1/namespaces/ns/pods")
+    assert r.status == 429
+    assert not r.released
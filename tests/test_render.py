@@ -0,0 +1,308 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from kubetemplatespawner._render import (
+    RenderCache,
+    RenderQueue,
+    SkeletonCache,
+    chart_digest,
+    parse_manifests,
+    values_digest,
+)
+
+from .conftest import ROOT_DIR
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+async def test_values_digest():
+    assert values_digest({"a": 1, "b": {"c": [2]}}) == values_digest(
+        {"b": {"c": [2]}, "a": 1}
+    )
+    assert values_digest({"a": 1}) != values_digest({"a": "1"})
+
+
+async def test_parse_manifests(mocker):
+    to_thread = mocker.spy(asyncio, "to_thread")
+    text = "---\n# Source: a.yaml\nkind: Pod\n---\n# Source: b.yaml\n"
+    assert await parse_manifests(text) == [{"kind": "Pod"}]
+    assert not to_thread.called
+
+    # Large output is parsed in a thread
+    text = "".join(f"---\nkind: ConfigMap\ndata: {{a: '{i}'}}\n" for i in range(1000))
+    manifests = await parse_manifests(text.encode())
+    assert to_thread.called
+    assert len(manifests) == 1000
+    assert manifests[-1] == {"kind": "ConfigMap", "data": {"a": "999"}}
+
+
+async def test_chart_digest(tmp_path):
+    (tmp_path / "templates").mkdir()
+    template = tmp_path / "templates" / "a.yaml"
+    template.write_text("a: 1\n")
+
+    d1 = chart_digest(str(tmp_path))
+    assert chart_digest(str(tmp_path)) == d1
+    assert chart_digest(str(ROOT_DIR / "example")) != d1
+
+    template.write_text("a: 2\n")
+    assert chart_digest(str(tmp_path)) != d1
+
+
+async def test_render_cache():
+    renders = []
+
+    async def render():
+        renders.append(1)
+        await asyncio.sleep(0.1)
+        return [{"kind": "Pod", "metadata": {"name": f"pod-{len(renders)}"}}]
+
+    cache = RenderCache(maxsize=2)
+    key1 = cache.key(str(ROOT_DIR / "example"), {"a": 1})
+
+    # Concurrent renders of the same key are merged
+    r1, r2 = await asyncio.gather(
+        cache.get_or_render(key1, render), cache.get_or_render(key1, render)
+    )
+    assert r1 == r2 == [{"kind": "Pod", "metadata": {"name": "pod-1"}}]
+    assert len(renders) == 1
+
+    # Returned manifests are copies
+    r1[0]["kind"] = "Service"
+    r3 = await cache.get_or_render(key1, render)
+    assert r3[0]["kind"] == "Pod"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # Least recently used is evicted
+    key2 = cache.key(str(ROOT_DIR / "example"), {"a": 2})
+    key3 = cache.key(str(ROOT_DIR / "example"), {"a": 3})
+    await cache.get_or_render(key2, render)
+    await cache.get_or_render(key3, render)
+    assert len(cache) == 2
+    await cache.get_or_render(key1, render)
+    assert len(renders) == 4
+
+
+async def test_render_cache_secrets():
+    renders = []
+
+    async def render(vars):
+        renders.append(vars)
+        env = vars["env"]
+        return [{"kind": "Pod", "env": [env["JUPYTERHUB_API_TOKEN"], env["A"]]}]
+
+    def vars(token):
+        return {"env": {"JUPYTERHUB_API_TOKEN": token, "A": "a"}}
+
+    cache = RenderCache()
+    path = str(ROOT_DIR / "example")
+    # Two renders to check the token can be substituted
+    assert await cache.get(path, vars("t1"), render) == [
+        {"kind": "Pod", "env": ["t1", "a"]}
+    ]
+    assert len(renders) == 2
+    # The token isn't part of the key, or kept in the cache
+    assert await cache.get(path, vars("t2"), render) == [
+        {"kind": "Pod", "env": ["t2", "a"]}
+    ]
+    assert len(renders) == 2
+    assert "t1" not in str(cache.manifests())
+    assert "t2" not in str(cache.manifests())
+
+    # Renders that transform the token aren't cached
+    async def render_encoded(vars):
+        renders.append(vars)
+        token = vars["env"]["JUPYTERHUB_API_TOKEN"]
+        return [{"kind": "Secret", "data": {"token": token[::-1]}}]
+
+    cache = RenderCache()
+    for token in ("t1", "t2"):
+        assert await cache.get(path, vars(token), render_encoded) == [
+            {"kind": "Secret", "data": {"token": token[::-1]}}
+        ]
+    assert len(renders) == 6
+    assert len(cache) == 0
+
+
+def _vars(username, servername=""):
+    return {
+        "userid": 12,
+        "username": username,
+        "escaped_username": username,
+        "escaped_servername": servername,
+        "instance": "jupyter",
+        "env": {"TOKEN": f"secret-{username}", "EMPTY": ""},
+    }
+
+
+async def _render_pod(vars):
+    return [
+        {
+            "kind": "Pod",
+            "metadata": {
+                "name": f"jupyter-{vars['escaped_username']}",
+                "labels": {"hub.jupyter.org/servername": vars["escaped_servername"]},
+            },
+            "spec": {
+                "uid": vars["userid"],
+                "env": [{"name": k, "value": v} for (k, v) in vars["env"].items()],
+            },
+        }
+    ]
+
+
+async def test_skeleton_cache():
+    renders = []
+
+    async def render(vars):
+        renders.append(vars)
+        return await _render_pod(vars)
+
+    cache = SkeletonCache()
+    for username in ("alice", "bob"):
+        vars = _vars(username)
+        assert await cache.get(str(ROOT_DIR / "example"), vars, render) == (
+            await _render_pod(vars)
+        )
+    # Two renders to check the skeleton, then substitution only
+    assert len(renders) == 2
+
+    # Empty values are part of the key
+    vars = _vars("alice", "server")
+    assert await cache.get(str(ROOT_DIR / "example"), vars, render) == (
+        await _render_pod(vars)
+    )
+    assert len(renders) == 4
+
+
+async def test_skeleton_cache_bounded():
+    renders = []
+
+    async def render(vars):
+        renders.append(vars)
+        return await _render_pod(vars)
+
+    def vars(instance):
+        # Non-user values are part of the key
+        return _vars("alice") | {"instance": instance}
+
+    path = str(ROOT_DIR / "example")
+    cache = SkeletonCache(maxsize=2)
+    for instance in ("a", "b", "a", "c"):
+        await cache.get(path, vars(instance), render)
+    # "b" is least recently used so it's evicted
+    assert len(cache) == 2
+    assert len(renders) == 6
+    await cache.get(path, vars("a"), render)
+    assert len(renders) == 6
+    await cache.get(path, vars("b"), render)
+    assert len(renders) == 8
+
+    cache = SkeletonCache(maxsize=0)
+    await cache.get(path, vars("a"), render)
+    assert len(cache) == 0
+
+
+async def test_skeleton_cache_unsupported():
+    async def render_conditional(vars):
+        docs = await _render_pod(vars)
+        if len(vars["escaped_username"]) > 10:
+            docs[0]["metadata"]["name"] = "long"
+        return docs
+
+    async def render_key(vars):
+        docs = await _render_pod(vars)
+        docs[0]["metadata"]["labels"][vars["escaped_username"]] = "true"
+        return docs
+
+    for render in (render_conditional, render_key):
+        cache = SkeletonCache()
+        assert (
+            await cache.get(str(ROOT_DIR / "example"), _vars("alice"), render) is None
+        )
+
+
+async def test_render_queue():
+    queue = RenderQueue(max_concurrent=2, notify_interval=0)
+    running = []
+    max_running = 0
+    positions: dict[int, list[int]] = {}
+
+    async def render(n):
+        nonlocal max_running
+        async with queue.slot(lambda p: positions.setdefault(n, []).append(p)):
+            running.append(n)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.05)
+            running.remove(n)
+
+    await asyncio.gather(*(render(n) for n in range(5)))
+    assert max_running == 2
+    assert queue.completed == 5
+    assert queue.running == 0
+    assert queue.depth == 0
+    assert queue.max_wait > 0
+
+    # First two renders don't wait, the last moves up the queue
+    assert 0 not in positions
+    assert 1 not in positions
+    assert positions[4] == [3, 2, 1]
+
+
+async def test_render_queue_notify_throttled():
+    queue = RenderQueue(max_concurrent=1, notify_interval=0.2)
+    calls = 0
+    positions: dict[int, list[int]] = {}
+    wait = REGISTRY.get_sample_value(
+        "jupyterhub_kubetemplatespawner_render_queue_wait_seconds_count"
+    )
+
+    async def render(n):
+        def on_position(p):
+            nonlocal calls
+            calls += 1
+            positions.setdefault(n, []).append(p)
+
+        async with queue.slot(on_position):
+            await asyncio.sleep(0.001)
+
+    await asyncio.gather(*(render(n) for n in range(50)))
+    assert queue.completed == 50
+    # Told their position when queued, then not on every release
+    assert positions[49][0] == 49
+    assert calls < 2 * 49
+    # No position is repeated
+    assert all(len(set(p)) == len(p) for p in positions.values())
+    assert (
+        REGISTRY.get_sample_value(
+            "jupyterhub_kubetemplatespawner_render_queue_wait_seconds_count"
+        )
+        == wait + 50
+    )
+    assert (
+        REGISTRY.get_sample_value("jupyterhub_kubetemplatespawner_render_queue_depth")
+        == 0
+    )
+
+
+async def test_render_queue_cancel():
+    queue = RenderQueue(max_concurrent=1)
+    release = asyncio.Event()
+
+    async def render():
+        async with queue.slot():
+            await release.wait()
+
+    t1 = asyncio.create_task(render())
+    t2 = asyncio.create_task(render())
+    await asyncio.sleep(0.01)
+    assert queue.depth == 1
+    t2.cancel()
+    await asyncio.sleep(0.01)
+    assert queue.depth == 0
+
+    release.set()
+    await t1
+    assert queue.running == 0
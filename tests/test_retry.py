@@ -0,0 +1,44 @@
+import asyncio
+from time import monotonic
+
+import pytest
+
+from kubetemplatespawner._retry import Backoff
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+async def test_backoff_delays(mocker):
+    mocker.patch.multiple(Backoff, initial=1, maximum=5, factor=2, jitter=0)
+    backoff = Backoff()
+    assert backoff.remaining == float("inf")
+    assert [backoff.next_delay() for _ in range(5)] == [1, 2, 4, 5, 5]
+    backoff.reset()
+    assert backoff.next_delay() == 1
+
+
+async def test_backoff_jitter(mocker):
+    mocker.patch.multiple(Backoff, initial=4, maximum=4, factor=2, jitter=0.5)
+    delays = [Backoff().next_delay() for _ in range(100)]
+    assert all(2 <= d <= 4 for d in delays)
+    assert len(set(delays)) > 1
+
+
+async def test_backoff_deadline(mocker):
+    mocker.patch.multiple(Backoff, initial=10, maximum=10, factor=2, jitter=0)
+    backoff = Backoff(0.2)
+    assert 0 < backoff.next_delay() <= 0.2
+
+    start = monotonic()
+    assert not await backoff.sleep()
+    assert backoff.expired
+    assert monotonic() - start < 1
+    assert not await backoff.sleep()
+
+
+async def test_backoff_sleep(mocker):
+    mocker.patch.multiple(Backoff, initial=0.01, maximum=0.01, factor=2, jitter=0)
+    backoff = Backoff(5)
+    assert await backoff.sleep()
+    assert await asyncio.wait_for(backoff.sleep(), 1)
+    assert backoff.attempts == 2
@@ -115,11 +115,11 @@ async def test_spawner(k8s_client, k8s_namespace, config, hub):
     url = await spawner.start()
     assert re.match(r"http://\d+\.\d+\.\d+\.\d+:8888$", url)
 
-    assert spawner._manifests
+    assert spawner._manifests_digest
 
     pod_name = None
     pvc_name = None
-    for m in spawner._manifests:
+    for m in await spawner.manifests():
         if m["kind"] == "Pod":
             assert not pod_name
             pod_name = m["metadata"]["name"]
@@ -166,8 +166,8 @@ async def test_spawner(k8s_client, k8s_namespace, config, hub):
     assert status == 0
 
     # check state has been cleared
-    assert not spawner._manifests
-    assert not spawner._connection_manifest
+    assert not spawner._manifests_digest
+    assert not spawner._connection_summary
 
     # should delete PVC
     await spawner.delete_forever()
@@ -0,0 +1,73 @@
+import pytest
+
+from kubetemplatespawner._store import ManifestStore
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+MANIFESTS = [
+    {"apiVersion": "v1", "kind": "Pod", "metadata": {"name": "a", "labels": {}}},
+    {"apiVersion": "v1", "kind": "Service", "metadata": {"name": "a"}},
+]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+async def test_manifest_store(compress):
+    store = ManifestStore(compress=compress)
+    d1 = store.put(MANIFESTS)
+    # Key order doesn't matter
+    d2 = store.put([dict(reversed(m.items())) for m in MANIFESTS])
+    assert d1 == d2
+    assert len(store) == 1
+    assert store.get(d1) == MANIFESTS
+    assert store.get("missing") is None
+
+    store.release(d1)
+    assert store.get(d1) == MANIFESTS
+    store.release(d1)
+    assert store.get(d1) is None
+    assert len(store) == 0
+
+
+async def test_manifest_store_path(tmp_path):
+    store = ManifestStore(path=str(tmp_path))
+    digest = store.put(MANIFESTS)
+    assert (tmp_path / f"{digest}.json").exists()
+    # Blobs in files aren't kept in memory
+    assert store.size == 0
+    assert store.get(digest) == MANIFESTS
+
+    # e.g. after a restart
+    store2 = ManifestStore(path=str(tmp_path), compress=False)
+    assert store2.get(digest) == MANIFESTS
+    store2.acquire(digest)
+    # Other persisted state may reference the file until it's swept
+    store2.release(digest)
+    assert store2.get(digest) == MANIFESTS
+    store2.sweep([])
+    assert store2.get(digest) == MANIFESTS
+    digest2 = store2.put(MANIFESTS[:1])
+    store2.release(digest2)
+    assert store2.get(digest2) is None
+
+
+async def test_manifest_store_sweep(tmp_path):
+    store = ManifestStore(path=str(tmp_path))
+    persisted = store.put(MANIFESTS)
+    referenced = store.put(MANIFESTS[:1])
+    unreferenced = store.put(MANIFESTS[1:])
+    store.release(persisted)
+    store.release(unreferenced)
+
+    # Recently written files are kept
+    assert store.sweep([persisted]) == 0
+    assert store.sweep([persisted], min_age=0) == 1
+    assert store.get(persisted) == MANIFESTS
+    assert store.get(referenced) == MANIFESTS[:1]
+    assert store.get(unreferenced) is None
+
+    # Persisted state when swept still references it
+    store.acquire(persisted)
+    store.release(persisted)
+    assert store.get(persisted) == MANIFESTS
+    store.release(referenced)
+    assert store.get(referenced) is None
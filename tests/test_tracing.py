@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from kubetemplatespawner._tracing import InMemoryExporter, Tracer
+
+pytestmark = pytest.mark.asyncio(loop_scope="module")
+
+
+async def test_tracer_disabled():
+    tracer = Tracer()
+    with tracer.span("a") as span:
+        assert span is None
+
+
+async def test_tracer():
+    exporter = InMemoryExporter()
+    tracer = Tracer(exporter)
+
+    async def child(name):
+        with tracer.span("child", name=name):
+            await asyncio.sleep(0)
+
+    with tracer.span("root", kind="Pod") as root:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(child("a"))
+            tg.create_task(child("b"))
+        root.set_attribute("extra", 1)
+    with pytest.raises(ValueError):
+        with tracer.span("failed"):
+            raise ValueError("test")
+
+    assert [s.name for s in exporter.spans] == ["child", "child", "root", "failed"]
+    [root] = exporter.by_name("root")
+    assert root.parent_id is None
+    assert root.attributes == {"kind": "Pod", "extra": 1}
+    assert root.duration >= 0
+    children = exporter.children(root)
+    assert sorted(s.attributes["name"] for s in children) == ["a", "b"]
+    assert all(s.trace_id == root.trace_id for s in children)
+
+    [failed] = exporter.by_name("failed")
+    assert failed.parent_id is None
+    assert failed.trace_id != root.trace_id
+    assert failed.error == "ValueError('test')"
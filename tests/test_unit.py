@@ -1,11 +1,18 @@
+import os
 from collections import namedtuple
 
 import pytest
 import yaml
+from jupyterhub import orm
 from kubernetes_asyncio.dynamic.resource import ResourceInstance
+from prometheus_client import REGISTRY
 from traitlets import TraitError
 
 import kubetemplatespawner.spawner
+from kubetemplatespawner import GoTemplateRenderer, HelmWorkerRenderer
+from kubetemplatespawner._kubernetes import KubernetesStatusError
+from kubetemplatespawner._store import ManifestStore
+from kubetemplatespawner._tracing import InMemoryExporter, tracer
 
 from .conftest import ROOT_DIR
 
@@ -15,8 +22,7 @@ pytestmark = pytest.mark.asyncio(loop_scope="module")
 @pytest.fixture(autouse=True)
 def mock_k8s_client(mocker):
     mocker.patch("kubetemplatespawner.spawner.load_config")
-    mocker.patch("kubetemplatespawner.spawner.ApiClient")
-    mocker.patch("kubetemplatespawner.spawner.DynamicClient")
+    mocker.patch("kubetemplatespawner.spawner.shared_dynamic_client")
 
 
 class MockKubeTemplateSpawner(kubetemplatespawner.spawner.KubeTemplateSpawner):
@@ -25,11 +31,19 @@ class MockKubeTemplateSpawner(kubetemplatespawner.spawner.KubeTemplateSpawner):
         return {"TEST": "Test\nKubeTemplateSpawner"}
 
 
-def mock_spawner(username="user-1", servername="", namespace="default", **kwargs):
+def mock_spawner(
+    username="user-1", servername="", namespace="default", base_url=None, **kwargs
+):
+    # A real server is only needed for template values such as base_url
+    server = None
+    if base_url:
+        server = orm.Server(
+            proto="http", ip="", port=0, base_url=base_url, cookie_name="c"
+        )
+    kwargs.setdefault("template_path", str(ROOT_DIR / "example"))
     k = MockKubeTemplateSpawner(
-        template_path=str(ROOT_DIR / "example"),
         user=namedtuple("User", "id name")(12, username),
-        orm_spawner=namedtuple("ORMSpawner", "name server")(servername, None),
+        orm_spawner=namedtuple("ORMSpawner", "name server")(servername, server),
         namespace=namespace,
         **kwargs,
     )
@@ -71,9 +85,88 @@ async def test_template_namespace():
     }
 
 
-async def test_manifests():
+async def test_skeleton_shared_between_users(tmp_path, mocker):
+    (tmp_path / "Chart.yaml").write_text("apiVersion: v2\nname: test\nversion: 1.0.0\n")
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "pod.yaml").write_text(
+        "apiVersion: v1\n"
+        "kind: Pod\n"
+        "metadata:\n"
+        "  name: jupyter-{{ .Values.escaped_username }}\n"
+        "  annotations:\n"
+        "    kubetemplatespawner/connection: 'true'\n"
+        "spec:\n"
+        "  securityContext:\n"
+        "    runAsUser: {{ .Values.userid }}\n"
+        "  containers:\n"
+        "  - name: notebook\n"
+        "    args: [--base-url={{ .Values.base_url }}, --uid={{ .Values.userid }}]\n"
+    )
+    render = mocker.spy(GoTemplateRenderer, "render")
+    pods = []
+    for username in ("alice", "bob"):
+        k = mock_spawner(
+            username,
+            base_url=f"/user/{username}/",
+            template_path=str(tmp_path),
+            renderer_class="kubetemplatespawner.GoTemplateRenderer",
+            render_skeleton=True,
+        )
+        assert k.template_namespace()["base_url"] == f"/user/{username}/"
+        [pod] = await k.manifests()
+        pods.append(pod)
+    # Two renders to check the skeleton, then substitution for the second user
+    assert render.call_count == 2
+    assert pods[1]["metadata"]["name"] == "jupyter-bob"
+    assert pods[1]["spec"]["securityContext"]["runAsUser"] == 12
+    assert pods[1]["spec"]["containers"][0]["args"] == [
+        "--base-url=/user/bob/",
+        "--uid=12",
+    ]
+
+
+async def test_warm_pool_slot_namespace(mocker):
+    k = mock_spawner(
+        "user-1",
+        base_url="/user/user-1/",
+        extra_vars={"UID": 12},
+        warm_pool_sizes={"default": 1},
+        render_cache_size=0,
+    )
+    pool = k._warm_pool()
+    vars = k._warm_pool_namespace(pool, "abc")
+    assert vars == {
+        "env": {},
+        "escaped_servername": "",
+        "escaped_user_server": "warm-pool-abc",
+        "escaped_username": "warm-pool-abc",
+        "instance": "jupyter",
+        "ip": "0.0.0.0",
+        "namespace": "default",
+        "port": 8888,
+        "unescaped_servername": "",
+        "unescaped_username": "warm-pool-abc",
+        "userid": None,
+        "username": "warm-pool-abc",
+        "warm_pool": "default",
+    }
+
+    # The connection object is only rendered once
+    template = mocker.spy(k, "_template")
+    connection = await k._warm_pool_connection(pool)
+    assert connection.kind == "Pod"
+    assert await k._warm_pool_connection(pool) == connection
+    assert template.call_count == 1
+
+
+@pytest.mark.parametrize("render_skeleton", [False, True])
+async def test_manifests(render_skeleton):
     k = mock_spawner(
-        "user-1@🐧", "", "dev", extra_vars=lambda self: {"UID": self.user.id}
+        "user-1@🐧",
+        "",
+        "dev",
+        extra_vars=lambda self: {"UID": self.user.id},
+        render_skeleton=render_skeleton,
     )
     ms = await k.manifests()
     assert len(ms) == 2
@@ -111,9 +204,92 @@ async def test_get_connection(resource, expected):
     assert c == expected
 
 
+async def test_state():
+    k = mock_spawner()
+    ms = await k.manifests()
+    state = k.get_state()
+    assert "manifests" not in state
+    assert state["summaries"] == [
+        ["v1", m["kind"], m["metadata"]["name"], "default"] for m in ms
+    ]
+    assert state["summaries"][state["connection"]][1] == "Pod"
+
+    k2 = mock_spawner()
+    k2.load_state(state)
+    assert k2.get_state() == state
+    assert await k2.manifests() == ms
+
+    k.clear_state()
+    assert not k.get_state().get("manifests_digest")
+    k2.clear_state()
+    assert (
+        kubetemplatespawner.spawner.manifest_store.get(state["manifests_digest"])
+        is None
+    )
+
+
+async def test_manifest_store_sweep(tmp_path, mocker):
+    mocker.patch.object(kubetemplatespawner.spawner, "manifest_store", ManifestStore())
+    store = kubetemplatespawner.spawner.manifest_store
+    persisted = ManifestStore(path=str(tmp_path)).put([{"kind": "Pod"}])
+    (tmp_path / "unreferenced.json").write_text("[]")
+    (tmp_path / "recent.json").write_text("[]")
+    os.utime(tmp_path / "unreferenced.json", (0, 0))
+
+    db = orm.new_session_factory("sqlite://")()
+    user = orm.User(name="user-1")
+    db.add(user)
+    orm_spawner = orm.Spawner(user=user, name="", state={"manifests_digest": persisted})
+    db.add(orm_spawner)
+    db.add(orm.Spawner(user=user, name="stopped", state={}))
+    db.commit()
+
+    # Files are swept once, when the first spawner is created
+    MockKubeTemplateSpawner(
+        user=namedtuple("User", "id name")(12, "user-1"),
+        orm_spawner=orm_spawner,
+        manifest_store_path=str(tmp_path),
+    )
+    assert store.swept
+    assert sorted(f.name for f in tmp_path.iterdir()) == [
+        f"{persisted}.json",
+        "recent.json",
+    ]
+
+
+async def test_state_migration():
+    k = mock_spawner()
+    ms = await k.manifests()
+    pod = next(m for m in ms if m["kind"] == "Pod")
+    state = k.get_state()
+    k.clear_state()
+
+    k2 = mock_spawner()
+    k2.load_state(
+        {
+            "kubetemplatespawner_version": "0.0.1",
+            "manifests": ms,
+            "connection_manifest": pod,
+        }
+    )
+    assert k2.get_state() == state
+    k2.clear_state()
+
+
+def metric(name, **labels):
+    return (
+        REGISTRY.get_sample_value(f"jupyterhub_kubetemplatespawner_{name}", labels) or 0
+    )
+
+
 async def test_start(mocker):
     delete_manifest = mocker.patch("kubetemplatespawner.spawner.delete_manifest")
-    deploy_manifest = mocker.patch("kubetemplatespawner.spawner.deploy_manifest")
+    deploy_manifest = mocker.patch(
+        "kubetemplatespawner.spawner.deploy_manifest",
+        return_value={"get": 0.1, "create": 0.1, "ready": 1.0, "total": 1.2},
+    )
+    ready_count = metric("ready_duration_seconds_count", kind="Pod", instance="jupyter")
+    ready_sum = metric("ready_duration_seconds_sum", kind="Pod", instance="jupyter")
 
     get_resource_by_name = mocker.patch(
         "kubetemplatespawner.spawner.get_resource_by_name",
@@ -137,6 +313,11 @@ async def test_start(mocker):
     )
 
     assert len(deploy_manifest.call_args_list) == 2
+    assert deploy_manifest.call_args_list[0].kwargs == {
+        "field_manager": None,
+        "force_conflicts": False,
+        "dry_run": False,
+    }
     deploy1 = deploy_manifest.call_args_list[0].args[1]
     deploy2 = deploy_manifest.call_args_list[1].args[1]
     if deploy1["kind"] != "Pod":
@@ -146,6 +327,72 @@ async def test_start(mocker):
     assert deploy1["metadata"]["name"] == "jupyter-user-1"
     assert deploy2["kind"] == "PersistentVolumeClaim"
     assert deploy2["metadata"]["name"] == "jupyter-user-1"
+    # Timeout is the time remaining before the deadline
+    assert 0 < deploy_manifest.call_args_list[0].args[2] <= k.k8s_timeout
+
+    messages = []
+    while (event := k.events.get_nowait()) is not None:
+        messages.append(event["message"])
+    assert sorted(m for m in messages if "is ready" in m) == [
+        "PersistentVolumeClaim/jupyter-user-1 is ready (60s remaining)",
+        "Pod/jupyter-user-1 is ready (60s remaining)",
+    ]
+
+    labels = {"kind": "Pod", "instance": "jupyter"}
+    assert metric("ready_duration_seconds_count", **labels) == ready_count + 1
+    assert metric("ready_duration_seconds_sum", **labels) == ready_sum + 1.0
+    assert metric("connection_duration_seconds_count", **labels) >= 1
+
+
+async def test_progress_events_bounded():
+    k = mock_spawner()
+    for i in range(150):
+        k._put_event({"message": f"event {i}"})
+    k._put_event(None)
+    # The oldest events are dropped, but not the end of progress
+    messages = [event["message"] async for event in k.progress()]
+    assert len(messages) == k.events.maxsize - 1
+    assert messages[-1] == "event 149"
+    assert k.events_dropped == 51
+
+
+async def test_api_errors_from_status(mocker):
+    status = ResourceInstance(None, {"kind": "Status", "code": 403})
+    mocker.patch(
+        "kubetemplatespawner.spawner.deploy_manifest",
+        side_effect=KubernetesStatusError("Forbidden", status),
+    )
+    labels = {"operation": "deploy", "kind": "Pod", "instance": "jupyter"}
+    errors = metric("api_errors_total", **labels)
+
+    k = mock_spawner()
+    with pytest.raises(KubernetesStatusError):
+        await k._deploy_manifest(
+            None, {"kind": "Pod", "metadata": {"name": "a"}}, False
+        )
+    assert metric("api_errors_total", **labels) == errors + 1
+
+
+async def test_poll_batch_failure(mocker):
+    status = ResourceInstance(None, {"kind": "Status", "code": 500})
+    get = mocker.patch(
+        "kubetemplatespawner.spawner.poll_lister.get",
+        side_effect=KubernetesStatusError("Internal error", status),
+    )
+    k = mock_spawner(poll_batch_window=0.1)
+    await k.manifests()
+    state = k.get_state()
+    assert "manifests_digest" in state
+
+    # Unknown, so the server isn't marked stopped
+    assert await k.poll() is None
+    assert k.get_state() == state
+
+    # Only a missing object means the server has stopped
+    get.side_effect = None
+    get.return_value = None
+    assert await k.poll() == 0
+    assert "manifests_digest" not in k.get_state()
 
 
 async def test_stop(mocker):
@@ -188,3 +435,269 @@ async def test_stop(mocker):
         },
         {"kubetemplatespawner/lifecycle": "server-stopped"},
     )
+
+
+async def test_stop_deduplicates_kinds(mocker):
+    get_deletions_by_labels = mocker.patch(
+        "kubetemplatespawner.spawner.get_deletions_by_labels",
+        side_effect=lambda dyn_client, api_version, kind, *args, **kwargs: [
+            ResourceInstance(
+                None,
+                {
+                    "apiVersion": api_version,
+                    "kind": kind,
+                    "metadata": {"name": "jupyter-user-1", "namespace": "default"},
+                },
+            )
+        ],
+    )
+    delete_manifest = mocker.patch("kubetemplatespawner.spawner.delete_manifest")
+
+    k = mock_spawner(resource_kinds=["v1/ConfigMap", "v1/Pod", "v1/ConfigMap"])
+    await k.stop()
+
+    kinds = sorted(c.args[2] for c in get_deletions_by_labels.call_args_list)
+    assert kinds == ["ConfigMap", "Pod"]
+    # Pod deleted before the ConfigMap it might use
+    deleted = [c.args[1].kind for c in delete_manifest.call_args_list]
+    assert deleted == ["Pod", "ConfigMap"]
+
+
+async def test_stop_background(mocker):
+    mocker.patch(
+        "kubetemplatespawner.spawner.get_deletions_by_labels",
+        return_value=[
+            ResourceInstance(
+                None,
+                {
+                    "apiVersion": "v1",
+                    "kind": "Pod",
+                    "metadata": {"name": "jupyter-user-1", "namespace": "default"},
+                },
+            )
+        ],
+    )
+    delete_manifest = mocker.patch("kubetemplatespawner.spawner.delete_manifest")
+    track = mocker.patch("kubetemplatespawner.spawner.deletion_reaper.track")
+
+    k = mock_spawner(
+        resource_kinds=["v1/Pod"],
+        k8s_timeout=30,
+        k8s_delete_background=True,
+        k8s_delete_propagation_policy="Foreground",
+        k8s_delete_grace_period=5,
+    )
+    await k.stop()
+
+    [call] = delete_manifest.call_args_list
+    assert call.args[2] == 0
+    assert call.kwargs == {
+        "propagation_policy": "Foreground",
+        "grace_period_seconds": 5,
+    }
+    [call] = track.call_args_list
+    assert call.args[1:] == (
+        kubetemplatespawner.spawner.ManifestSummary(
+            "v1", "Pod", "jupyter-user-1", "default"
+        ),
+        30,
+    )
+
+
+@pytest.mark.parametrize(
+    "collection_allowed,spawning", [(True, False), (False, False), (True, True)]
+)
+async def test_stop_many(mocker, collection_allowed, spawning):
+    def obj(kind, username, lifecycle):
+        return ResourceInstance(
+            None,
+            {
+                "apiVersion": "v1",
+                "kind": kind,
+                "metadata": {
+                    "name": f"{kind}-{username}",
+                    "namespace": "default",
+                    "annotations": {"kubetemplatespawner/lifecycle": lifecycle},
+                },
+            },
+        )
+
+    def list_objects(dyn_client, api_version, kind, selector, namespace):
+        if kind == "Pod":
+            return [obj("Pod", "user-1", "server-stopped")]
+        return [
+            obj("ConfigMap", "user-1", "server-stopped"),
+            obj("ConfigMap", "user-2", "user-deleted"),
+        ]
+
+    get_resource_by_selector = mocker.patch(
+        "kubetemplatespawner.spawner.get_resource_by_selector",
+        side_effect=list_objects,
+    )
+    delete_collection = mocker.patch(
+        "kubetemplatespawner.spawner.delete_collection",
+        return_value=collection_allowed,
+    )
+    delete_manifest = mocker.patch("kubetemplatespawner.spawner.delete_manifest")
+    track = mocker.patch("kubetemplatespawner.spawner.deletion_reaper.track")
+    wait = mocker.patch("kubetemplatespawner.spawner.deletion_reaper.wait")
+
+    kinds = ["v1/ConfigMap", "v1/Pod"]
+    spawners = [
+        mock_spawner("user-1", resource_kinds=kinds),
+        mock_spawner("user-2", resource_kinds=kinds),
+        mock_spawner("user-3", "named", resource_kinds=kinds),
+    ]
+    # A delete collection request could delete the new server's objects
+    spawners[1]._spawn_pending = spawning
+    await kubetemplatespawner.spawner.KubeTemplateSpawner.stop_many(spawners)
+
+    # Pods before ConfigMaps, one list per server name
+    selectors = [c.args[2:4] for c in get_resource_by_selector.call_args_list]
+    assert sorted(selectors[:2]) == [
+        (
+            "Pod",
+            "app.kubernetes.io/instance=jupyter,hub.jupyter.org/servername=,"
+            "hub.jupyter.org/username in (user-1,user-2)",
+        ),
+        (
+            "Pod",
+            "app.kubernetes.io/instance=jupyter,hub.jupyter.org/servername=named,"
+            "hub.jupyter.org/username in (user-3)",
+        ),
+    ]
+    assert [s[0] for s in selectors[2:]] == ["ConfigMap", "ConfigMap"]
+
+    # All Pods can be deleted
+    collections = [c.args[2:] for c in delete_collection.call_args_list]
+    assert [c[0] for c in collections] == ["Pod"] * (1 if spawning else 2)
+    # A ConfigMap must be kept so others are deleted individually, as are the
+    # Pods if the delete collection request was rejected or a server is spawning
+    individual = ["ConfigMap-user-1", "ConfigMap-user-1"]
+    if not collection_allowed:
+        individual += ["Pod-user-1", "Pod-user-1"]
+    elif spawning:
+        assert "user-1,user-2" not in collections[0][2]
+        individual += ["Pod-user-1"]
+    assert sorted(c.args[1].name for c in delete_manifest.call_args_list) == (
+        individual
+    )
+    assert len(track.call_args_list) == 4
+    assert len(wait.call_args_list) == 2
+
+
+async def test_start_tracing(mocker):
+    mocker.patch(
+        "kubetemplatespawner.spawner.deploy_manifest", return_value={"total": 1.0}
+    )
+    mocker.patch(
+        "kubetemplatespawner.spawner.get_resource_by_name",
+        return_value=ResourceInstance(
+            None, {"kind": "Pod", "status": {"podIP": "1.2.3.4"}}
+        ),
+    )
+    exporter = InMemoryExporter()
+    k = mock_spawner(trace_exporter=exporter)
+    try:
+        await k.start()
+    finally:
+        tracer.exporter = None
+
+    [start] = exporter.by_name("start")
+    assert start.attributes == {"username": "user-1", "servername": ""}
+    children = sorted(
+        (s.name, s.attributes.get("kind")) for s in exporter.children(start)
+    )
+    assert children == [
+        ("deploy_manifest", "PersistentVolumeClaim"),
+        ("deploy_manifest", "Pod"),
+        ("events", None),
+        ("get_connection_object", "Pod"),
+        ("render_manifests", None),
+    ]
+
+
+async def test_start_image_prepull(mocker):
+    deploy_manifest = mocker.patch(
+        "kubetemplatespawner.spawner.deploy_manifest", return_value={"total": 1.0}
+    )
+    mocker.patch(
+        "kubetemplatespawner.spawner.get_resource_by_name",
+        return_value=ResourceInstance(
+            None, {"kind": "Pod", "status": {"podIP": "1.2.3.4"}}
+        ),
+    )
+    k = mock_spawner(instance_name="prepull", image_prepull_count=2)
+    await k.start()
+
+    prepuller = kubetemplatespawner.spawner.shared_image_prepuller("prepull", "default")
+    await prepuller._update_task
+    daemonset = deploy_manifest.call_args_list[-1].args[1]
+    assert daemonset["kind"] == "DaemonSet"
+    assert daemonset["metadata"]["name"] == "prepull-image-prepuller"
+    [init] = daemonset["spec"]["template"]["spec"]["initContainers"]
+    assert init["image"] == "quay.io/jupyterhub/k8s-singleuser-sample:4.1.0"
+    assert deploy_manifest.call_args_list[-1].args[2] == k.image_prepull_timeout
+    assert prepuller.pulled == {init["image"]}
+
+
+async def test_start_image_prepull_disabled(mocker):
+    mocker.patch(
+        "kubetemplatespawner.spawner.deploy_manifest", return_value={"total": 1.0}
+    )
+    mocker.patch(
+        "kubetemplatespawner.spawner.get_resource_by_name",
+        return_value=ResourceInstance(
+            None, {"kind": "Pod", "status": {"podIP": "1.2.3.4"}}
+        ),
+    )
+    status = ResourceInstance(None, {"kind": "Status", "code": 403})
+    delete_manifest = mocker.patch(
+        "kubetemplatespawner.spawner.delete_manifest",
+        side_effect=KubernetesStatusError("Forbidden", status),
+    )
+    k = mock_spawner(instance_name="prepull-disabled")
+    await k.start()
+
+    # A leftover DaemonSet is deleted, a Role without DaemonSets is fine
+    prepuller = kubetemplatespawner.spawner.shared_image_prepuller(
+        "prepull-disabled", "default"
+    )
+    await prepuller._update_task
+    assert delete_manifest.call_args.args[1].name == "prepull-disabled-image-prepuller"
+    assert prepuller.removed
+
+
+async def test_gotemplate_renderer(mocker):
+    subprocess = mocker.patch("asyncio.create_subprocess_exec")
+    k = mock_spawner(
+        username="gotemplate",
+        renderer_class="kubetemplatespawner.GoTemplateRenderer",
+    )
+    [pvc, pod] = await k.manifests()
+    assert not subprocess.called
+    assert pvc["kind"] == "PersistentVolumeClaim"
+    assert pod["kind"] == "Pod"
+    assert pod["metadata"]["name"] == "jupyter-gotemplate"
+    assert pod["spec"]["containers"][0]["env"] == [
+        {"name": "TEST", "value": "Test\nKubeTemplateSpawner"}
+    ]
+
+
+async def test_helm_worker_renderer():
+    from .test_helmworker import STUB_WORKER
+
+    k = mock_spawner(
+        username="helmworker",
+        renderer_class="kubetemplatespawner.HelmWorkerRenderer",
+        helm_worker_command=STUB_WORKER,
+        helm_worker_health_check_interval=0,
+    )
+    renderer = kubetemplatespawner.spawner.shared_renderer(HelmWorkerRenderer)
+    try:
+        [pvc, pod] = await k.manifests()
+        assert pod["metadata"]["name"] == "jupyter-helmworker"
+        [worker] = renderer.pool(k.template_path).workers
+        assert worker.command == STUB_WORKER
+    finally:
+        await renderer.close()